@@ -1,25 +1,38 @@
-import subprocess
+import asyncio
+import json
+import re
 
+import compile_check
+import diagnostics
 import style
 
 from configuration import Config
-from conversation import Conversation, LongInputException
+from metrics import labelled, timed
+from conversation import LongInputException, new_conversation
+from worktrees import worktrees
 
 
+# The steps of the arbiter are coroutines, whatever the transport of its conversation
+# (see `new_conversation`)
 class Arbiter:
 
     def __init__(self):
-        self.grade = -1
-        self.conversation = Conversation(Config.arbiter_model, Config.arbiter_region, Config.prompt_dir)
+        self.reset_verdict()
+        self.conversation = new_conversation(Config.arbiter_model, Config.arbiter_region, Config.prompt_dir)
 
-    def hi(self):
+    async def hi(self):
         self.conversation.add_system_prompt(prompt_str='Hi!')
-        return self.conversation.hi()
+        return await self.conversation.hi()
+
+    @timed('assess')
+    async def assess_worker(self, original_file: str, worker_output: str):
+        self.start_assessment(original_file, worker_output)
+        return await self.read_verdict(await self.conversation.converse_async())
 
-    def assess_worker(self, original_file: str, worker_output: str):
+    def start_assessment(self, original_file: str, worker_output: str):
         Config.verboseprint(f'Assessing the output with {Config.arbiter_model}')
 
-        self.grade = -1
+        self.reset_verdict()
 
         # TODO: Why not add this during initialization?
         self.conversation.add_system_prompt(prompt_filename='arbiter_system_prompt.txt')
@@ -53,13 +66,30 @@ class Arbiter:
                 """,
                 msg_filename='worker_type_invariant.txt'
             )
-        self.conversation.converse()
-        return self.get_grade()
+        self.conversation.send_message_str(Arbiter.VERDICT_REQUEST)
+
+    # Restores the assessment of the contracts of the previous run (see journal.py)
+    def resume_assessment(self, original_file: str, worker_output: str, grade: int):
+        self.reset_verdict()
+        self.grade = grade
+        self.conversation.add_system_prompt(prompt_filename='arbiter_system_prompt.txt')
+        self.conversation.send_file_with_message(
+            f"""
+            You already assessed the following contracts generated by the worker for the attached
+            file, and graded them {grade}/5:
+            """ + "\n" + worker_output,
+            original_file)
+        self.conversation.set_checkpoint()
+
+    @timed('assess harnesses')
+    async def assess_harnesses(self, worker_output: str):
+        self.start_harnesses_assessment(worker_output)
+        return await self.read_verdict(await self.conversation.converse_async())
 
-    def assess_harnesses(self, worker_output: str):
+    def start_harnesses_assessment(self, worker_output: str):
         Config.verboseprint(f'Assessing the generated harnesses with {Config.arbiter_model}')
 
-        self.grade = -1
+        self.reset_verdict()
 
         self.conversation.send_message_str(
             """
@@ -69,9 +99,10 @@ class Arbiter:
             """
         )
         self.conversation.send_message_from_file('harnesses.txt')
-        self.conversation.converse()
-        self.conversation.send_message_str(
-            f"""
+        self.conversation.send_message_str(Arbiter.harnesses_assessment_request(worker_output))
+
+    def harnesses_assessment_request(worker_output: str):
+        return f"""
             IMPORTANT:
 
             1. Contract harnesses MUST NOT use `assert` or `assume` (`kani::assume`). Kani
@@ -86,102 +117,150 @@ class Arbiter:
             And now please assess the following harnesses generated by the worker:
 
             {worker_output}
-            """
-        )
-        self.conversation.converse()
-        return self.get_grade()
+            """ + Arbiter.VERDICT_REQUEST
+
+    @timed('reassess')
+    async def reassess_worker(self, worker_output: str):
+        self.start_reassessment(worker_output)
+        return await self.read_verdict(await self.conversation.converse_async())
 
-    def reassess_worker(self, worker_output: str):
+    def start_reassessment(self, worker_output: str):
         Config.verboseprint(f'\tRe-assessing the output')
 
-        self.grade = -1
+        self.reset_verdict()
         self.conversation.send_message_str(
             """
             Please re-assess the following updated worker's output:
-            """ + "\n" + worker_output)
-        self.conversation.converse()
-        return self.get_grade()
+            """ + "\n" + worker_output + "\n" + Arbiter.VERDICT_REQUEST)
 
-    def ask_to_improve(self):
+    # The instructions of the last verdict, if the output can still be improved
+    def improvement_instructions(self):
         if self.grade <= 0 or self.grade >= 5:
             return ''
-
-        Config.verboseprint(f'\tPreparing refinement instructions')
-
-        self.conversation.send_message_str(
+        return self.instructions
+
+    VERDICT_REQUEST = """
+            Finish your answer with your verdict, as a JSON object in a ```json block:
+
+            ```json
+            {
+              "grade": <your grade, a number between 1 and 5>,
+              "summary": "<short (one to two phrases long) summary of why you grade it that way>",
+              "instructions": "<precise, actionable instructions that the worker should follow to improve or correct its output, or an empty string if the grade is 5>"
+            }
+            ```
             """
-            Provide precise, actionable instructions that the worker should follow
-            to improve or correct its output.
 
-            Print only these instructions.
-            """
-        )
-        return self.conversation.converse()
+    # number of answers read for a verdict, including the corrected ones
+    VERDICT_ATTEMPTS = 3
 
-    def get_grade(self):
-        self.conversation.send_message_str(
-            """
-            Print your grade. Print only the number between 1 and 5 without any explanation.
-            """
-        )
-        grade_str = self.conversation.converse()
-        grade_str, _, _ = grade_str.partition(' ')
-        while grade_str:
-            try:
-                self.grade = int(grade_str)
+    def reset_verdict(self):
+        self.grade = -1
+        self.summary = ''
+        self.instructions = ''
+
+    # Reads the verdict of the arbiter's answer `out`, and asks for a corrected one while
+    # it is not valid; returns the grade (-1 if there is no valid verdict)
+    async def read_verdict(self, out: str):
+        for attempt in range(Arbiter.VERDICT_ATTEMPTS):
+            errors = self.parse_verdict(out)
+            if errors == [] or attempt == Arbiter.VERDICT_ATTEMPTS - 1:
                 break
-            except:
-                grade_str = grade_str[:-1]
-        if self.grade >= 1 and self.grade <= 5:
-            Config.verboseprint(f'\tGrade: {self.grade}/5')
+            self.conversation.send_message_str(Arbiter.verdict_correction_request(errors))
+            out = await self.conversation.converse_async()
         return self.grade
 
+    # Sets the grade, summary and instructions of the verdict in `out`; returns what is wrong with it
+    def parse_verdict(self, out: str):
+        self.reset_verdict()
+        verdict, errors = Arbiter.verdict_of(out)
+        if errors != []:
+            Config.verboseprint(style.yellow(f'\tInvalid verdict: {"; ".join(errors)}'))
+            return errors
+        self.grade = verdict['grade']
+        self.summary = verdict['summary']
+        self.instructions = verdict['instructions']
+        Config.verboseprint(f'\tGrade: {self.grade}/5')
+        return []
+
+    # Returns the verdict in `out` (grade, summary and instructions), and the list of its errors
+    def verdict_of(out: str):
+        blocks = re.findall(r'```json\s*\n(.*?)```', out, re.DOTALL)
+        text = blocks[-1] if blocks != [] else out[out.find('{'):out.rfind('}') + 1]
+        try:
+            verdict = json.loads(text)
+        except ValueError:
+            return None, ['the verdict is not a valid JSON object']
+        if not isinstance(verdict, dict):
+            return None, ['the verdict is not a JSON object']
+
+        errors = []
+        grade = verdict.get('grade')
+        if isinstance(grade, str) and grade.strip().isdigit():
+            grade = int(grade)
+        if not isinstance(grade, int) or isinstance(grade, bool) or grade < 1 or grade > 5:
+            errors.append('"grade" must be a number between 1 and 5')
+        summary = verdict.get('summary')
+        if not isinstance(summary, str) or summary.strip() == '':
+            errors.append('"summary" must be a non-empty string')
+        instructions = verdict.get('instructions', '')
+        if isinstance(instructions, list) and all(isinstance(i, str) for i in instructions):
+            instructions = '\n'.join(instructions)
+        if not isinstance(instructions, str):
+            errors.append('"instructions" must be a string')
+        elif instructions.strip() == '' and isinstance(grade, int) and 1 <= grade < 5:
+            errors.append('"instructions" must not be empty if the grade is below 5')
+        if errors != []:
+            return None, errors
+        return {'grade': grade, 'summary': summary.strip(), 'instructions': instructions.strip()}, []
+
+    def verdict_correction_request(errors):
+        return """
+            Your verdict is not valid:
+            """ + "".join(f"\n            - {e}" for e in errors) + """
+
+            Please print only the corrected verdict, as a JSON object in a ```json block, with the
+            "grade", "summary" and "instructions" fields described above.
+            """
+
     def log_summary(self):
         if self.grade < 0:
             return
-        self.conversation.send_message_str(
-            """
-            Print short (one to two phrases long) summary of why you grade it that way.
-            """
-        )
-        Config.log(self.conversation.converse())
-
-    def try_to_compile(self):
-        Config.verboseprint(f'Trying to compile')
-
-        if Config.source_dir.startswith("https://"):
-            Config.verboseprint(style.yellow(
-                f'\tRemote source cannot be used for a compilation check, skipping'))
-            return True
-
-        r = subprocess.run(["which", "timeout"],
-                           check=False, capture_output=True)
-        if r.returncode != 0:
-            Config.verboseprint(style.yellow(
-                f'\tCannot find `timeout`, skipping'))
-            return True
-
-        r = subprocess.run(["timeout", "40", "scripts/run-kani.sh"],
-                           cwd=Config.source_dir,
-                           capture_output=True,
-                           text=True,
-                           check=False)
-        if not ("error: " in r.stdout or "error[" in r.stdout):
-            Config.verboseprint(f'\tLooks fine')
-            return True
-
+        Config.log(self.summary)
+
+    # Returns the outcome of the compilation check of the updated file `f` (see compile_check.py),
+    # in a worktree if the update is still in `generated_file`, and the compiler errors (see
+    # diagnostics.py); a summary of the errors is sent to the arbiter
+    @timed('compile')
+    async def try_to_compile(self, f: str, generated_file: str = ''):
+        # the compiler runs in a separate process anyway
+        status, output = await asyncio.to_thread(labelled(Arbiter.compile), f, generated_file)
+        if status != compile_check.FAILED:
+            return status, []
+
+        errors = diagnostics.errors(output)
         try:
-            self.conversation.send_message_str(
-                """
-                The annotated code does not compile! Please review the compilation messages below carefully.
-                You should ensure that the worker avoids repeating these or similar mistakes in the future.
-                Later, you may be asked to guide the worker in fixing these specific issues.
-
-                Rust compiler output:
-                """ + r.stdout
-            )
-            self.conversation.converse()
+            self.conversation.send_message_str(Arbiter.compilation_errors_message(errors, output))
+            await self.conversation.converse_async()
         except LongInputException:
             print(style.yellow("Way too faulty... Nevermind"))
 
-        return False
+        return status, errors
+
+    def compile(f: str, generated_file: str):
+        if generated_file != '':
+            return worktrees.check(f, generated_file)
+        return compile_check.check(f)
+
+    def compilation_errors_message(errors, output: str):
+        summary = diagnostics.summary(errors)
+        if summary == '':
+            # no error could be read, only the end of the output is sent
+            summary = output[-diagnostics.MAX_SUMMARY_CHARS:]
+        return """
+                The annotated code does not compile! Please review the compilation errors below carefully.
+                You should ensure that the worker avoids repeating these or similar mistakes in the future.
+                Later, you may be asked to guide the worker in fixing these specific issues.
+
+                Rust compiler errors:
+                """ + summary
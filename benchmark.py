@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import random
+import time
+
+import contractgen
+
+from configuration import Config
+from local_bedrock import LocalBedrock
+from metrics import metrics
+
+
+# Runs the whole pipeline against the local Bedrock stand-in (local_bedrock.py), without
+# network or credentials, and reports the throughput and the latency of each stage
+# (see metrics.py).
+
+
+# A fixed corpus of Rust files, with safe and unsafe functions in impls and at the top level
+def synthetic_corpus(directory: str, n: int, seed: int = 0):
+    rnd = random.Random(seed)
+    files = []
+    for i in range(n):
+        lines = [f'//! Synthetic module {i}', '', 'use crate::ptr;', '']
+        for s in range(rnd.randint(1, 4)):
+            lines += [f'pub struct S{s}<T> {{', '    ptr: *mut T,', '    len: usize,', '}', '',
+                      f'impl<T> S{s}<T> {{']
+            for k in range(rnd.randint(2, 12)):
+                if rnd.random() < 0.5:
+                    lines += ['    /// # Safety', f'    /// `i` must be less than `self.len`.',
+                              f'    pub unsafe fn get_{k}(&self, i: usize) -> &T {{',
+                              '        // SAFETY: the caller guarantees that i < len',
+                              '        unsafe { &*self.ptr.add(i) }', '    }', '']
+                else:
+                    lines += [f'    pub fn len_{k}(&self) -> usize {{', '        self.len', '    }', '']
+            lines += ['}', '']
+        for k in range(rnd.randint(0, 5)):
+            lines += ['/// # Safety', '/// `p` must be non-null.',
+                      f'pub unsafe fn read_{k}(p: *const u8) -> u8 {{',
+                      '    // SAFETY: p is non-null', '    unsafe { *p }', '}', '']
+        name = f'library/core/src/bench/mod_{i}.rs'
+        os.makedirs(os.path.dirname(directory + name), exist_ok=True)
+        with open(directory + name, 'w') as f:
+            f.write('\n'.join(lines))
+        files.append(name)
+    return files
+
+
+def main():
+    arg = argparse.ArgumentParser(description='Offline end-to-end benchmark of the annotation pipeline')
+    arg.add_argument('-c', '--config', type=str, default='',
+                     help='configuration file with the files to annotate (a local source_dir)')
+    arg.add_argument('-n', '--synthetic', type=int, default=12,
+                     help='number of synthetic files to annotate, if no configuration file is given')
+    arg.add_argument('-j', '--jobs', type=int, default=1, help='number of files annotated in parallel')
+    arg.add_argument('-A', '--async', dest='use_async', action='store_true', help='send the requests asynchronously')
+    arg.add_argument('-p', '--proof', action='store_true', help='generate harnesses')
+    arg.add_argument('--chunk-tokens', type=int, default=Config.chunk_tokens,
+                     help='annotate the files larger than this (estimated tokens) in chunks')
+    arg.add_argument('--chunk-jobs', type=int, default=1, help='number of chunks annotated in parallel')
+    arg.add_argument('--harness-batch', type=int, default=Config.harness_batch_size,
+                     help='number of functions whose harnesses are requested at once')
+    arg.add_argument('--harness-jobs', type=int, default=Config.harness_jobs,
+                     help='number of batches of harnesses requested in parallel')
+    arg.add_argument('--context-tokens', type=int, default=Config.context_tokens,
+                     help='estimated input tokens above which the oldest turns are removed (0 disables it)')
+    arg.add_argument('--context-policy', choices=['trim', 'summarize'], default=Config.context_policy,
+                     help='remove the oldest turns, or replace them with a summary')
+    arg.add_argument('--latency', type=float, default=0.5, help='seconds before the first token')
+    arg.add_argument('--token-latency', type=float, default=0.005, help='seconds per output token')
+    arg.add_argument('--throttle-rate', type=float, default=0.0, help='probability of throttling a request')
+    arg.add_argument('--error-rate', type=float, default=0.0, help='probability of a ServiceUnavailableException')
+    arg.add_argument('--max-concurrent', type=int, default=0, help='throttle above this number of requests in flight')
+    arg.add_argument('--rules', type=str, default='', help='JSON file with scripted responses')
+    arg.add_argument('--recorded', type=str, default='', help='response cache directory to replay')
+    args = arg.parse_args()
+
+    if args.config != '':
+        Config.init_from_file(args.config)
+        files = Config.files_to_annotate
+    else:
+        Config.source_dir = Config.target_dir + "bench/corpus/"
+        files = Config.normalize_files(synthetic_corpus(Config.source_dir, args.synthetic))
+    Config.target_dir = Config.target_dir + "bench/"
+    Config.jobs = max(1, args.jobs)
+    Config.use_async = args.use_async
+    Config.gen_harnesses = args.proof
+    Config.chunk_tokens = max(0, args.chunk_tokens)
+    Config.chunk_jobs = max(1, args.chunk_jobs)
+    Config.harness_batch_size = max(1, args.harness_batch)
+    Config.harness_jobs = max(1, args.harness_jobs)
+    Config.context_tokens = max(0, args.context_tokens)
+    Config.context_policy = args.context_policy
+    Config.update_source = False
+    # every run annotates the whole corpus again
+    Config.use_cache = False
+    Config.incremental = False
+    Config.resume = False
+    Config.verbose = False
+    Config.update_verboseprint()
+
+    server = LocalBedrock(port=0,
+                          latency=args.latency,
+                          token_latency=args.token_latency,
+                          throttle_rate=args.throttle_rate,
+                          error_rate=args.error_rate,
+                          max_concurrent=args.max_concurrent,
+                          rules_file=args.rules,
+                          recorded_dir=args.recorded).start()
+    Config.bedrock_endpoint = f'http://127.0.0.1:{server.port()}'
+    # the stand-in does not check the signatures
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'local')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'local')
+
+    start = time.monotonic()
+    results = contractgen.handle_files(files)
+    elapsed = time.monotonic() - start
+    server.shutdown()
+
+    contractgen.print_results(results)
+    print(f'\n{len(files)} files in {elapsed:.1f}s: {len(files) / elapsed * 60:.2f} files/minute')
+    print(f'{server.requests / max(1, len(files)):.1f} requests per file ({server.statistics()})')
+    print('\n' + metrics.summary(), end='')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+import hashlib
+import re
+
+import add_contracts
+from rust_syntax import function_name, items, scan, signature, struct_name, trim_pub, trim_unsafe
+
+# Splits large Rust source files into chunks that fit a token budget, along item
+# boundaries (impls, traits, modules, functions, ...). Blocks that are too large
+# (typically `impl` blocks) are split between their own items, and each piece is
+# wrapped into the header and the closing brace of the block, so that the worker
+# still knows which structure the functions belong to.
+
+# chunks without unsafe functions nor safety comments need no contracts
+RELEVANT = re.compile(r'\bunsafe\s+(extern\s+"[^"]*"\s+)?fn\b|SAFETY|# Safety')
+# attributes inserted by add_contracts.py, ignored by the hashes of the items
+CONTRACT_ATTRIBUTE = re.compile(r'\s*#\[(requires|ensures|safety::|cfg_attr\(kani)')
+
+
+def estimate_tokens(text: str):
+    return len(text) // 4
+
+
+# Splits the block in lines [start, end) at depth `level` into pieces of at most
+# `max_tokens` tokens (except for single items that are larger)
+def split_block(lines, depths, last_chars, start: int, end: int, level: int, max_tokens: int):
+    text = ''.join(lines[start:end])
+    if estimate_tokens(text) <= max_tokens:
+        return [text]
+
+    # the header ends with the line that opens the block
+    h = start
+    while h < end and depths[h + 1] <= level:
+        h += 1
+    # the block closes on its last line
+    if h >= end - 1 or depths[end - 1] <= level:
+        return [text]
+    header = ''.join(lines[start:h + 1])
+    footer = lines[end - 1] if lines[end - 1].endswith('\n') else lines[end - 1] + '\n'
+    budget = max_tokens - estimate_tokens(header + footer)
+
+    pieces = []
+    for (s, e) in items(lines, depths, last_chars, h + 1, end - 1, level + 1):
+        pieces += split_block(lines, depths, last_chars, s, e, level + 1, budget)
+    return [header + p + footer for p in pack(pieces, budget)]
+
+
+# Groups consecutive pieces into chunks of at most `max_tokens` tokens
+def pack(pieces, max_tokens: int):
+    res = []
+    current = ''
+    for p in pieces:
+        if current != '' and estimate_tokens(current + p) > max_tokens:
+            res.append(current)
+            current = ''
+        current += p if current == '' else '\n' + p
+    if current != '':
+        res.append(current)
+    return res
+
+
+# Returns the chunks of `source` that may need contracts, in the order of the file
+def split_into_chunks(source: str, max_tokens: int):
+    lines = source.splitlines(keepends=True)
+    depths, last_chars = scan(lines)
+    pieces = []
+    for (s, e) in items(lines, depths, last_chars, 0, len(lines), 0):
+        pieces += split_block(lines, depths, last_chars, s, e, 0, max_tokens)
+    return [c for c in pack(pieces, max_tokens) if RELEVANT.search(c)]
+
+
+def strip_fences(contracts: str):
+    if contracts.startswith("```rust\n"):
+        return contracts.split("```rust\n")[1].split("```")[0]
+    return contracts
+
+
+# A function or a type definition of a source file
+class Item:
+
+    def __init__(self, kind: str, key: str, text: str, path, start: int, end: int):
+        # 'fn' or 'type'
+        self.kind = kind
+        # `Struct::function` (`_None::function` outside of impls and traits), or the type name
+        self.key = key
+        self.text = text
+        # (header, closing line) of the enclosing blocks
+        self.path = path
+        # lines [start, end) of the item in the file, with its attributes and comments
+        self.start = start
+        self.end = end
+        self.hash = item_hash(text)
+
+
+def item_hash(text: str):
+    lines = [l.strip() for l in text.splitlines() if l.strip() != '' and not CONTRACT_ATTRIBUTE.match(l)]
+    return hashlib.sha256('\n'.join(lines).encode('utf-8')).hexdigest()
+
+
+# Returns the functions and type definitions of `source`, in the order of the file
+def index_items(source: str):
+    lines = source.splitlines(keepends=True)
+    depths, last_chars = scan(lines)
+    res = []
+
+    def visit(start: int, end: int, level: int, struct: str, path):
+        for (s, e) in items(lines, depths, last_chars, start, end, level):
+            sig = signature(lines, s, e)
+            l = trim_unsafe(trim_pub(lines[sig].strip()))
+            # the line that opens the block, if any
+            h = sig
+            while h < e and depths[h + 1] <= level:
+                h += 1
+            if re.match(r'(impl\b|trait |auto trait |mod )', l) and h < e - 1 and depths[e - 1] > level:
+                if l.startswith('mod '):
+                    name = struct
+                else:
+                    name = struct_name(' '.join(x.strip() for x in lines[sig:h + 1]))
+                footer = lines[e - 1] if lines[e - 1].endswith('\n') else lines[e - 1] + '\n'
+                visit(h + 1, e - 1, level + 1, name, path + ((''.join(lines[s:h + 1]), footer),))
+                continue
+            text = ''.join(lines[s:e])
+            fname = function_name(lines[sig].strip())
+            if re.search(r'\bfn\s', l) and re.fullmatch(r'\w+', fname):
+                res.append(Item('fn', f'{struct}::{fname}', text, path, s, e))
+                continue
+            m = re.match(r'(struct|enum|union)\s+(\w+)', l)
+            if m is not None:
+                res.append(Item('type', m.group(2), text, path, s, e))
+
+    visit(0, len(lines), 0, '_None', ())
+    return res
+
+
+# Returns source code with only the given items, within their enclosing blocks
+def excerpt(items_to_keep):
+    groups = []
+    for it in items_to_keep:
+        if groups != [] and groups[-1][0] == it.path:
+            groups[-1][1].append(it.text)
+        else:
+            groups.append((it.path, [it.text]))
+    res = []
+    for (path, texts) in groups:
+        res.append(''.join(h for (h, _) in path) + '\n'.join(texts) + ''.join(f for (_, f) in reversed(path)))
+    return '\n'.join(res)
+
+
+# Splits the worker's output into the contracts of each function (lists of groups,
+# by the key of `Item.key`) and the type invariants (lists of impls, by type name),
+# with the parser of add_contracts.py
+def parse_contracts(output: str):
+    out = strip_fences(output.strip()).split('\n')
+    contracts = {}
+    for (impl, _, fname, text) in add_contracts.parse_contracts(out):
+        contracts.setdefault(f'{impl}::{fname}', []).append(text)
+    invariants = {}
+    lines = '\n'.join(add_contracts.type_invariants(out)).strip().splitlines(keepends=True)
+    depths, last_chars = scan(lines)
+    for (s, e) in items(lines, depths, last_chars, 0, len(lines), 0):
+        name = struct_name(lines[signature(lines, s, e)].strip())
+        invariants.setdefault(name, []).append(''.join(lines[s:e]).strip())
+    return contracts, invariants
+
+
+# Splits a `verify` module into its harnesses, by name of the function they check
+def parse_harnesses(harnesses: str, header: str):
+    res = {}
+    if harnesses == '':
+        return res
+    lines = harnesses.removeprefix(header).strip().removesuffix('}').splitlines(keepends=True)
+    depths, last_chars = scan(lines)
+    for (s, e) in items(lines, depths, last_chars, 0, len(lines), 0):
+        text = ''.join(lines[s:e]).strip()
+        target = re.search(r'proof_for_contract\(\s*([\w:<>]+)', text)
+        name = target.group(1).split('::')[-1] if target is not None else ''
+        res.setdefault(name, []).append(text)
+    return res
@@ -0,0 +1,106 @@
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import time
+
+import style
+
+from configuration import Config
+import diagnostics
+
+# Checks that an updated source file still compiles. Only the crate of the file (e.g.,
+# `library/core`) is built, into a target directory that is kept between files and
+# runs, so that each check is an incremental rebuild of that crate. By default, the
+# crate is built by Kani (without verifying it), so that the contracts and harnesses
+# are compiled too.
+
+# cargo commands that are not provided by a `cargo-<command>` binary
+CARGO_COMMANDS = ['build', 'check', 'rustc', 'test', 'run', 'doc', 'bench']
+
+# outcomes of `check`
+OK = 'ok'
+FAILED = 'failed'
+TIMEOUT = 'timeout'
+SKIPPED = 'skipped'
+
+
+# Returns the crate (the directory under `library/`) of a file of the source directory
+def crate_of(f: str):
+    m = re.match(r'library/([\w-]+)/', f.removeprefix(Config.source_dir))
+    return m.group(1) if m is not None else None
+
+
+def build_dir():
+    return os.path.abspath(Config.target_dir + "build") + '/'
+
+
+# The compile command for `crate`, run in the `library` workspace of the source directory
+def command(crate: str, build: str):
+    return [arg.format(crate=crate, target_dir=build + crate)
+            for arg in shlex.split(Config.compile_command)]
+
+
+# Returns the outcome of the compilation of the crate of `f`, and the compiler output.
+# The crate is compiled in `root`, a copy of the source directory (see worktrees.py),
+# into a build directory under `build`.
+def check(f: str, root: str = '', build: str = ''):
+    root = root or Config.source_dir
+    build = build or build_dir()
+    Config.verboseprint(f'Trying to compile')
+
+    if Config.source_dir.startswith("https://"):
+        Config.verboseprint(style.yellow(
+            f'\tRemote source cannot be used for a compilation check, skipping'))
+        return SKIPPED, ''
+
+    crate = crate_of(f)
+    if crate is None:
+        Config.verboseprint(style.yellow(f'\tCannot find the crate of {f}, skipping'))
+        return SKIPPED, ''
+
+    cmd = command(crate, build)
+    missing = missing_command(cmd, root)
+    if missing is not None:
+        Config.verboseprint(style.yellow(f'\tCannot find `{missing}`, skipping'))
+        return SKIPPED, ''
+
+    start = time.monotonic()
+    try:
+        r = subprocess.run(cmd,
+                           cwd=root + "library",
+                           env=dict(os.environ, CARGO_INCREMENTAL="1"),
+                           capture_output=True,
+                           text=True,
+                           timeout=Config.compile_timeout,
+                           check=False)
+    except subprocess.TimeoutExpired as e:
+        Config.verboseprint(style.yellow(f'\tNo result after {Config.compile_timeout}s'))
+        Config.log(f'{f}: compilation of {crate} timed out after {Config.compile_timeout}s')
+        return TIMEOUT, output_of(e.stdout) + output_of(e.stderr)
+
+    elapsed = time.monotonic() - start
+    output = r.stdout + r.stderr
+    Config.log(f'{f}: compilation of {crate}: {elapsed:.1f}s')
+    # a command may fail without printing the errors of rustc
+    if r.returncode != 0 or diagnostics.failed(output):
+        return FAILED, output
+    Config.verboseprint(f'\tLooks fine ({elapsed:.1f}s)')
+    return OK, output
+
+
+# Returns the program of `cmd` (or its cargo subcommand) if it is not installed, or None
+def missing_command(cmd, root: str):
+    if shutil.which(cmd[0]) is None and not os.path.isfile(root + "library/" + cmd[0]):
+        return cmd[0]
+    if os.path.basename(cmd[0]) == 'cargo' and len(cmd) > 1 and not cmd[1].startswith('-') and \
+       cmd[1] not in CARGO_COMMANDS and shutil.which('cargo-' + cmd[1]) is None:
+        return f'cargo {cmd[1]}'
+    return None
+
+
+def output_of(out):
+    if out is None:
+        return ''
+    return out.decode('utf-8', errors='replace') if isinstance(out, bytes) else out
@@ -1,8 +1,11 @@
 import argparse
 import configparser
+import contextvars
 import io
 import logging
+import os
 import pathlib
+import re
 import sys
 
 import style
@@ -21,23 +24,105 @@ class Config:
     target_dir = "target/"
     # library source directory, can be local or remote
     source_dir = "https://raw.githubusercontent.com/model-checking/verify-rust-std/refs/heads/main/"
+    # download the remote source files at a fixed revision into `target_dir`/snapshots
+    snapshot = False
+    # number of files downloaded in parallel into a snapshot
+    snapshot_jobs = 16
     # indicates whether we should update the original source files
     update_source = False
     # indicates whether we should generate harnesses
     gen_harnesses = False
     # run Kani to verify that the annotations compile without errors
     try_compile = False
+    # command that builds the crate {crate} of an updated file into {target_dir}, run in `source_dir`/library;
+    # Kani's codegen builds the contracts and the `#[cfg(kani)]` harnesses too, which `cargo check`
+    # (a faster check, e.g., "cargo check --package {crate} --target-dir {target_dir} --message-format json") does not
+    compile_command = "cargo kani --only-codegen --package {crate} --target-dir {target_dir} -Z function-contracts -Z mem-predicates"
+    # seconds before a compilation check is reported as timed out
+    compile_timeout = 600
+    # number of compilation checks run at the same time, each in its own git worktree of `source_dir`
+    compile_jobs = 2
+    # run each generated harness with Kani, and ask the worker to correct those that fail
+    run_harnesses = False
+    # command that verifies the harness {harness} with Kani into {target_dir}, run in `source_dir`
+    verify_command = "kani verify-std -Z unstable-options ./library --target-dir {target_dir} -Z function-contracts -Z mem-predicates --harness {harness} --exact"
+    # seconds before a harness is reported as timed out
+    verify_timeout = 600
+    # number of harnesses of a file run at the same time
+    verify_jobs = os.cpu_count() or 1
     # generate type invarinats
     gen_type_invariants = True
     # worker region
     worker_region = "us-west-2"
     # arbiter region
     arbiter_region = "us-west-2"
+    # bedrock-runtime endpoint, e.g., of a local stand-in (see local_bedrock.py)
+    bedrock_endpoint = ""
+    # number of files annotated in parallel
+    jobs = 1
+    # converse with the models asynchronously, from a single event loop
+    use_async = False
+    # maximum number of async requests in flight per model and region
+    max_inflight = 16
+    # initial, minimum and maximum number of requests per second per model and region;
+    # with an initial rate of 0, requests are only paced after the first throttle
+    request_rate = 0.0
+    min_request_rate = 0.1
+    max_request_rate = 10.0
+    # increase of the request rate after each successful request
+    request_rate_step = 0.1
+    # base and cap of the exponential backoff after throttling (seconds)
+    backoff_base = 2.0
+    max_backoff = 240.0
+    # stream the responses that can be cut short, e.g., when only the first code block is needed
+    streaming = True
+    # let Bedrock cache the system prompt and the attached source file
+    prompt_caching = True
+    # reuse the model's responses to identical requests, stored in `target_dir`/cache
+    use_cache = True
+    # ignore the stored responses, but still store the new ones
+    refresh_cache = False
+    # maximum size (MB) and age (days) of the cached responses
+    cache_max_size = 512
+    cache_max_age = 30
+    # only send the functions that changed since the last run (see `target_dir`/manifest.json)
+    incremental = True
+    # skip the stages completed by the previous run (see `target_dir`/journal.sqlite)
+    resume = False
+    # files larger than this (estimated tokens) are annotated in chunks; 0 disables chunking
+    chunk_tokens = 40000
+    # number of chunks of a file annotated in parallel
+    chunk_jobs = 1
+    # number of functions whose harnesses are requested at once; 1 sends one request per function
+    harness_batch_size = 8
+    # number of batches of harnesses requested in parallel, each in its own branch of the conversation
+    harness_jobs = 4
+    # estimated input tokens above which the oldest turns of a conversation are removed; 0 disables it
+    context_tokens = 150000
+    # the conversation is then shrunk to this fraction of `context_tokens`
+    context_target = 0.75
+    # "trim" removes the oldest turns, "summarize" replaces them with a summary written by the model
+    context_policy = "trim"
+    # tokens (input, output and cache) and cost (USD) of the whole run; 0 means unlimited
+    token_budget = 0
+    cost_budget = 0.0
+    # tokens after which the refinement of a file stops; 0 means unlimited
+    file_token_cap = 0
+    # the refinement of a file stops after a round that improved the grade by less than this, per 1000 tokens
+    min_gain_per_ktokens = 0.0
+    # USD per million input, output, cache read and cache write tokens
+    token_prices = [3.0, 15.0, 0.3, 3.75]
+    # sample the stacks of the threads, and write a profile of each file into `target_dir`/profiles
+    profile = False
+    # seconds between two samples of the profiler
+    profile_interval = 0.01
     # verbose mode
     verbose = False
 
     logger = logging.getLogger(__name__)
     verboseprint = print if verbose else lambda *a, **k: None
+    # the file handled by the current thread (or asyncio task)
+    current_file_var = contextvars.ContextVar('current_file', default='')
 
     def __init__(self,
                  files_to_annotate: str = "",
@@ -46,10 +131,21 @@ class Config:
                  prompt_dir: str = "",
                  target_dir: str = "",
                  source_dir: str = "",
+                 snapshot = None,
                  update_source = None,
                  gen_harnesses = None,
                  gen_type_invariants = None,
                  try_compile = None,
+                 run_harnesses = None,
+                 jobs = None,
+                 use_async = None,
+                 use_cache = None,
+                 refresh_cache = None,
+                 incremental = None,
+                 resume = None,
+                 profile = None,
+                 token_budget = None,
+                 cost_budget = None,
                  verbose = None,
                  config_filename: str = ""):
         if config_filename != "":
@@ -66,6 +162,8 @@ class Config:
             Config.source_dir = Config.normalize_dir(target_dir)
         if source_dir != "":
             Config.source_dir = Config.normalize_dir(source_dir)
+        if snapshot is not None:
+            Config.snapshot = snapshot
         if update_source is not None:
             Config.update_source = update_source
         if gen_harnesses is not None:
@@ -74,10 +172,30 @@ class Config:
             Config.gen_type_invariants = gen_type_invariants
         if try_compile is not None:
             Config.try_compile = try_compile
+        if run_harnesses is not None:
+            Config.run_harnesses = run_harnesses
+        if jobs is not None:
+            Config.jobs = max(1, jobs)
+        if use_async is not None:
+            Config.use_async = use_async
+        if use_cache is not None:
+            Config.use_cache = use_cache
+        if refresh_cache is not None:
+            Config.refresh_cache = refresh_cache
+        if incremental is not None:
+            Config.incremental = incremental
+        if resume is not None:
+            Config.resume = resume
+        if profile is not None:
+            Config.profile = profile
+        if token_budget is not None:
+            Config.token_budget = max(0, token_budget)
+        if cost_budget is not None:
+            Config.cost_budget = max(0.0, cost_budget)
         if verbose is not None:
             Config.verbose = verbose
         Config.files_to_annotate = Config.normalize_files(Config.files_to_annotate)
-        Config.verboseprint = print if Config.verbose else lambda *a, **k: None
+        Config.update_verboseprint()
         logging.basicConfig(filename='logger.log', level=logging.INFO)
 
     def init_from_arguments():
@@ -97,6 +215,9 @@ class Config:
         arg.add_argument('-t', '--target', type=str, required=False,
                          default='',
                          help='the target directory of the output files')
+        arg.add_argument('--snapshot', action='store_true', required=False,
+                         default=None,
+                         help='download the remote source files at a fixed revision first')
         arg.add_argument('-u', '--update', action='store_true', required=False,
                          default=None,
                          help='update the original source files')
@@ -106,6 +227,36 @@ class Config:
         arg.add_argument('-k', '--kani', action='store_true', required=False,
                          default=None,
                          help='run Kani just to verify that the annotations compile without errors')
+        arg.add_argument('--run-harnesses', action='store_true', required=False,
+                         default=None,
+                         help='run the generated harnesses with Kani and keep those that are verified')
+        arg.add_argument('-j', '--jobs', type=int, required=False,
+                         default=None,
+                         help='number of files annotated in parallel')
+        arg.add_argument('-A', '--async', dest='use_async', action='store_true', required=False,
+                         default=None,
+                         help='converse with the models asynchronously')
+        arg.add_argument('--no-cache', dest='use_cache', action='store_false', required=False,
+                         default=None,
+                         help='do not use the cache of model responses')
+        arg.add_argument('--refresh-cache', action='store_true', required=False,
+                         default=None,
+                         help='ignore the cached model responses and store the new ones')
+        arg.add_argument('--no-incremental', dest='incremental', action='store_false', required=False,
+                         default=None,
+                         help='annotate the whole files, even the functions that did not change')
+        arg.add_argument('--resume', action='store_true', required=False,
+                         default=None,
+                         help='continue the previous run, skipping the stages it completed')
+        arg.add_argument('--profile', action='store_true', required=False,
+                         default=None,
+                         help='profile the run, and write the stacks of each file in the flamegraph format')
+        arg.add_argument('--token-budget', type=int, required=False,
+                         default=None,
+                         help='maximum number of tokens of the run')
+        arg.add_argument('--cost-budget', type=float, required=False,
+                         default=None,
+                         help='maximum cost of the run (USD)')
         arg.add_argument('-v', '--verbose', action='store_true', required=False,
                          default=None,
                          help='verbose mode')
@@ -119,13 +270,24 @@ class Config:
             arbiter_model = args.amodel,
             source_dir = args.source,
             target_dir = args.target,
+            snapshot = args.snapshot,
             update_source = args.update,
             gen_harnesses = args.proof,
             try_compile = args.kani,
+            run_harnesses = args.run_harnesses,
+            jobs = args.jobs,
+            use_async = args.use_async,
+            use_cache = args.use_cache,
+            refresh_cache = args.refresh_cache,
+            incremental = args.incremental,
+            resume = args.resume,
+            profile = args.profile,
+            token_budget = args.token_budget,
+            cost_budget = args.cost_budget,
             verbose = args.verbose,
             config_filename = args.config
         )
-        Config.verboseprint = print if Config.verbose else lambda *a, **k: None
+        Config.update_verboseprint()
 
 
     def init_from_file(config_filename: str):
@@ -145,6 +307,10 @@ class Config:
                     Config.target_dir = Config.normalize_dir(conf["config"]["target_dir"])
                 if "source_dir" in conf["config"]:
                     Config.source_dir = Config.normalize_dir(conf["config"]["source_dir"])
+                if "snapshot" in conf["config"]:
+                    Config.snapshot = conf["config"]["snapshot"].lower() == "true"
+                if "snapshot_jobs" in conf["config"]:
+                    Config.snapshot_jobs = max(1, int(conf["config"]["snapshot_jobs"]))
                 if "update_source" in conf["config"]:
                     Config.update_source = conf["config"]["update_source"].lower() == "true"
                 if "gen_harnesses" in conf["config"]:
@@ -153,14 +319,100 @@ class Config:
                     Config.gen_type_invariants = conf["config"]["gen_type_invariants"].lower() == "true"
                 if "try_compile" in conf["config"]:
                     Config.try_compile = conf["config"]["try_compile"].lower() == "true"
+                if "compile_command" in conf["config"]:
+                    Config.compile_command = conf["config"]["compile_command"]
+                if "compile_timeout" in conf["config"]:
+                    Config.compile_timeout = max(1.0, float(conf["config"]["compile_timeout"]))
+                if "compile_jobs" in conf["config"]:
+                    Config.compile_jobs = max(1, int(conf["config"]["compile_jobs"]))
+                if "run_harnesses" in conf["config"]:
+                    Config.run_harnesses = conf["config"]["run_harnesses"].lower() == "true"
+                if "verify_command" in conf["config"]:
+                    Config.verify_command = conf["config"]["verify_command"]
+                if "verify_timeout" in conf["config"]:
+                    Config.verify_timeout = max(1.0, float(conf["config"]["verify_timeout"]))
+                if "verify_jobs" in conf["config"]:
+                    Config.verify_jobs = max(1, int(conf["config"]["verify_jobs"]))
                 if "worker_region" in conf["config"]:
                     Config.worker_region = conf["config"]["worker_region"]
                 if "arbiter_region" in conf["config"]:
                     Config.arbiter_region = conf["config"]["arbiter_region"]
+                if "bedrock_endpoint" in conf["config"]:
+                    Config.bedrock_endpoint = conf["config"]["bedrock_endpoint"]
+                if "jobs" in conf["config"]:
+                    Config.jobs = max(1, int(conf["config"]["jobs"]))
+                if "use_async" in conf["config"]:
+                    Config.use_async = conf["config"]["use_async"].lower() == "true"
+                if "max_inflight" in conf["config"]:
+                    Config.max_inflight = max(1, int(conf["config"]["max_inflight"]))
+                if "streaming" in conf["config"]:
+                    Config.streaming = conf["config"]["streaming"].lower() == "true"
+                if "prompt_caching" in conf["config"]:
+                    Config.prompt_caching = conf["config"]["prompt_caching"].lower() == "true"
+                if "use_cache" in conf["config"]:
+                    Config.use_cache = conf["config"]["use_cache"].lower() == "true"
+                if "refresh_cache" in conf["config"]:
+                    Config.refresh_cache = conf["config"]["refresh_cache"].lower() == "true"
+                if "cache_max_size" in conf["config"]:
+                    Config.cache_max_size = float(conf["config"]["cache_max_size"])
+                if "cache_max_age" in conf["config"]:
+                    Config.cache_max_age = float(conf["config"]["cache_max_age"])
+                if "incremental" in conf["config"]:
+                    Config.incremental = conf["config"]["incremental"].lower() == "true"
+                if "resume" in conf["config"]:
+                    Config.resume = conf["config"]["resume"].lower() == "true"
+                if "chunk_tokens" in conf["config"]:
+                    Config.chunk_tokens = max(0, int(conf["config"]["chunk_tokens"]))
+                if "chunk_jobs" in conf["config"]:
+                    Config.chunk_jobs = max(1, int(conf["config"]["chunk_jobs"]))
+                if "harness_batch_size" in conf["config"]:
+                    Config.harness_batch_size = max(1, int(conf["config"]["harness_batch_size"]))
+                if "harness_jobs" in conf["config"]:
+                    Config.harness_jobs = max(1, int(conf["config"]["harness_jobs"]))
+                if "context_tokens" in conf["config"]:
+                    Config.context_tokens = max(0, int(conf["config"]["context_tokens"]))
+                if "context_target" in conf["config"]:
+                    Config.context_target = min(1.0, max(0.1, float(conf["config"]["context_target"])))
+                if "context_policy" in conf["config"]:
+                    policy = conf["config"]["context_policy"].strip().lower()
+                    if policy in ["trim", "summarize"]:
+                        Config.context_policy = policy
+                    else:
+                        print(style.yellow(f'Unknown context policy "{policy}", using "{Config.context_policy}"'))
+                if "request_rate" in conf["config"]:
+                    Config.request_rate = float(conf["config"]["request_rate"])
+                if "min_request_rate" in conf["config"]:
+                    Config.min_request_rate = float(conf["config"]["min_request_rate"])
+                if "max_request_rate" in conf["config"]:
+                    Config.max_request_rate = float(conf["config"]["max_request_rate"])
+                if "request_rate_step" in conf["config"]:
+                    Config.request_rate_step = float(conf["config"]["request_rate_step"])
+                if "backoff_base" in conf["config"]:
+                    Config.backoff_base = float(conf["config"]["backoff_base"])
+                if "max_backoff" in conf["config"]:
+                    Config.max_backoff = float(conf["config"]["max_backoff"])
+                if "token_budget" in conf["config"]:
+                    Config.token_budget = max(0, int(conf["config"]["token_budget"]))
+                if "cost_budget" in conf["config"]:
+                    Config.cost_budget = max(0.0, float(conf["config"]["cost_budget"]))
+                if "file_token_cap" in conf["config"]:
+                    Config.file_token_cap = max(0, int(conf["config"]["file_token_cap"]))
+                if "min_gain_per_ktokens" in conf["config"]:
+                    Config.min_gain_per_ktokens = max(0.0, float(conf["config"]["min_gain_per_ktokens"]))
+                if "token_prices" in conf["config"]:
+                    prices = [float(p) for p in conf["config"]["token_prices"].split(',')]
+                    if len(prices) == 4:
+                        Config.token_prices = prices
+                    else:
+                        print(style.yellow(f'token_prices needs 4 prices, using {Config.token_prices}'))
+                if "profile" in conf["config"]:
+                    Config.profile = conf["config"]["profile"].lower() == "true"
+                if "profile_interval" in conf["config"]:
+                    Config.profile_interval = max(0.001, float(conf["config"]["profile_interval"]))
                 if "verbose" in conf["config"]:
                     Config.verbose = conf["config"]["verbose"].lower() == "true"
                 Config.files_to_annotate = Config.normalize_files(Config.files_to_annotate)
-                Config.verboseprint = print if Config.verbose else lambda *a, **k: None
+                Config.update_verboseprint()
         except FileNotFoundError:
             print(style.red(f'Cannot find configuration file "{config_filename}"'))
             sys.exit(1)
@@ -171,6 +423,8 @@ class Config:
         print(f'Arbiter model: {Config.arbiter_model}')
         print(f'Worker region: {Config.worker_region}')
         print(f'Arbiter region {Config.arbiter_region}')
+        if Config.bedrock_endpoint != "":
+            print(f'Bedrock endpoint: {Config.bedrock_endpoint}')
         print('Files to annotate:')
         if len(Config.files_to_annotate) == 0:
             print('  []')
@@ -180,17 +434,75 @@ class Config:
         print(f'Prompt dir: {Config.prompt_dir}')
         print(f'Target dir: {Config.target_dir}')
         print(f'Source dir: {Config.source_dir}')
+        print(f'Snapshot: {Config.snapshot}')
         print(f'Update source: {Config.update_source}')
         print(f'Generate harnesses: {Config.gen_harnesses}')
         print(f'Generate type invariants: {Config.gen_type_invariants}')
         print(f'Try to run Kani: {Config.try_compile}')
+        if Config.try_compile:
+            print(f'Compile command: {Config.compile_command} (timeout: {Config.compile_timeout}s)')
+            print(f'Parallel compilation checks: {Config.compile_jobs}')
+        print(f'Run harnesses: {Config.run_harnesses}')
+        if Config.run_harnesses:
+            print(f'Verify command: {Config.verify_command} (timeout: {Config.verify_timeout}s)')
+            print(f'Parallel harnesses: {Config.verify_jobs}')
+        print(f'Parallel jobs: {Config.jobs}')
+        print(f'Async mode: {Config.use_async}')
+        print(f'Max requests in flight: {Config.max_inflight}')
+        print(f'Request rate: {Config.request_rate or "unpaced until throttled"} ({Config.min_request_rate}-{Config.max_request_rate}) requests/s')
+        print(f'Max backoff: {Config.max_backoff}s')
+        print(f'Streaming: {Config.streaming}')
+        print(f'Prompt caching: {Config.prompt_caching}')
+        print(f'Use response cache: {Config.use_cache}')
+        print(f'Refresh response cache: {Config.refresh_cache}')
+        print(f'Incremental: {Config.incremental}')
+        print(f'Resume: {Config.resume}')
+        print(f'Chunk size: {Config.chunk_tokens} tokens' if Config.chunk_tokens > 0 else 'Chunk size: no chunking')
+        print(f'Parallel chunks: {Config.chunk_jobs}')
+        print(f'Harness batch size: {Config.harness_batch_size}')
+        print(f'Parallel harness batches: {Config.harness_jobs}')
+        print(f'Context window: {Config.context_tokens} tokens ({Config.context_policy})'
+              if Config.context_tokens > 0 else 'Context window: unmanaged')
+        print(f'Token budget: {Config.token_budget or "unlimited"}')
+        print(f'Cost budget: ' + (f'${Config.cost_budget:.2f}' if Config.cost_budget > 0 else 'unlimited'))
+        print(f'Token cap per file: {Config.file_token_cap or "unlimited"}')
+        print(f'Minimum grade gain per 1000 tokens: {Config.min_gain_per_ktokens}')
+        print(f'Token prices (USD per million input, output, cache read, cache write): {Config.token_prices}')
+        print(f'Profile: {Config.profile}' + (f' (every {Config.profile_interval}s)' if Config.profile else ''))
         print(f'Verbose mode: {Config.verbose}')
         out = output.getvalue()
         output.close()
         return out
 
     def log(msg: str):
-        Config.logger.info(msg)
+        Config.logger.info(Config.current_tag() + msg)
+
+    def update_verboseprint():
+        Config.verboseprint = Config.tagged_print if Config.verbose else lambda *a, **k: None
+
+    # In parallel mode, prefix the output with the file handled by the current thread or task
+    def tagged_print(*args, **kwargs):
+        tag = Config.current_tag()
+        if tag == '':
+            print(*args, **kwargs)
+            return
+        msg = kwargs.pop('sep', ' ').join(str(a) for a in args)
+        # drop leading empty lines (possibly preceded by a color code)
+        msg = re.sub(r'^((?:\x1b\[[0-9;]*m)*)\n+', r'\1', msg)
+        # a single write, so that lines of parallel jobs do not interleave
+        print(tag + msg + kwargs.pop('end', '\n'), end='', **kwargs)
+
+    def set_current_file(f: str):
+        Config.current_file_var.set(f)
+
+    def current_file():
+        return Config.current_file_var.get()
+
+    def current_tag():
+        f = Config.current_file()
+        if Config.jobs <= 1 or f == '':
+            return ''
+        return f'[{f.removeprefix(Config.source_dir)}] '
 
     def normalize_dir(dirname: str):
         if not dirname.endswith('/'):
@@ -1,21 +1,40 @@
 #!/usr/bin/env python3
 
+import asyncio
 import datetime
+import json
 import os
 import shutil
 import subprocess
 import sys
-import urllib
 
-from conversation import LongInputException
+from chunker import estimate_tokens, split_into_chunks
+import compile_check
+import harness_runner
+from conversation import LongInputException, async_bedrock
+from journal import journal
+from manifest import manifest
+from metrics import labelled, metrics
+from profiler import profiler
+from rate_limiter import throttling_report
+from response_cache import response_cache
+from scheduler import Rounds, scheduler
+from snapshot import take_snapshot
+from sources import sources
+from worktrees import worktrees
 import style
 
-from urllib.request import urlopen
+from concurrent.futures import ThreadPoolExecutor
 
 from arbiter import Arbiter
 from configuration import Config
 from worker import Worker
 
+# the original sources (and Kani runs on them) are shared by all parallel jobs
+source_lock = asyncio.Lock()
+# number of times the contracts that do not compile are dropped before the file is rejected
+ROLLBACK_ATTEMPTS = 2
+
 
 def is_annotated_already(file_to_annotate: str):
    # TODO: some functions may be annotated, while others may not.
@@ -29,109 +48,506 @@ def is_remote(file_to_annotate: str):
 
 
 def file_exists(file_to_annotate: str):
-    try:
-        if is_remote(file_to_annotate):
-            urlopen(file_to_annotate).read()
-            return True
-        return os.path.isfile(file_to_annotate)
-    except urllib.error.HTTPError:
-        return False
-
-def handle_file(worker, arbiter, f: str):
-    if not file_exists(f):
+    if is_remote(file_to_annotate):
+        # the content is kept for `Worker.read_source_file`
+        return sources.exists(file_to_annotate)
+    return os.path.isfile(file_to_annotate)
+
+
+# Returns a short description of the outcome. The steps of the pipeline are coroutines,
+# run in a single event loop with either transport (see `conversation.new_conversation`).
+async def handle_file(worker, arbiter, f: str):
+    if not await asyncio.to_thread(labelled(file_exists), f):
         Config.verboseprint(style.yellow(f'\nFile {f.removesuffix('\n')} not found. Skipping'))
-        return
+        return 'not found'
     # TODO: make this skip optional
     # if not is_remote(f) and is_annotated_already(f):
     #     Config.verboseprint(style.yellow(
     #         f'\nFile {f.removesuffix('\n')} is already annotated. Skipping'))
     #     return
 
-    worker.set_file_to_annotate(f)
-    worker.generate_contracts()
-    contracts = worker.autorefine_contracts()
+    await asyncio.to_thread(labelled(worker.set_file_to_annotate), f)
+    job = journal.job(worker.file_id, worker.source_code)
+    done = job.done()
+    if done is not None:
+        Config.verboseprint(style.yellow(f'\n{f} was completed by the previous run. Skipping'))
+        return done
+    if not scheduler.admit(f, worker.source_code):
+        Config.verboseprint(style.yellow(f'\n{f} does not fit in the budget. Skipping'))
+        return 'over budget'
+    try:
+        return job.finish(await run_stages(worker, arbiter, f, job))
+    finally:
+        scheduler.finish(f)
+
 
-    grade = arbiter.assess_worker(Config.target_dir + worker.file_id + ".rs", contracts)
+# The stages of `handle_file`, recorded in the journal (see journal.py)
+async def run_stages(worker, arbiter, f: str, job):
+    plan = await asyncio.to_thread(labelled(manifest.plan), worker.file_id, worker.source_code)
+    if plan.incremental():
+        return await handle_file_in_chunks(worker, arbiter, f, plan, plan.excerpt(), Config.chunk_tokens)
+    if needs_chunking(worker.source_code):
+        return await handle_file_in_chunks(worker, arbiter, f, plan, worker.source_code, Config.chunk_tokens)
+
+    contracts = job.accepted('contracts')
+    if contracts is not None:
+        grade = contracts[0]
+        worker.resume_contracts(contracts[1])
+        arbiter.resume_assessment(Config.target_dir + worker.file_id + ".rs", contracts[1], grade)
+    else:
+        try:
+            grade = await annotate_contracts(worker, arbiter, f)
+        except LongInputException:
+            if Config.chunk_tokens == 0:
+                raise
+            Config.verboseprint(style.yellow(f'The input is too long. Annotating {f} in smaller chunks'))
+            return await handle_file_in_chunks(worker, arbiter, f, plan, worker.source_code,
+                                               fallback_chunk_tokens(worker.source_code))
+        job.record('contracts', grade, worker.generated_contracts)
+    if grade < 4:
+        Config.verboseprint(style.yellow(f'The annotation is not good enough. Skipping the rest'))
+        return f'low grade ({grade}/5)'
+    # TODO: Save contracts with the highest grade
+    worker.save_generated_contracts()
+
+    harnesses = ''
+    if Config.gen_harnesses:
+        await resume_or_annotate_harnesses(worker, arbiter, f, job)
+        # Save only excellent harnesses
+        if worker.harnesses_grade == 5:
+            worker.save_generated_harnesses()
+            harnesses = worker.generated_harnesses
+
+    plan.resolve([(worker.source_code, worker.generated_contracts, harnesses, True)], Worker.HARNESSES_HEADER)
+    return record(plan, await update_source_file(worker, arbiter, f, grade, plan), grade)
+
+
+def needs_chunking(source_code: str):
+    return Config.chunk_tokens > 0 and estimate_tokens(source_code) > Config.chunk_tokens
+
+
+# The conversation about a file below `chunk_tokens` may still grow too long
+def fallback_chunk_tokens(source_code: str):
+    return min(Config.chunk_tokens, estimate_tokens(source_code) // 2)
+
+
+# Keeps the contracts of the files that were annotated successfully in the manifest
+def record(plan, res: str, grade: int):
+    if res.startswith('annotated'):
+        manifest.record(plan, grade)
+    return res
+
+
+# Generates and refines the contracts of the worker's file; returns the final grade
+async def annotate_contracts(worker, arbiter, f: str):
+    await worker.generate_contracts()
+    contracts = await worker.autorefine_contracts()
+
+    grade = await arbiter.assess_worker(Config.target_dir + worker.file_id + ".rs", contracts)
     Config.log(f'{f}: initial grade: {grade}/5')
     arbiter.log_summary()
 
+    rounds = Rounds(f, grade, worker.conversation, arbiter.conversation)
     max_try = 3
     while max_try > 0:
-        improvements = arbiter.ask_to_improve()
-        if improvements == '':
+        improvements = arbiter.improvement_instructions()
+        if improvements == '' or not rounds.worth_another(grade):
             break
-        worker.refine_contracts(improvements)
-        contracts = worker.autorefine_contracts()
-        grade = arbiter.reassess_worker(contracts)
+        await worker.refine_contracts(improvements)
+        contracts = await worker.autorefine_contracts()
+        grade = await arbiter.reassess_worker(contracts)
         max_try -= 1
 
     Config.log(f'{f}: final grade: {grade}/5')
     Config.log(f'{f}: number of refinement rounds: {4 - max_try}')
     arbiter.log_summary()
     worker.log_summary()
+    return grade
 
-    if grade < 4:
-        Config.verboseprint(style.yellow(f'The annotation is not good enough. Skipping the rest'))
+
+async def resume_or_annotate_harnesses(worker, arbiter, f: str, job):
+    harnesses = job.resumed('harnesses')
+    if harnesses is not None:
+        worker.harnesses_grade, worker.generated_harnesses = harnesses
         return
-    # TODO: Save contracts with the highest grade
-    worker.save_generated_contracts()
+    await annotate_harnesses(worker, arbiter, f)
+    job.record('harnesses', worker.harnesses_grade, worker.generated_harnesses)
 
-    if Config.gen_harnesses:
-        harnesses = worker.generate_harnesses()
-        if harnesses != '':
-            grade = arbiter.assess_harnesses(harnesses)
-            Config.log(f'{f}: initial grade (harnesses): {grade}/5')
-            arbiter.log_summary()
-            if grade < 5:
-                improvements = arbiter.ask_to_improve()
-                if improvements != '':
-                    harnesses = worker.refine_harnesses(improvements)
-                    grade = arbiter.reassess_worker(harnesses)
-            Config.log(f'{f}: final grade (harnesses): {grade}/5')
-            arbiter.log_summary()
-            # Save only excellent harnesses
-            if grade == 5:
-                worker.save_generated_harnesses()
+
+# Generates and refines the harnesses; their grade is kept in `worker.harnesses_grade`
+async def annotate_harnesses(worker, arbiter, f: str):
+    worker.harnesses_grade = 0
+    if scheduler.exhausted(f):
+        return
+    harnesses = await worker.generate_harnesses()
+    if harnesses == '':
+        Config.log(f'{f}: no harnesses to generate')
+        return
+    annotated_file = Config.target_dir + worker.file_id + "_annotated.rs"
+    if harness_runner.available(f, annotated_file):
+        await verify_harnesses(worker, f, annotated_file)
+        return
+    grade = await arbiter.assess_harnesses(harnesses)
+    Config.log(f'{f}: initial grade (harnesses): {grade}/5')
+    arbiter.log_summary()
+    if grade < 5 and not scheduler.exhausted(f):
+        improvements = arbiter.improvement_instructions()
+        if improvements != '':
+            await worker.refine_harnesses(improvements)
+            grade = await arbiter.reassess_worker(worker.generated_harnesses)
+    Config.log(f'{f}: final grade (harnesses): {grade}/5')
+    arbiter.log_summary()
+    worker.harnesses_grade = grade
+
+
+# Runs the harnesses with Kani instead of having them graded by the arbiter; those that
+# are not verified are sent back to the worker once, and only the verified ones are kept
+async def verify_harnesses(worker, f: str, annotated_file: str):
+    results = await asyncio.to_thread(labelled(harness_runner.run), f, annotated_file, worker.generated_harnesses,
+                                      Worker.HARNESSES_HEADER)
+    Config.log(f'{f}: harnesses: {harness_runner.summary(results)}')
+    if any(r['status'] != harness_runner.VERIFIED for r in results) and not scheduler.exhausted(f):
+        harnesses = worker.generated_harnesses
+        if await worker.refine_harnesses(harness_runner.failure_report(results)) != '':
+            results = await asyncio.to_thread(labelled(harness_runner.run), f, annotated_file, worker.generated_harnesses,
+                                              Worker.HARNESSES_HEADER)
+            Config.log(f'{f}: corrected harnesses: {harness_runner.summary(results)}')
         else:
-            Config.log(f'{f}: no harnesses to generate')
+            worker.generated_harnesses = harnesses
+    keep_verified_harnesses(worker, f, results)
 
+
+def keep_verified_harnesses(worker, f: str, results):
+    worker.generated_harnesses = harness_runner.verified_module(worker.generated_harnesses,
+                                                                Worker.HARNESSES_HEADER, results)
+    worker.harnesses_grade = 5 if worker.generated_harnesses != '' else 0
+    if worker.harnesses_grade < 5:
+        Config.verboseprint(style.yellow(f'\tNo harness could be verified'))
+    Config.log(f'{f}: final grade (harnesses): {worker.harnesses_grade}/5')
+
+
+async def update_source_file(worker, arbiter, f: str, grade: int, plan):
     generated_file = Config.target_dir + worker.file_id + "_annotated.rs"
+    dropped = []
     if not is_remote(f) and Config.update_source and os.path.isfile(generated_file):
-        Config.verboseprint("Replacing the original file", f)
-        shutil.copyfile(generated_file, f)
+        if Config.try_compile and worktrees.available():
+            # compiled in a worktree, the original file is only replaced if it compiles
+            status, dropped = await compile_annotated_file(worker, arbiter, f, plan, False)
+            res = failed_compilation(status)
+            if res is not None:
+                Config.verboseprint(style.yellow(f'{res.capitalize()}. Keeping the original file'))
+                Config.log(f'{f}: {res}')
+                return res
+            async with source_lock:
+                Config.verboseprint("Replacing the original file", f)
+                shutil.copyfile(generated_file, f)
+                worktrees.promote(f)
+        else:
+            async with source_lock:
+                Config.verboseprint("Replacing the original file", f)
+                shutil.copyfile(generated_file, f)
+
+                if Config.try_compile:
+                    status, dropped = await compile_annotated_file(worker, arbiter, f, plan, True)
+                    res = failed_compilation(status)
+                    if res is not None:
+                        revert_source_file(f, res)
+                        return res
+
+    return annotated(grade, dropped)
+
+
+# Compiles the annotated file (see `Arbiter.try_to_compile`), in place of `f` if `in_place`.
+# The contracts and harnesses that the errors point at are dropped, and the file is
+# compiled again, up to ROLLBACK_ATTEMPTS times. Returns the outcome of the last check,
+# and the dropped items.
+async def compile_annotated_file(worker, arbiter, f: str, plan, in_place: bool):
+    generated_file = Config.target_dir + worker.file_id + "_annotated.rs"
+    dropped = []
+    for attempt in range(ROLLBACK_ATTEMPTS + 1):
+        status, errors = await arbiter.try_to_compile(f, '' if in_place else generated_file)
+        if status != compile_check.FAILED or attempt == ROLLBACK_ATTEMPTS:
+            break
+        items = roll_back(worker, f, plan, errors)
+        if items is None:
+            break
+        dropped += items
+        if in_place:
+            shutil.copyfile(generated_file, f)
+    return status, dropped
+
+
+# Drops the contracts and harnesses that the compiler errors point at from `plan`, and
+# annotates the file again without them. Returns the dropped items, or None if some
+# errors are elsewhere (e.g., in the inserted `use` declarations, or in another file).
+def roll_back(worker, f: str, plan, errors):
+    if errors == [] or not all(e.is_in(f) and e.line > 0 for e in errors):
+        return None
+    with open(Config.target_dir + worker.file_id + "_annotated.rs", 'r') as file:
+        items = plan.reject_items_at(file.read(), [e.line - 1 for e in errors])
+    if items is None or plan.contracts() == '':
+        return None
+    Config.verboseprint(style.yellow(f'\tCompilation errors in {", ".join(items)}. Dropping them'))
+    Config.log(f'{f}: dropped after compilation errors: {", ".join(items)}')
+    worker.copy_source_file()
+    worker.generated_contracts = plan.contracts()
+    worker.save_generated_contracts()
+    if Config.gen_harnesses:
+        worker.generated_harnesses = plan.harnesses(Worker.HARNESSES_HEADER)
+        worker.save_generated_harnesses()
+    return items
+
+
+def annotated(grade: int, dropped):
+    if dropped != []:
+        return f'annotated ({grade}/5, {len(dropped)} dropped)'
+    return f'annotated ({grade}/5)'
+
+
+# The outcome of a file whose compilation check did not pass, or None
+def failed_compilation(status: str):
+    if status == compile_check.FAILED:
+        return 'compilation failed'
+    if status == compile_check.TIMEOUT:
+        return 'compilation timed out'
+    return None
+
+
+# Annotates each relevant chunk of `code` (the whole file, or only its new and
+# changed items) in its own conversations, then applies the contracts (and harnesses)
+# of the accepted chunks and the stored ones of the unchanged items to the whole file
+async def handle_file_in_chunks(worker, arbiter, f: str, plan, code: str, max_tokens: int):
+    chunks = prepare_chunks(f, plan, code, max_tokens)
+    if chunks is None:
+        return 'nothing to annotate'
+
+    chunk_jobs = asyncio.Semaphore(Config.chunk_jobs)
+
+    async def annotate(i: int):
+        async with chunk_jobs:
+            return await annotate_chunk(f, i, len(chunks), chunks[i])
+
+    results = await asyncio.gather(*(labelled(annotate)(i) for i in range(len(chunks))))
+    grade = save_chunks(worker, f, plan, chunks, results)
+    if grade is None:
+        return f'low grade ({max(g for (_, g, _) in results)}/5)'
+    await verify_chunk_harnesses(worker, f, plan)
+    return record(plan, await update_source_file(worker, arbiter, f, grade, plan), grade)
+
+
+# Returns the chunks to send, or None if there is nothing to annotate
+def prepare_chunks(f: str, plan, code: str, max_tokens: int):
+    if plan.incremental():
+        Config.log(f'{f}: {len(plan.changed())}/{len(plan.items)} new or changed items')
+    # without chunking, the excerpt is sent in one piece
+    chunks = split_into_chunks(code, max_tokens if max_tokens > 0 else estimate_tokens(code) + 1)
+    if len(chunks) == 0 and not plan.incremental():
+        return None
+    Config.verboseprint(f'\nAnnotating {f} in {len(chunks)} chunks')
+    Config.log(f'{f}: {len(chunks)} chunks')
+    return chunks
+
+
+# Returns the contracts, their grade and the (excellent) harnesses of a chunk
+async def annotate_chunk(f: str, i: int, n: int, code: str):
+    worker, arbiter = Worker(), Arbiter()
+    worker.set_chunk_to_annotate(f, i, code)
+    name = f'{f} (chunk {i + 1}/{n})'
+    job = journal.job(worker.file_id, code)
+    resumed = job.accepted('chunk')
+    if resumed is not None:
+        return tuple(json.loads(resumed[1]))
+    try:
+        grade = await annotate_contracts(worker, arbiter, name)
+        harnesses = ''
+        if grade >= 4 and Config.gen_harnesses:
+            if harness_runner.enabled(f):
+                # run with Kani on the whole file, see `verify_chunk_harnesses`
+                if not scheduler.exhausted(name):
+                    harnesses = await worker.generate_harnesses()
+            else:
+                await annotate_harnesses(worker, arbiter, name)
+                if worker.harnesses_grade == 5:
+                    harnesses = worker.generated_harnesses
+        return record_chunk(job, worker.generated_contracts, grade, harnesses)
+    except LongInputException:
+        Config.verboseprint(style.yellow(f'{name}: input is too long. Skipping the chunk'))
+        Config.log(f'{name}: input is too long')
+        return '', -1, ''
+    finally:
+        log_usage(name, worker, arbiter, 0, 0)
+
+
+def record_chunk(job, contracts: str, grade: int, harnesses: str):
+    job.record('chunk', grade, json.dumps([contracts, grade, harnesses]))
+    return contracts, grade, harnesses
+
+
+# Applies the contracts and harnesses of the accepted chunks and of the unchanged
+# items to the whole file; returns the lowest grade, or None if no chunk was accepted
+def save_chunks(worker, f: str, plan, chunks, results):
+    grades = [grade for (_, grade, _) in results if grade >= 4]
+    if results != []:
+        Config.log(f'{f}: chunk grades: {[grade for (_, grade, _) in results]}')
+        Config.log(f'{f}: accepted chunks: {len(grades)}/{len(results)}')
+        if grades == []:
+            Config.verboseprint(style.yellow(f'No chunk is annotated well enough. Skipping the rest'))
+            return None
+
+    plan.resolve([(code, contracts, harnesses, grade >= 4)
+                  for (code, (contracts, grade, harnesses)) in zip(chunks, results)],
+                 Worker.HARNESSES_HEADER)
+    worker.copy_source_file()
+    worker.generated_contracts = plan.contracts()
+    worker.save_generated_contracts()
+    if Config.gen_harnesses:
+        worker.generated_harnesses = plan.harnesses(Worker.HARNESSES_HEADER)
+        worker.save_generated_harnesses()
+    if plan.incremental():
+        grades.append(plan.entry['grade'])
+    return min(grades)
+
+
+# Runs the harnesses of the chunks (and of the unchanged items) with Kani on the whole
+# annotated file, and keeps only the verified ones; they are not sent back to the worker,
+# whose conversations were about single chunks
+async def verify_chunk_harnesses(worker, f: str, plan):
+    annotated_file = Config.target_dir + worker.file_id + "_annotated.rs"
+    if not Config.gen_harnesses or worker.generated_harnesses == '' or \
+            not harness_runner.available(f, annotated_file):
+        return
+    # the harnesses are run on the annotated file without them
+    worker.save_generated_contracts()
+    results = await asyncio.to_thread(labelled(harness_runner.run), f, annotated_file, worker.generated_harnesses,
+                                      Worker.HARNESSES_HEADER)
+    Config.log(f'{f}: harnesses: {harness_runner.summary(results)}')
+    keep_verified_harnesses(worker, f, results)
+    plan.keep_harnesses([r['harness'] for r in results if r['status'] == harness_runner.VERIFIED])
+    worker.save_generated_harnesses()
+
+
+def revert_source_file(f: str, reason: str):
+    Config.verboseprint(style.yellow(f'{reason.capitalize()}. Reverting the changes'))
+    Config.log(f'{f}: {reason}')
+    # TODO: try to refine before reverting, or at least try adding contracts without proofs
+    subprocess.run(["git", "-C", Config.source_dir, "checkout", f], check=False, capture_output=True)
+
+
+async def handle_file_safely(worker, arbiter, f: str):
+    worker_calls, arbiter_calls = len(worker.conversation.calls), len(arbiter.conversation.calls)
+    try:
+        return await handle_file(worker, arbiter, f)
+    except LongInputException:
+        print(Config.current_tag() + style.yellow("The model returned the following errors: Input is too long for requested model"))
+        print(Config.current_tag() + "You probably attached a large file")
+        Config.verboseprint('Skipping')
+        return 'input is too long'
+    finally:
+        log_usage(f, worker, arbiter, worker_calls, arbiter_calls)
+
+
+def log_usage(f: str, worker, arbiter, worker_calls: int, arbiter_calls: int):
+    Config.log(f'{f}: worker usage: {worker.conversation.usage_summary(worker_calls)}')
+    Config.log(f'{f}: arbiter usage: {arbiter.conversation.usage_summary(arbiter_calls)}')
+
+
+# Each job gets its own worker and arbiter, so that conversations do not mix
+async def handle_files_async(files):
+    jobs = asyncio.Semaphore(Config.jobs)
+
+    async def handle_in_task(f: str):
+        async with jobs:
+            Config.set_current_file(f)
+            return await labelled(handle_file_safely)(Worker(), Arbiter(), f)
+
+    loop = asyncio.get_running_loop()
+    if not Config.use_async:
+        # each request in flight blocks a thread of the default executor, see `Conversation.converse_async`
+        loop.set_default_executor(ThreadPoolExecutor(
+            max_workers=Config.jobs * (Config.chunk_jobs * Config.harness_jobs + 1)))
+    profiler.watch(loop)
+    try:
+        # make sure we can talk
+        await Worker().hi()
+        await Arbiter().hi()
+
+        results = await asyncio.gather(*(handle_in_task(f) for f in files))
+        return dict(zip(files, results))
+    finally:
+        await async_bedrock.close()
+        profiler.watch(None)
+
+
+# Annotates `files`, with the transport of `use_async`; returns the outcome of each file
+def handle_files(files):
+    return asyncio.run(handle_files_async(files))
+
+
+def print_results(results):
+    print('\nResults:')
+    for f, res in results.items():
+        name = f.removeprefix(Config.source_dir)
+        if res.startswith('annotated'):
+            print(f'  {name}: {style.green(res)}')
+        else:
+            print(f'  {name}: {style.yellow(res)}')
 
-        if Config.try_compile:
-            ok = arbiter.try_to_compile()
-            if not ok:
-                Config.verboseprint(style.yellow(f'Compilation failed. Reverting the changes'))
-                Config.log(f'{f}: compilation failed')
-                # TODO: try to refine before reverting, or at least try adding contracts without proofs
-                subprocess.run(["git", "-C", Config.source_dir, "checkout", f], check=False, capture_output=True)
 
 def main():
     style.init()
 
     Config.init_from_arguments()
+    if Config.snapshot and is_remote(Config.source_dir):
+        take_snapshot()
     if Config.verbose:
         Config.print()
 
     Config.log(f'{datetime.datetime.now()} start annotating')
 
-    worker = Worker()
-    arbiter = Arbiter()
+    if Config.profile:
+        profiler.start()
+    try:
+        files = scheduler.order(Config.files_to_annotate)
+        results = handle_files(files)
+    finally:
+        profiler.stop()
 
-    # make sure we can talk
-    worker.hi()
-    arbiter.hi()
+    for f, res in results.items():
+        Config.log(f'{f}: {res}')
+    print_results(results)
 
-    for f in Config.files_to_annotate:
-        try:
-            handle_file(worker, arbiter, f)
-        except LongInputException:
-            print(style.yellow("The model returned the following errors: Input is too long for requested model"))
-            print("You probably attached a large file")
-            Config.verboseprint('Skipping')
-            continue
+    report = throttling_report()
+    if report != '':
+        Config.log('time lost to throttling:\n' + report)
+        print('\nTime lost to throttling:')
+        print(report, end='')
+
+    report = response_cache.report()
+    if report != '':
+        Config.log(report)
+        print('\n' + report)
+    response_cache.evict()
+
+    path = metrics.write()
+    report = metrics.summary()
+    Config.log('time and tokens by stage:\n' + report)
+    print('\nTime and tokens by stage:')
+    print(report, end='')
+    print(f'Metrics written to {path}.json and {path}.prom')
+
+    report = scheduler.report()
+    if report != '':
+        Config.log('budget:\n' + report)
+        print('\nBudget:')
+        print(report, end='')
+
+    if Config.profile:
+        path = profiler.write()
+        report = profiler.summary()
+        Config.log('profile by stage:\n' + report)
+        print('\nProfile by stage (time of the threads and tasks):')
+        print(report, end='')
+        print(f'Profiles written to {path}')
 
 
 if __name__ == '__main__':
@@ -1,17 +1,36 @@
+import asyncio
 import base64
 import boto3
+import contextlib
+import copy
 import pathlib
 import sys
+import threading
 import time
 
 import style
 
+from botocore.config import Config as BotocoreConfig
 from botocore.exceptions import ClientError, ReadTimeoutError
 from configuration import Config
+from metrics import labelled, metrics
+from rate_limiter import get_rate_limiter
+from response_cache import response_cache
+
+try:
+    from aiobotocore.session import get_session
+except ImportError:
+    get_session = None
+
 
 class LongInputException(Exception):
     pass
 
+# boto3 clients cannot be safely created from several threads at once
+client_lock = threading.Lock()
+# throttled requests are retried by `converse`, so that the rate limiter sees the throttles
+NO_RETRIES = BotocoreConfig(retries={'total_max_attempts': 1})
+
 class Conversation:
 
     def __init__(self, bedrock_model: str, bedrock_region: str, prompt_dir: str):
@@ -24,14 +43,26 @@ class Conversation:
         # bedrock region used for this model
         self.bedrock_region = bedrock_region
         # bedrock client for this conversation
-        self.bedrock_client = boto3.client(
-            service_name='bedrock-runtime', region_name=self.bedrock_region)
+        self.bedrock_client = self.create_client()
         # system prompts
         self.system_prompts = [{"text": ""}]
         # current checkpoint
         self.checkpoint = -1
         # reminder message
         self.reminder = ''
+        # token usage of each request, see `record_usage`
+        self.calls = []
+        # size of the text of the conversation per token, calibrated with the usage of the responses
+        self.chars_per_token = 4.0
+        # size of the text of the last request
+        self.sent_chars = 0
+        # in a branch, the messages shared with the conversation it was forked from (see `fork`)
+        self.shared = []
+
+    def create_client(self):
+        with client_lock:
+            return boto3.client(service_name='bedrock-runtime', region_name=self.bedrock_region,
+                                endpoint_url=Config.bedrock_endpoint or None, config=NO_RETRIES)
 
     def add_system_prompt(self, prompt_str: str = "", prompt_filename: str = ""):
         if prompt_str != "":
@@ -116,86 +147,560 @@ class Conversation:
             self.remove_till_checkpoint()
             self.msgs = self.msgs[:1]
 
-    def converse(self):
+    # With a `stop` condition (see stop_conditions.py), the response is streamed and
+    # truncated as soon as the condition holds
+    def converse(self, stop=None):
         cleaned_conversation = False
+        attempt = 0
+        # time spent waiting for the rate limiter
+        wait = 0.0
+        limiter = get_rate_limiter(self.bedrock_model, self.bedrock_region)
+        start, end = self.old_turns()
+        if start < end:
+            summary = self.summarize(start, end) if Config.context_policy == 'summarize' else ''
+            self.remove_turns(start, end, summary)
         while True:
             try:
                 if self.msgs == []:
                     Config.verboseprint(style.yellow("No messages to send"))
                     return ''
-                inference_config = {"temperature": 0.0}
-                response = self.bedrock_client.converse(
-                    modelId=self.bedrock_model,
-                    messages=self.msgs,
-                    system=self.system_prompts,
-                    inferenceConfig=inference_config,
-                )
-                rep_message = response['output']['message']
-                if len(rep_message['content']) == 0:
-                    return ''
-                self.msgs.append(rep_message)
-                i = 0
-                out = ''
-                while i < len(rep_message['content']):
-                    if 'text' in rep_message['content'][i]:
-                        out += rep_message['content'][i]['text']
-                    i += 1
-                return out
+                request = self.request()
+                response = response_cache.get(Conversation.cached_request(request, stop))
+                if response is None:
+                    wait += limiter.acquire()
+                    self.sent_chars = self.context_chars()
+                    sent = time.monotonic()
+                    if stop is None or not Config.streaming:
+                        response = self.bedrock_client.converse(**request)
+                    else:
+                        response = read_stream(self.bedrock_client, request, StreamReader(stop))
+                    limiter.on_success()
+                    response_cache.put(Conversation.cached_request(request, stop), response)
+                    self.record_usage(response, False, time.monotonic() - sent, attempt, wait)
+                else:
+                    self.record_usage(response, True, 0.0, attempt, wait)
+                return self.read_response(response)
             except (TimeoutError, ReadTimeoutError):
-                Config.verboseprint(
-                    "Throttling (TimeoutError)... let me wait and try again in 4 minutes")
-                time.sleep(240)
-                continue
-            except self.bedrock_client.exceptions.AccessDeniedException:
-                print(style.red("Access Denied"))
-                print(f'Make sure that the model ({self.bedrock_model}) is available in your region ({self.bedrock_region})')
-                print(f'Configure the region in the config file: [worker_region|arbiter_region] = region')
-                self.bedrock_client.close()
-                sys.exit(1)
+                delay = self.backoff_delay(limiter, attempt, 'TimeoutError')
+                wait += delay
+                time.sleep(delay)
+                attempt += 1
             except ClientError as excep:
-                if excep.response['Error']['Code'] == 'ThrottlingException' or \
-                   excep.response['Error']['Code'] == 'ServiceUnavailableException' or \
-                   excep.response['Error']['Code'] == 'ReadTimeoutError':
-                    Config.verboseprint(
-                        f'Throttling ({excep.response['Error']['Code']})... let me wait and try again in 4 minutes')
-                    time.sleep(240)
-                    continue
-                elif excep.response['Error']['Code'] == 'ExpiredTokenException':
-                    print(style.red("Your credentials have expired"))
-                    print("Please run `ada cred update --account <account> --role <role> --once`")
-                    self.bedrock_client.close()
-                    sys.exit(1)
-                elif excep.response['Error']['Code'] == 'UnrecognizedClientException':
-                    print(style.red("Unrecognized error"))
-                    print("Try runing `mwinit` first")
-                    self.bedrock_client.close()
-                    sys.exit(1)
-                elif excep.response['Error']['Code'] == 'ValidationException':
-                    if "model identifier is invalid" in excep.response['Error']['Message']:
-                        print(style.red(excep.response['Error']['Message']))
-                        self.bedrock_client.close()
-                        sys.exit(1)
-                    elif "with on-demand throughput" in excep.response['Error']['Message']:
-                        print(style.red(excep.response['Error']['Message']))
-                        print("Try prefixing your model ID with 'us.'")
-                        sys.exit(1)
-                    elif cleaned_conversation and "Input is too long for requested model" in excep.response['Error']['Message']:
-                        self.remove_from_checkpoint()
-                        raise LongInputException
-                    elif cleaned_conversation:
-                        self.remove_all_except_checkpoint()
-                        return ''
+                action = self.handle_client_error(excep, cleaned_conversation)
+                if action == Conversation.RETRY:
+                    limiter.on_throttle(sent)
+                    delay = self.backoff_delay(limiter, attempt, excep.response['Error']['Code'])
+                    wait += delay
+                    time.sleep(delay)
+                    attempt += 1
+                elif action == Conversation.GIVE_UP:
+                    return ''
+                elif action == Conversation.SHORTENED:
                     cleaned_conversation = True
-                    Config.verboseprint(style.yellow("The conversation is way too long, let me shorten it"))
-                    self.remove_till_checkpoint()
-                    continue
-                else:
-                    raise
+
+    # possible outcomes of `handle_client_error`
+    RETRY = 'retry'
+    SHORTENED = 'shortened'
+    UNCACHED = 'uncached'
+    GIVE_UP = 'give up'
+
+    def backoff_delay(self, limiter, attempt: int, reason: str):
+        delay = limiter.backoff_delay(attempt)
+        Config.verboseprint(f'Throttling ({reason})... let me wait and try again in {delay:.1f} seconds')
+        return delay
+
+    CACHE_POINT = {"cachePoint": {"type": "default"}}
+    # models that support prompt caching on Bedrock, with the minimum number of tokens of a
+    # cacheable prefix (the first match wins); the other models get no cache points
+    CACHE_MIN_TOKENS = [('claude-3-5-haiku', 2048), ('claude-3-5-sonnet-20241022', 1024),
+                        ('claude-3-7-sonnet', 1024), ('claude-sonnet-4', 1024), ('claude-opus-4', 1024),
+                        ('amazon.nova', 1000)]
+    # models whose requests were rejected because of their cache points
+    uncached_models = set()
+
+    # A truncated response must not be reused for a request without the same stop condition
+    def cached_request(request, stop):
+        if stop is None or not Config.streaming:
+            return request
+        return dict(request, stopCondition=stop.__name__)
+
+    def request(self):
+        inference_config = {"temperature": 0.0}
+        msgs = self.msgs
+        system = self.system_prompts
+        min_tokens = self.min_cache_tokens()
+        if min_tokens > 0:
+            system_chars = sum(Conversation.message_chars(p) for p in self.system_prompts)
+            msgs = self.msgs_with_cache_point(system_chars, min_tokens)
+            if system_chars / self.chars_per_token >= min_tokens:
+                system = self.system_prompts + [Conversation.CACHE_POINT]
+        return {
+            "modelId": self.bedrock_model,
+            "messages": msgs,
+            "system": system,
+            "inferenceConfig": inference_config,
+        }
+
+    # Minimum number of tokens of a cacheable prefix with the model, 0 if it cannot cache
+    def min_cache_tokens(self):
+        if not Config.prompt_caching or self.bedrock_model in Conversation.uncached_models:
+            return 0
+        for (model, tokens) in Conversation.CACHE_MIN_TOKENS:
+            if model in self.bedrock_model:
+                return tokens
+        return 0
+
+    # Adds a cache point after the attached document (the checkpoint message), so that
+    # Bedrock caches the prefix of the conversation up to and including the document, and,
+    # in a branch, after the messages shared with the other branches (see `fork`). Smaller
+    # prefixes than `min_tokens` (after `system_chars` of system prompt) are not cached.
+    # The messages themselves are not modified.
+    def msgs_with_cache_point(self, system_chars: int, min_tokens: int):
+        points = []
+        if 0 <= self.checkpoint < len(self.msgs) and \
+           any('document' in c for c in self.msgs[self.checkpoint]['content']):
+            points.append(self.checkpoint)
+        n = len(self.shared)
+        if self.checkpoint + 1 < n <= len(self.msgs) and self.msgs[n - 1] is self.shared[-1]:
+            points.append(n - 1)
+        points = [i for i in points if (system_chars + sum(Conversation.message_chars(m) for m in self.msgs[:i + 1]))
+                  / self.chars_per_token >= min_tokens]
+        if points == []:
+            return self.msgs
+        msgs = list(self.msgs)
+        for i in points:
+            msgs[i] = {"role": msgs[i]["role"], "content": msgs[i]["content"] + [Conversation.CACHE_POINT]}
+        return msgs
+
+    # Returns a branch of the conversation, to ask questions that do not depend on each other
+    # concurrently. Messages are never modified once added, so the branch only copies the list
+    # of messages, and its requests start with the same (cacheable) messages as those of this
+    # conversation. The branch shares the client and the usage records of this conversation.
+    def fork(self):
+        branch = copy.copy(self)
+        branch.msgs = list(self.msgs)
+        branch.shared = list(self.msgs)
+        return branch
+
+    # Appends the messages added by `branch` since it was forked
+    def merge(self, branch):
+        shared = set(id(m) for m in branch.shared)
+        start = 0
+        for i, m in enumerate(branch.msgs):
+            if id(m) in shared:
+                start = i + 1
+        self.msgs += branch.msgs[start:]
+
+    # Records the usage of a request that took `seconds` (0 if the response was cached),
+    # after `retries` retries and `wait` seconds spent waiting for the rate limiter
+    def record_usage(self, response, cached: bool, seconds: float, retries: int, wait: float):
+        usage = response.get('usage', {})
+        # with prompt caching, the cached part of the input is not counted in `inputTokens`
+        context_tokens = usage.get('inputTokens', 0) + usage.get('cacheReadInputTokens', 0) + \
+            usage.get('cacheWriteInputTokens', 0)
+        if not cached and context_tokens >= Conversation.MIN_CALIBRATION_TOKENS and self.sent_chars > 0:
+            self.chars_per_token = self.sent_chars / context_tokens
+        if usage == {} and not cached:
+            # a stream cut by a stop condition does not report its usage
+            usage = self.estimated_usage(response)
+            context_tokens = usage['inputTokens']
+        call = {
+            "context_tokens": context_tokens,
+            "input_tokens": usage.get('inputTokens', 0),
+            "output_tokens": usage.get('outputTokens', 0),
+            "cache_read_tokens": usage.get('cacheReadInputTokens', 0),
+            "cache_write_tokens": usage.get('cacheWriteInputTokens', 0),
+            "latency_ms": response.get('metrics', {}).get('latencyMs', 0),
+            "cached": cached,
+        }
+        self.calls.append(call)
+        metrics.record_request(self.bedrock_model, cached, seconds, call, retries, wait)
+
+    # smaller requests are mostly made of the formatting of the messages
+    MIN_CALIBRATION_TOKENS = 1000
+
+    def estimated_usage(self, response):
+        output = sum(len(c.get('text', '')) for c in response['output']['message']['content'])
+        return {"inputTokens": int(self.sent_chars / self.chars_per_token),
+                "outputTokens": int(output / self.chars_per_token)}
+
+    # Size of the text of the system prompt and of the messages (documents included)
+    def context_chars(self):
+        return sum(Conversation.message_chars(m) for m in self.system_prompts + self.msgs)
+
+    def message_chars(msg):
+        res = 0
+        for c in msg.get('content', [msg]):
+            if 'text' in c:
+                res += len(c['text'])
+            elif 'document' in c:
+                # base64-encoded
+                res += len(c['document']['source']['bytes']) * 3 // 4
+        return res
+
+    # Estimated number of input tokens of the next request
+    def estimated_tokens(self):
+        return int(self.context_chars() / self.chars_per_token)
+
+    # Returns the range of the oldest messages to remove once the conversation is larger
+    # than `context_tokens`, so that it shrinks to `context_target` of it. The system prompt,
+    # the messages up to the checkpoint (the attached document) and the last request are kept,
+    # and the range ends with a response.
+    def old_turns(self):
+        if Config.context_tokens <= 0:
+            return 0, 0
+        tokens = self.estimated_tokens()
+        if tokens <= Config.context_tokens:
+            return 0, 0
+        excess = (tokens - Config.context_tokens * Config.context_target) * self.chars_per_token
+        start = self.checkpoint + 1 if self.checkpoint >= 0 else 1
+        last = len(self.msgs)
+        while last > start and self.msgs[last - 1]['role'] == 'user':
+            last -= 1
+        end = start
+        removed = 0
+        while end < last and (removed < excess or self.msgs[end - 1]['role'] != 'assistant'):
+            removed += Conversation.message_chars(self.msgs[end])
+            end += 1
+        return start, end
+
+    # Replaces the messages in [start, end) with their summary, if any
+    def remove_turns(self, start: int, end: int, summary: str):
+        Config.verboseprint(style.yellow(
+            f'The conversation is getting long ({self.estimated_tokens()} tokens), ' +
+            ('summarizing' if summary != '' else 'removing') + f' {end - start} old messages'))
+        summary_msgs = [] if summary == '' else [{
+            "role": "user",
+            "content": [{"text": "Summary of the earlier part of our conversation:\n\n" + summary}]
+        }]
+        self.msgs = self.msgs[:start] + summary_msgs + self.msgs[end:]
+
+    # A request for the summary of the messages in [start, end), as a transcript
+    def summary_request(self, start: int, end: int):
+        transcript = []
+        for m in self.msgs[start:end]:
+            text = '\n'.join(c['text'] if 'text' in c else f"[document {c['document']['name']}]"
+                             for c in m['content'] if 'text' in c or 'document' in c)
+            transcript.append(f"{m['role'].upper()}:\n{text}")
+        return {
+            "role": "user",
+            "content": [{"text": Conversation.SUMMARY_REQUEST + '\n\n'.join(transcript)}]
+        }
+
+    SUMMARY_REQUEST = """
+            Below is an earlier part of our conversation, which will be removed from it. Summarize
+            it in a few paragraphs: keep the instructions, the decisions and the findings that are
+            still needed to continue the work, and leave out the code that will be printed again.
+
+            """
+
+    def summarize(self, start: int, end: int):
+        msgs, checkpoint = self.msgs, self.checkpoint
+        self.msgs, self.checkpoint = [self.summary_request(start, end)], -1
+        try:
+            return self.converse()
+        finally:
+            self.msgs, self.checkpoint = msgs, checkpoint
+
+    # Summary of the token usage of the requests sent since `first_call`
+    def usage_summary(self, first_call: int = 0):
+        calls = [c for c in self.calls[first_call:] if not c["cached"]]
+        cached = len(self.calls[first_call:]) - len(calls)
+        return f'{len(calls)} requests ({cached} cached responses), ' + \
+               f'{sum(c["input_tokens"] for c in calls)} input tokens, ' + \
+               f'{sum(c["cache_read_tokens"] for c in calls)} cache read tokens, ' + \
+               f'{sum(c["cache_write_tokens"] for c in calls)} cache write tokens, ' + \
+               f'{sum(c["output_tokens"] for c in calls)} output tokens, ' + \
+               f'{max([c["context_tokens"] for c in calls], default=0)} tokens in the largest request, ' + \
+               f'{sum(c["latency_ms"] for c in calls) / 1000:.1f}s latency'
+
+    def read_response(self, response):
+        rep_message = response['output']['message']
+        if len(rep_message['content']) == 0:
+            return ''
+        self.msgs.append(rep_message)
+        i = 0
+        out = ''
+        while i < len(rep_message['content']):
+            if 'text' in rep_message['content'][i]:
+                out += rep_message['content'][i]['text']
+            i += 1
+        return out
+
+    # Decides what to do with a failed request; exits or raises on unrecoverable errors
+    def handle_client_error(self, excep: ClientError, cleaned_conversation: bool):
+        if excep.response['Error']['Code'] == 'AccessDeniedException':
+            print(style.red("Access Denied"))
+            print(f'Make sure that the model ({self.bedrock_model}) is available in your region ({self.bedrock_region})')
+            print(f'Configure the region in the config file: [worker_region|arbiter_region] = region')
+            self.close()
+            sys.exit(1)
+        elif excep.response['Error']['Code'] == 'ThrottlingException' or \
+           excep.response['Error']['Code'] == 'ServiceUnavailableException' or \
+           excep.response['Error']['Code'] == 'ReadTimeoutError':
+            return Conversation.RETRY
+        elif excep.response['Error']['Code'] == 'ExpiredTokenException':
+            print(style.red("Your credentials have expired"))
+            print("Please run `ada cred update --account <account> --role <role> --once`")
+            self.close()
+            sys.exit(1)
+        elif excep.response['Error']['Code'] == 'UnrecognizedClientException':
+            print(style.red("Unrecognized error"))
+            print("Try runing `mwinit` first")
+            self.close()
+            sys.exit(1)
+        elif excep.response['Error']['Code'] == 'ValidationException':
+            if "model identifier is invalid" in excep.response['Error']['Message']:
+                print(style.red(excep.response['Error']['Message']))
+                self.close()
+                sys.exit(1)
+            elif "with on-demand throughput" in excep.response['Error']['Message']:
+                print(style.red(excep.response['Error']['Message']))
+                print("Try prefixing your model ID with 'us.'")
+                sys.exit(1)
+            elif 'cach' in excep.response['Error']['Message'].lower() and \
+                 self.bedrock_model not in Conversation.uncached_models:
+                # e.g., the model does not support prompt caching, or not with these cache points
+                Config.verboseprint(style.yellow(f'{self.bedrock_model} rejected the cache points, '
+                                                 'let me try again without them'))
+                Conversation.uncached_models.add(self.bedrock_model)
+                return Conversation.UNCACHED
+            elif not Conversation.too_long(excep.response['Error']['Message']):
+                raise excep
+            elif cleaned_conversation and "Input is too long for requested model" in excep.response['Error']['Message']:
+                self.remove_from_checkpoint()
+                raise LongInputException
+            elif cleaned_conversation:
+                self.remove_all_except_checkpoint()
+                return Conversation.GIVE_UP
+            Config.verboseprint(style.yellow("The conversation is way too long, let me shorten it"))
+            self.remove_till_checkpoint()
+            return Conversation.SHORTENED
+        else:
+            raise excep
+
+    # messages of the validation errors caused by the length of the conversation
+    TOO_LONG = ['too long', 'too many tokens', 'too many total text bytes', 'context length',
+                'context window', 'maximum number of tokens']
+
+    def too_long(message: str):
+        return any(m in message.lower() for m in Conversation.TOO_LONG)
+
+    def close(self):
+        self.bedrock_client.close()
 
     def encode_file_to_base64(filename: str):
         with open(filename, 'rb') as file:
             return base64.b64encode(file.read()).decode('utf-8')
 
-    def hi(self):
+    # Same as `converse`, as a coroutine: the steps of the pipeline (see worker.py and
+    # arbiter.py) are coroutines for both transports, and this one sends its blocking
+    # requests from a thread, so that the other files and chunks go on meanwhile
+    async def converse_async(self, stop=None):
+        return await asyncio.to_thread(labelled(self.converse), stop)
+
+    async def hi(self):
         self.send_message_str("Hi, are you there?")
-        return self.converse()
+        return await self.converse_async()
+
+
+# Collects the events of a streamed response until the stop condition holds
+class StreamReader:
+
+    def __init__(self, stop):
+        self.stop = stop
+        self.text = ''
+        self.usage = {}
+        self.metrics = {}
+        self.stop_reason = ''
+        self.start = time.monotonic()
+
+    # Returns True once the rest of the stream is not needed
+    def add(self, event):
+        if 'contentBlockDelta' in event:
+            self.text += event['contentBlockDelta']['delta'].get('text', '')
+            end = self.stop(self.text)
+            if end is not None:
+                self.text = self.text[:end]
+                self.stop_reason = 'stop_condition'
+                return True
+        elif 'messageStop' in event:
+            self.stop_reason = event['messageStop'].get('stopReason', '')
+        elif 'metadata' in event:
+            self.usage = event['metadata'].get('usage', {})
+            self.metrics = event['metadata'].get('metrics', {})
+        return False
+
+    # The response in the format of `converse`; the usage is unknown if the stream was cut
+    def response(self):
+        content = [{"text": self.text}] if self.text != '' else []
+        if 'latencyMs' not in self.metrics:
+            self.metrics = {"latencyMs": int((time.monotonic() - self.start) * 1000)}
+        return {
+            "output": {"message": {"role": "assistant", "content": content}},
+            "usage": self.usage,
+            "metrics": self.metrics,
+            "stopReason": self.stop_reason,
+        }
+
+
+def read_stream(client, request, reader):
+    stream = client.converse_stream(**request)['stream']
+    try:
+        for event in stream:
+            if reader.add(event):
+                break
+    finally:
+        stream.close()
+    return reader.response()
+
+
+# Bedrock clients and concurrency limits shared by all async conversations of the process
+class AsyncBedrock:
+
+    def __init__(self):
+        # one client per region
+        self.clients = {}
+        # one semaphore per (model, region), caps the number of requests in flight
+        self.semaphores = {}
+        self.lock = None
+        self.exit_stack = None
+
+    async def client(self, region: str):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if region not in self.clients:
+                if get_session is None:
+                    # without aiobotocore, each request in flight occupies a thread
+                    with client_lock:
+                        self.clients[region] = boto3.client(service_name='bedrock-runtime', region_name=region,
+                                                            endpoint_url=Config.bedrock_endpoint or None, config=NO_RETRIES)
+                else:
+                    if self.exit_stack is None:
+                        self.exit_stack = contextlib.AsyncExitStack()
+                    self.clients[region] = await self.exit_stack.enter_async_context(
+                        get_session().create_client('bedrock-runtime', region_name=region,
+                                                    endpoint_url=Config.bedrock_endpoint or None, config=NO_RETRIES))
+            return self.clients[region]
+
+    def semaphore(self, model: str, region: str):
+        if (model, region) not in self.semaphores:
+            self.semaphores[(model, region)] = asyncio.Semaphore(Config.max_inflight)
+        return self.semaphores[(model, region)]
+
+    async def converse(self, model: str, region: str, request):
+        client = await self.client(region)
+        async with self.semaphore(model, region):
+            if get_session is None:
+                return await asyncio.to_thread(labelled(client.converse), **request)
+            return await client.converse(**request)
+
+    async def converse_stream(self, model: str, region: str, request, reader):
+        client = await self.client(region)
+        async with self.semaphore(model, region):
+            if get_session is None:
+                return await asyncio.to_thread(labelled(read_stream), client, request, reader)
+            stream = (await client.converse_stream(**request))['stream']
+            try:
+                async for event in stream:
+                    if reader.add(event):
+                        break
+            finally:
+                stream.close()
+            return reader.response()
+
+    async def close(self):
+        if self.exit_stack is not None:
+            await self.exit_stack.aclose()
+        elif get_session is None:
+            for client in self.clients.values():
+                client.close()
+        self.clients = {}
+        self.semaphores = {}
+        self.lock = None
+        self.exit_stack = None
+
+
+async_bedrock = AsyncBedrock()
+
+
+class AsyncConversation(Conversation):
+
+    def create_client(self):
+        # clients are shared by all async conversations, see `AsyncBedrock`
+        return None
+
+    async def converse(self, stop=None):
+        cleaned_conversation = False
+        attempt = 0
+        wait = 0.0
+        limiter = get_rate_limiter(self.bedrock_model, self.bedrock_region)
+        start, end = self.old_turns()
+        if start < end:
+            summary = await self.summarize(start, end) if Config.context_policy == 'summarize' else ''
+            self.remove_turns(start, end, summary)
+        while True:
+            try:
+                if self.msgs == []:
+                    Config.verboseprint(style.yellow("No messages to send"))
+                    return ''
+                request = self.request()
+                response = response_cache.get(Conversation.cached_request(request, stop))
+                if response is None:
+                    delay = limiter.reserve()
+                    wait += delay
+                    await asyncio.sleep(delay)
+                    self.sent_chars = self.context_chars()
+                    sent = time.monotonic()
+                    if stop is None or not Config.streaming:
+                        response = await async_bedrock.converse(self.bedrock_model, self.bedrock_region, request)
+                    else:
+                        response = await async_bedrock.converse_stream(
+                            self.bedrock_model, self.bedrock_region, request, StreamReader(stop))
+                    limiter.on_success()
+                    response_cache.put(Conversation.cached_request(request, stop), response)
+                    self.record_usage(response, False, time.monotonic() - sent, attempt, wait)
+                else:
+                    self.record_usage(response, True, 0.0, attempt, wait)
+                return self.read_response(response)
+            except (TimeoutError, ReadTimeoutError):
+                delay = self.backoff_delay(limiter, attempt, 'TimeoutError')
+                wait += delay
+                await asyncio.sleep(delay)
+                attempt += 1
+            except ClientError as excep:
+                action = self.handle_client_error(excep, cleaned_conversation)
+                if action == Conversation.RETRY:
+                    limiter.on_throttle(sent)
+                    delay = self.backoff_delay(limiter, attempt, excep.response['Error']['Code'])
+                    wait += delay
+                    await asyncio.sleep(delay)
+                    attempt += 1
+                elif action == Conversation.GIVE_UP:
+                    return ''
+                elif action == Conversation.SHORTENED:
+                    cleaned_conversation = True
+
+    async def converse_async(self, stop=None):
+        return await self.converse(stop)
+
+    def close(self):
+        # shared clients are closed with `async_bedrock.close()`
+        pass
+
+    async def summarize(self, start: int, end: int):
+        msgs, checkpoint = self.msgs, self.checkpoint
+        self.msgs, self.checkpoint = [self.summary_request(start, end)], -1
+        try:
+            return await self.converse()
+        finally:
+            self.msgs, self.checkpoint = msgs, checkpoint
+
+
+# A conversation with the transport of the run: aiobotocore from the event loop in async
+# mode (`-A`), or else boto3 from threads
+def new_conversation(bedrock_model: str, bedrock_region: str, prompt_dir: str):
+    if Config.use_async:
+        return AsyncConversation(bedrock_model, bedrock_region, prompt_dir)
+    return Conversation(bedrock_model, bedrock_region, prompt_dir)
@@ -0,0 +1,134 @@
+import json
+import re
+
+from configuration import Config
+
+# Reads the errors of a compilation check (see compile_check.py). The output of the
+# default compile command (Kani's code generation) is the human-readable output of
+# rustc; commands run with `--message-format json` (e.g., `cargo check`) print the
+# diagnostics of rustc as JSON lines, which are read too.
+
+# errors listed in the summary sent to the arbiter
+MAX_ERRORS = 10
+# characters of the summary sent to the arbiter
+MAX_SUMMARY_CHARS = 4000
+
+# rustc messages that only count the other errors
+SUMMARY_MESSAGE = re.compile(r'aborting due to|could not compile|build failed')
+ERROR_LINE = re.compile(r'^error(\[(E\d+)\])?: (.*)$')
+LOCATION_LINE = re.compile(r'^\s*--> (.+?):(\d+):(\d+)$')
+
+
+class Diagnostic:
+
+    def __init__(self, message: str, code: str, file: str, line: int, rendered: str):
+        self.message = message
+        # e.g., `E0425`, or ''
+        self.code = code
+        # as printed by the compiler, relative to the workspace or absolute ('' if unknown)
+        self.file = file
+        # 1-based, 0 if unknown
+        self.line = line
+        self.rendered = rendered
+
+    # Whether the error is in `f`, a file of the source directory
+    def is_in(self, f: str):
+        if self.file == '':
+            return False
+        relative = f.removeprefix(Config.source_dir)
+        # the paths of the crates are relative to the `library` workspace
+        return self.file in [relative, relative.removeprefix('library/')] or \
+            relative.endswith('/' + self.file) or self.file.endswith('/' + relative)
+
+    def location(self):
+        return f'{self.file}:{self.line}' if self.file != '' else 'unknown location'
+
+
+# Returns the errors of the output of a compilation check
+def errors(output: str):
+    res = []
+    text = []
+    for l in output.splitlines():
+        msg = json_line(l)
+        if msg is None:
+            text.append(l)
+        elif msg.get('reason') == 'compiler-message':
+            d = from_json(msg['message'])
+            if d is not None:
+                res.append(d)
+    # cargo prints its own errors (and a custom command may print rustc's) as text
+    return res + from_text('\n'.join(text))
+
+
+def json_line(l: str):
+    if not l.startswith('{'):
+        return None
+    try:
+        return json.loads(l)
+    except ValueError:
+        return None
+
+
+def from_json(msg):
+    if msg.get('level') not in ['error', 'error: internal compiler error'] or SUMMARY_MESSAGE.match(msg['message']):
+        return None
+    file, line = '', 0
+    spans = [s for s in msg.get('spans', []) if s.get('is_primary')] or msg.get('spans', [])
+    if spans != []:
+        span = spans[0]
+        # errors in the expansion of a macro point to its call site in the file
+        while span['file_name'].startswith('<') and span.get('expansion') is not None:
+            span = span['expansion']['span']
+        file, line = span['file_name'], span['line_start']
+    code = msg['code']['code'] if msg.get('code') else ''
+    return Diagnostic(msg['message'], code, file, line, msg.get('rendered') or msg['message'])
+
+
+def from_text(output: str):
+    res = []
+    lines = output.splitlines()
+    for (i, l) in enumerate(lines):
+        m = ERROR_LINE.match(l)
+        if m is None or SUMMARY_MESSAGE.match(m.group(3)):
+            continue
+        # the message ends with an empty line
+        end = i + 1
+        while end < len(lines) and lines[end].strip() != '':
+            end += 1
+        file, line = '', 0
+        for l in lines[i + 1:end]:
+            loc = LOCATION_LINE.match(l)
+            if loc is not None:
+                file, line = loc.group(1), int(loc.group(2))
+                break
+        res.append(Diagnostic(m.group(3), m.group(2) or '', file, line, '\n'.join(lines[i:end])))
+    return res
+
+
+# Whether the output of a compilation check reports an error
+def failed(output: str):
+    text = '\n'.join(l for l in output.splitlines() if json_line(l) is None)
+    return errors(output) != [] or "error: " in text or "error[" in text
+
+
+# The distinct errors, with the number and locations of their occurrences, within
+# MAX_ERRORS and MAX_SUMMARY_CHARS
+def summary(diagnostics):
+    distinct = {}
+    for d in diagnostics:
+        distinct.setdefault((d.code, d.message), []).append(d)
+    res = ''
+    for (n, ((code, message), ds)) in enumerate(distinct.items()):
+        if n == MAX_ERRORS:
+            res += f'\n... and {len(distinct) - MAX_ERRORS} other errors\n'
+            break
+        locations = ', '.join(dict.fromkeys(d.location() for d in ds))
+        entry = f'\nerror{f"[{code}]" if code != "" else ""}: {message}\n  at {locations}\n'
+        # the full message of the first occurrence, if there is room for it
+        if len(res) + len(entry) + len(ds[0].rendered) < MAX_SUMMARY_CHARS:
+            entry += ds[0].rendered.rstrip() + '\n'
+        if len(res) + len(entry) > MAX_SUMMARY_CHARS:
+            res += f'\n... and {len(distinct) - n} other errors\n'
+            break
+        res += entry
+    return res
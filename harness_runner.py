@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from configuration import Config
+from metrics import labelled, timed
+from rust_syntax import items, scan
+from worktrees import worktrees
+
+# Runs each generated harness with Kani, in a worktree of the source directory (see
+# worktrees.py) where the annotated file replaces the original one. The harnesses of a
+# file run in parallel (`verify_jobs` at a time), each with its own timeout. Their
+# outcomes are stored in `target_dir`/verification, by hash of the annotated file (without
+# the harnesses) and of the harness, so that unchanged harnesses are not run again.
+
+# outcomes of a harness
+VERIFIED = 'verified'
+FAILED = 'failed'
+TIMEOUT = 'timeout'
+
+# lines of the Kani output kept for the worker
+MAX_OUTPUT_LINES = 30
+
+cache_lock = threading.Lock()
+
+
+# Returns whether the harnesses of `f` are run with Kani
+def enabled(f: str):
+    return Config.run_harnesses and not Config.source_dir.startswith("https://") and \
+        f.startswith(Config.source_dir) and \
+        shutil.which(shlex.split(Config.verify_command)[0]) is not None and worktrees.available()
+
+
+# Returns whether the harnesses of `f` can be run, with its contracts in `annotated_file`
+def available(f: str, annotated_file: str):
+    return os.path.isfile(annotated_file) and enabled(f)
+
+
+# Returns the (name, code) of the harnesses of a `verify` module
+def harnesses_of(module: str, header: str):
+    res = []
+    lines = module.removeprefix(header).strip().removesuffix('}').splitlines(keepends=True)
+    depths, last_chars = scan(lines)
+    for (s, e) in items(lines, depths, last_chars, 0, len(lines), 0):
+        text = ''.join(lines[s:e]).strip()
+        name = re.search(r'\bfn\s+(\w+)', text)
+        if 'proof_for_contract' in text and name is not None:
+            res.append((name.group(1), text))
+    return res
+
+
+# The path of the `verify` module of `f` in its crate, e.g., `ptr::unique::verify`
+def module_path(f: str):
+    relative = re.sub(r'^library/[\w-]+/src/', '', f.removeprefix(Config.source_dir)).removesuffix('.rs')
+    path = [p for p in relative.split('/') if p != '']
+    if path != [] and path[-1] in ['mod', 'lib']:
+        path = path[:-1]
+    return '::'.join(path + ['verify'])
+
+
+def key(annotated: str, harness: str):
+    return hashlib.sha256((annotated + '\0' + harness).encode('utf-8')).hexdigest()
+
+
+def cache_path(k: str):
+    return Config.target_dir + "verification/" + k[:2] + '/' + k + ".json"
+
+
+# Returns the stored outcome of a harness; timeouts are only reused for the same or a shorter timeout
+def cached(k: str):
+    try:
+        with open(cache_path(k), 'r') as f:
+            res = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if res['status'] == TIMEOUT and res['timeout'] < Config.verify_timeout:
+        return None
+    return res
+
+
+def store(k: str, res):
+    path = cache_path(k)
+    with cache_lock:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(res, f)
+        os.replace(tmp, path)
+
+
+# Runs the harnesses of `module` on `f` annotated with `annotated_file`; returns the
+# outcome of each harness (name, status, wall time and the end of the Kani output)
+@timed('verify')
+def run(f: str, annotated_file: str, module: str, header: str):
+    with open(annotated_file, 'r') as file:
+        annotated = file.read()
+    harnesses = harnesses_of(module, header)
+    results = {}
+    todo = []
+    for (name, text) in harnesses:
+        res = cached(key(annotated, text))
+        if res is not None:
+            results[name] = dict(res, cached=True)
+        else:
+            todo.append((name, text))
+    Config.verboseprint(f'\tRunning {len(todo)} harnesses ({len(harnesses) - len(todo)} known outcomes)')
+
+    if todo != []:
+        relative = f.removeprefix(Config.source_dir)
+        with worktrees.acquire() as (i, root):
+            with open(root + relative, 'w') as file:
+                file.write(annotated + '\n' + module + '\n')
+            try:
+                build = os.path.abspath(Config.target_dir + "build") + f'/{i}/verify'
+                with ThreadPoolExecutor(max_workers=Config.verify_jobs) as executor:
+                    outcomes = list(executor.map(labelled(lambda h: run_harness(root, build, module_path(f) + '::' + h[0])),
+                                                 todo))
+            finally:
+                worktrees.restore(i, root, relative)
+        for ((name, text), res) in zip(todo, outcomes):
+            store(key(annotated, text), res)
+            results[name] = dict(res, cached=False)
+
+    res = [dict(results[name], harness=name) for (name, _) in harnesses]
+    for r in res:
+        Config.log(f'{f}: harness {r["harness"]}: {r["status"]} ({r["seconds"]:.1f}s{", cached" if r["cached"] else ""})')
+    return res
+
+
+def run_harness(root: str, build: str, harness: str):
+    cmd = [arg.format(harness=harness, target_dir=build) for arg in shlex.split(Config.verify_command)]
+    start = time.monotonic()
+    try:
+        r = subprocess.run(cmd, cwd=root, capture_output=True, text=True,
+                           timeout=Config.verify_timeout, check=False)
+    except subprocess.TimeoutExpired:
+        return {'status': TIMEOUT, 'seconds': time.monotonic() - start, 'timeout': Config.verify_timeout,
+                'output': f'no result after {Config.verify_timeout}s'}
+    output = r.stdout + r.stderr
+    status = VERIFIED if r.returncode == 0 and "VERIFICATION:- SUCCESSFUL" in output else FAILED
+    return {'status': status, 'seconds': time.monotonic() - start, 'timeout': Config.verify_timeout,
+            'output': tail(output)}
+
+
+# The errors and failed checks of a Kani output, or its last lines
+def tail(output: str):
+    lines = output.splitlines()
+    relevant = [l for l in lines if re.search(r'error|FAILURE|Failed Checks|VERIFICATION', l)]
+    return '\n'.join((relevant or lines)[-MAX_OUTPUT_LINES:])
+
+
+# Instructions for the worker to correct the harnesses that were not verified
+def failure_report(results):
+    res = """
+            I ran your harnesses with Kani. The following ones could not be verified; please
+            correct them (a harness that fails may also reveal a contract that is too weak).
+            """
+    for r in results:
+        if r['status'] != VERIFIED:
+            res += f"\n`{r['harness']}`: {r['status']}\n```\n{r['output']}\n```\n"
+    return res
+
+
+# The `verify` module with only the verified harnesses
+def verified_module(module: str, header: str, results):
+    verified = set(r['harness'] for r in results if r['status'] == VERIFIED)
+    harnesses = [text for (name, text) in harnesses_of(module, header) if name in verified]
+    if harnesses == []:
+        return ''
+    return header + '\n\n'.join(harnesses) + '\n}'
+
+
+def summary(results):
+    counts = {s: sum(1 for r in results if r['status'] == s) for s in [VERIFIED, FAILED, TIMEOUT]}
+    return f'{counts[VERIFIED]} verified, {counts[FAILED]} failed, {counts[TIMEOUT]} timed out'
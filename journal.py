@@ -0,0 +1,119 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from configuration import Config
+
+
+# Records the progress of each file through the pipeline in `target_dir`/journal.sqlite,
+# together with the artifacts and the grade of each stage, so that an interrupted run
+# can be resumed (`--resume`) without redoing the stages that were completed:
+#   'chunk'      the contracts, grade and harnesses of a chunk of a file (see chunker.py)
+#   'contracts'  the contracts of the whole file, generated, refined and graded
+#   'harnesses'  the harnesses of the whole file, generated, refined and graded
+#   'done'       the outcome of the file, once it is saved (and the source file updated
+#                and compiled, if requested)
+# The stages of a file are only reused for the same source code and worker model. The
+# files that failed (low grade, compilation failed, ...) are not 'done', and their
+# rejected contracts and chunks are generated again, so that a resumed run retries them.
+class Journal:
+
+    STAGES = ['chunk', 'contracts', 'harnesses', 'done']
+
+    def __init__(self):
+        self.db = None
+        self.lock = threading.Lock()
+
+    def path(self):
+        return Config.target_dir + "journal.sqlite"
+
+    def connect(self):
+        if self.db is not None:
+            return
+        os.makedirs(Config.target_dir, exist_ok=True)
+        # each statement is committed on its own, so that the journal survives a crash
+        self.db = sqlite3.connect(self.path(), isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS stages (
+                             file_id TEXT, stage TEXT, source_hash TEXT, grade INTEGER,
+                             artifact TEXT, updated REAL, PRIMARY KEY (file_id, stage))''')
+
+    # Returns the journal of a file (or of a chunk of a file) with the given source code
+    def job(self, file_id: str, source: str):
+        h = hashlib.sha256((Config.worker_model + '\n' + source).encode('utf-8')).hexdigest()
+        return Job(self, file_id, h)
+
+    # Returns the (grade, artifact) of a stage, or None if it was not recorded for this source
+    def get(self, file_id: str, source_hash: str, stage: str):
+        with self.lock:
+            self.connect()
+            row = self.db.execute('SELECT grade, artifact FROM stages WHERE file_id = ? AND stage = ? AND source_hash = ?',
+                                  (file_id, stage, source_hash)).fetchone()
+        return row
+
+    # Records a stage, and forgets the later ones and those of another source code
+    def put(self, file_id: str, source_hash: str, stage: str, grade: int, artifact: str):
+        later = Journal.STAGES[Journal.STAGES.index(stage) + 1:]
+        with self.lock:
+            self.connect()
+            with self.db:
+                self.db.execute('BEGIN')
+                self.db.execute(f'DELETE FROM stages WHERE file_id = ? AND (source_hash != ? OR stage IN ({",".join("?" * len(later))}))',
+                                (file_id, source_hash, *later))
+                self.db.execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?)',
+                                (file_id, stage, source_hash, grade, artifact, time.time()))
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+# The stages of one file
+class Job:
+
+    def __init__(self, journal: Journal, file_id: str, source_hash: str):
+        self.journal = journal
+        self.file_id = file_id
+        self.source_hash = source_hash
+
+    # Returns the (grade, artifact) recorded for `stage` by a previous run, if the run is resumed
+    def resumed(self, stage: str):
+        if not Config.resume:
+            return None
+        return self.journal.get(self.file_id, self.source_hash, stage)
+
+    # lowest grade of the contracts that are kept
+    ACCEPTED = 4
+
+    # Same as `resumed`, if the grade recorded for `stage` was accepted
+    def accepted(self, stage: str):
+        res = self.resumed(stage)
+        if res is None or res[0] < Job.ACCEPTED:
+            return None
+        return res
+
+    # Returns the outcome recorded by a previous run, if the file was saved
+    def done(self):
+        res = self.resumed('done')
+        if res is None or not Job.saved(res[1]):
+            return None
+        return res[1]
+
+    def record(self, stage: str, grade: int, artifact: str):
+        self.journal.put(self.file_id, self.source_hash, stage, grade, artifact)
+
+    # Records the outcome of the file, if it was saved
+    def finish(self, res: str):
+        if Job.saved(res):
+            self.record('done', 0, res)
+        return res
+
+    def saved(res: str):
+        return res.startswith('annotated')
+
+
+journal = Journal()
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+
+import argparse
+import base64
+import json
+import random
+import re
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from response_cache import ResponseCache
+from rust_syntax import function_name, struct_name, trim_pub
+
+
+# Local stand-in for the `converse` and `converse-stream` operations of
+# bedrock-runtime. It serves scripted or recorded responses, with configurable
+# latency, throttling and error injection. To use it instead of Bedrock, set
+# `bedrock_endpoint = http://127.0.0.1:<port>` in the configuration file (boto3
+# still needs some credentials to sign the requests, any will do).
+class LocalBedrock(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self,
+                 port: int = 8765,
+                 latency: float = 0.0,
+                 token_latency: float = 0.0,
+                 throttle_rate: float = 0.0,
+                 error_rate: float = 0.0,
+                 max_concurrent: int = 0,
+                 max_input_tokens: int = 0,
+                 rules_file: str = "",
+                 recorded_dir: str = "",
+                 seed: int = 0):
+        super().__init__(('127.0.0.1', port), Handler)
+        # seconds before the first token
+        self.latency = latency
+        # seconds per output token
+        self.token_latency = token_latency
+        # probability of a ThrottlingException
+        self.throttle_rate = throttle_rate
+        # probability of a ServiceUnavailableException
+        self.error_rate = error_rate
+        # requests above this number of requests in flight are throttled (0 = no limit)
+        self.max_concurrent = max_concurrent
+        # longer inputs are rejected with "Input is too long" (0 = no limit)
+        self.max_input_tokens = max_input_tokens
+        self.script = Script(rules_file, recorded_dir)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.inflight = 0
+        # statistics
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def handle_error(self, request, client_address):
+        # clients drop kept-alive connections without notice
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+    # Decides whether the request fails; returns the error code, or ''
+    def inject_error(self, input_tokens: int):
+        with self.lock:
+            self.requests += 1
+            if self.max_concurrent > 0 and self.inflight >= self.max_concurrent:
+                self.throttled += 1
+                return 'ThrottlingException'
+            if self.random.random() < self.throttle_rate:
+                self.throttled += 1
+                return 'ThrottlingException'
+            if self.random.random() < self.error_rate:
+                self.errors += 1
+                return 'ServiceUnavailableException'
+            if self.max_input_tokens > 0 and input_tokens > self.max_input_tokens:
+                self.errors += 1
+                return 'ValidationException'
+            self.inflight += 1
+            self.input_tokens += input_tokens
+            return ''
+
+    def done(self, output_tokens: int):
+        with self.lock:
+            self.inflight -= 1
+            self.output_tokens += output_tokens
+
+    def statistics(self):
+        return f'{self.requests} requests, {self.throttled} throttled, {self.errors} errors, ' + \
+               f'{self.input_tokens} input tokens, {self.output_tokens} output tokens'
+
+
+ERRORS = {
+    'ThrottlingException': (429, 'Too many requests, please wait before trying again.'),
+    'ServiceUnavailableException': (503, 'The service is unavailable. Please try again later.'),
+    'ValidationException': (400, 'Input is too long for requested model.'),
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        path = urllib.parse.unquote(self.path).strip('/').split('/')
+        if len(path) != 3 or path[0] != 'model' or path[2] not in ['converse', 'converse-stream']:
+            self.send_json(404, {"message": f'Unknown operation {self.path}'}, 'UnknownOperationException')
+            return
+        model = path[1]
+        input_tokens = estimate_tokens(json.dumps(body))
+
+        error = self.server.inject_error(input_tokens)
+        if error != '':
+            status, message = ERRORS[error]
+            self.send_json(status, {"message": message}, error)
+            return
+
+        text = ''
+        try:
+            text = self.server.script.respond(model, body)
+            output_tokens = estimate_tokens(text)
+            usage = {"inputTokens": input_tokens, "outputTokens": output_tokens,
+                     "totalTokens": input_tokens + output_tokens}
+            if path[2] == 'converse':
+                latency = self.server.latency + output_tokens * self.server.token_latency
+                time.sleep(latency)
+                self.send_json(200, {
+                    "output": {"message": {"role": "assistant", "content": [{"text": text}]}},
+                    "stopReason": "end_turn",
+                    "usage": usage,
+                    "metrics": {"latencyMs": int(latency * 1000)},
+                })
+            else:
+                self.stream(text, usage)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stopped reading the stream
+            self.close_connection = True
+        finally:
+            self.server.done(estimate_tokens(text))
+
+    def send_json(self, status: int, payload, error_type: str = ''):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if error_type != '':
+            self.send_header('x-amzn-ErrorType', error_type)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def stream(self, text: str, usage):
+        start = time.monotonic()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.amazon.eventstream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        time.sleep(self.server.latency)
+        self.send_event('messageStart', {"role": "assistant"})
+        # roughly 4 tokens per chunk
+        for chunk in re.findall(r'.{1,16}', text, re.DOTALL):
+            time.sleep(estimate_tokens(chunk) * self.server.token_latency)
+            self.send_event('contentBlockDelta', {"delta": {"text": chunk}, "contentBlockIndex": 0})
+        self.send_event('contentBlockStop', {"contentBlockIndex": 0})
+        self.send_event('messageStop', {"stopReason": "end_turn"})
+        self.send_event('metadata', {"usage": usage,
+                                     "metrics": {"latencyMs": int((time.monotonic() - start) * 1000)}})
+        self.wfile.write(b'0\r\n\r\n')
+
+    def send_event(self, event_type: str, payload):
+        data = event_message(event_type, payload)
+        self.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+        self.wfile.flush()
+
+
+# Encodes an event of the `application/vnd.amazon.eventstream` format
+def event_message(event_type: str, payload):
+    headers = b''
+    for name, value in [(':event-type', event_type),
+                        (':content-type', 'application/json'),
+                        (':message-type', 'event')]:
+        headers += struct.pack('!B', len(name)) + name.encode('utf-8')
+        headers += struct.pack('!BH', 7, len(value)) + value.encode('utf-8')
+    body = json.dumps(payload).encode('utf-8')
+    prelude = struct.pack('!II', 12 + len(headers) + len(body) + 4, len(headers))
+    prelude += struct.pack('!I', zlib.crc32(prelude))
+    message = prelude + headers + body
+    return message + struct.pack('!I', zlib.crc32(message))
+
+
+def estimate_tokens(text: str):
+    return len(text) // 4 + 1
+
+
+# Decides what to answer. Rules (a JSON list of {"pattern": regex, "response": text},
+# matched against the last user message) come first, then recorded responses
+# (a response cache directory), then a built-in script that mimics the worker and
+# the arbiter well enough to run the whole pipeline.
+class Script:
+
+    def __init__(self, rules_file: str = "", recorded_dir: str = ""):
+        self.rules = []
+        if rules_file != "":
+            with open(rules_file, 'r') as f:
+                self.rules = [(re.compile(r["pattern"], re.DOTALL), r["response"]) for r in json.load(f)]
+        self.recorded_dir = recorded_dir if recorded_dir == "" or recorded_dir.endswith('/') else recorded_dir + '/'
+
+    def respond(self, model: str, body):
+        msg = last_user_text(body)
+        for pattern, response in self.rules:
+            if pattern.search(msg):
+                return response
+        if self.recorded_dir != "":
+            recorded = self.recorded(model, body)
+            if recorded is not None:
+                return recorded
+        return self.scripted(body, msg)
+
+    # Looks the request up in a response cache (see response_cache.py)
+    def recorded(self, model: str, body):
+        request = {
+            "modelId": model,
+            "messages": decode_documents(body.get("messages", [])),
+            "system": body.get("system", []),
+            "inferenceConfig": body.get("inferenceConfig", {}),
+        }
+        for stop in ['', 'first_rust_fence', 'end_of_harnesses']:
+            key = ResponseCache.key(request if stop == '' else dict(request, stopCondition=stop))
+            try:
+                with open(self.recorded_dir + key[:2] + '/' + key + ".json", 'r') as f:
+                    content = json.load(f)['output']['message']['content']
+                return ''.join(c.get('text', '') for c in content)
+            except (OSError, ValueError, KeyError):
+                continue
+        return None
+
+    def scripted(self, body, msg: str):
+        if "your verdict" in msg:
+            # the first assessment is not perfect, the following ones are
+            if count_user_texts(body, "your verdict") <= 1:
+                return verdict(4, "Some preconditions are missing.",
+                               "Please double check the preconditions of all unsafe functions.")
+            return verdict(5, "The contracts match the safety comments.", "")
+        if "Summarize it in a few paragraphs" in msg:
+            return "The worker annotated the unsafe functions; the arbiter asked for more precise preconditions."
+        if "END OF HARNESSES" in msg:
+            funcs = re.findall(r'^\s*- (\w+)$', msg, re.MULTILINE)
+            return ''.join(f'HARNESS: {func}\n' + harness_for(func) + '\n' for func in funcs) + "END OF HARNESSES\n"
+        if "proof_for_contract" in msg:
+            func = re.search(r'for the function (\S+) that you annotated', msg)
+            func = func.group(1) if func is not None else "f"
+            return harness_for(func)
+        if "print ALL your harnesses" in msg:
+            return "```rust\n#[kani::proof]\nfn check() {}\n```\n"
+        if "print your solution" in msg.lower():
+            return contracts_for(document_text(body))
+        return "Understood. " * 20
+
+
+def last_user_text(body):
+    for m in reversed(body.get("messages", [])):
+        if m.get("role") == "user":
+            return '\n'.join(c["text"] for c in m["content"] if "text" in c)
+    return ''
+
+
+def count_user_texts(body, text: str):
+    return sum(1 for m in body.get("messages", []) if m.get("role") == "user"
+               for c in m["content"] if text in c.get("text", ""))
+
+
+# botocore base64-encodes the document bytes, which `Conversation` already sends base64-encoded
+def decode_document(data: str):
+    data = base64.b64decode(data)
+    try:
+        return base64.b64decode(data, validate=True).decode('utf-8')
+    except ValueError:
+        return data.decode('utf-8', errors='replace')
+
+
+def decode_documents(msgs):
+    res = []
+    for m in msgs:
+        content = []
+        for c in m["content"]:
+            if "document" in c:
+                doc = dict(c["document"])
+                doc["source"] = {"bytes": base64.b64decode(doc["source"]["bytes"]).decode('utf-8')}
+                c = {"document": doc}
+            content.append(c)
+        res.append({"role": m["role"], "content": content})
+    return res
+
+
+def document_text(body):
+    for m in body.get("messages", []):
+        for c in m["content"]:
+            if "document" in c:
+                return decode_document(c["document"]["source"]["bytes"])
+    return ''
+
+
+def verdict(grade: int, summary: str, instructions: str):
+    return "The output follows the instructions.\n\n```json\n" + \
+        json.dumps({"grade": grade, "summary": summary, "instructions": instructions}, indent=2) + "\n```\n"
+
+
+def harness_for(func: str):
+    return f'```rust\n#[kani::proof_for_contract({func})]\nfn check_{func}() {{\n    let x: usize = kani::any();\n}}\n```\n'
+
+
+# A trivial precondition for each unsafe function, in the worker's output format
+def contracts_for(source: str):
+    res = []
+    current_impl = "_None"
+    for line in source.splitlines():
+        l = trim_pub(line.strip())
+        if l.startswith(("impl ", "impl<", "unsafe impl", "trait ", "unsafe trait ")) and not l.endswith("}"):
+            current_impl = struct_name(l)
+        elif line.startswith("}"):
+            current_impl = "_None"
+        elif " fn " in " " + l and "unsafe " in l and not l.endswith(";"):
+            name = function_name(l)
+            if name != l:
+                res.append(f'{current_impl}\n#[requires(true)]\n{name}')
+    return '\n\n'.join(res)
+
+
+def main():
+    arg = argparse.ArgumentParser(description='Local stand-in for the Bedrock converse API')
+    arg.add_argument('--port', type=int, default=8765, help='port to listen on')
+    arg.add_argument('--latency', type=float, default=0.0, help='seconds before the first token')
+    arg.add_argument('--token-latency', type=float, default=0.0, help='seconds per output token')
+    arg.add_argument('--throttle-rate', type=float, default=0.0, help='probability of throttling a request')
+    arg.add_argument('--error-rate', type=float, default=0.0, help='probability of a ServiceUnavailableException')
+    arg.add_argument('--max-concurrent', type=int, default=0, help='throttle above this number of requests in flight')
+    arg.add_argument('--max-input-tokens', type=int, default=0, help='reject longer inputs as too long')
+    arg.add_argument('--rules', type=str, default='', help='JSON file with scripted responses')
+    arg.add_argument('--recorded', type=str, default='', help='response cache directory to replay')
+    args = arg.parse_args()
+    server = LocalBedrock(port=args.port,
+                          latency=args.latency,
+                          token_latency=args.token_latency,
+                          throttle_rate=args.throttle_rate,
+                          error_rate=args.error_rate,
+                          max_concurrent=args.max_concurrent,
+                          max_input_tokens=args.max_input_tokens,
+                          rules_file=args.rules,
+                          recorded_dir=args.recorded)
+    print(f'Listening on http://127.0.0.1:{server.port()}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(server.statistics())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+import json
+import os
+import re
+import threading
+
+from chunker import excerpt, index_items, parse_contracts, parse_harnesses
+from configuration import Config
+
+
+# Records, for each annotated file, a hash of each of its functions (signature, body
+# and comments, including the SAFETY ones) and type definitions, together with the
+# contracts (or type invariants) and harnesses accepted for them. The following runs
+# only send the new or changed items to the worker, and reuse the stored contracts
+# of the others (see `Plan`).
+class Manifest:
+
+    def __init__(self):
+        # entries by file ID, loaded on first use
+        self.files = None
+        self.lock = threading.Lock()
+
+    def path(self):
+        return Config.target_dir + "manifest.json"
+
+    def load(self):
+        if self.files is not None:
+            return
+        try:
+            with open(self.path(), 'r') as f:
+                self.files = json.load(f)
+        except (OSError, ValueError):
+            self.files = {}
+
+    # Returns the plan of the annotation of `source`
+    def plan(self, file_id: str, source: str):
+        with self.lock:
+            self.load()
+            entry = self.files.get(file_id)
+        # the stored contracts are only reused for the same worker
+        if not Config.incremental or entry is None or entry['model'] != Config.worker_model:
+            entry = None
+        return Plan(file_id, index_items(source), entry)
+
+    # Stores the items resolved by `plan`, except the rejected ones
+    def record(self, plan, grade: int):
+        entry = {
+            'model': Config.worker_model,
+            'grade': grade,
+            'items': [r for r in plan.resolved if r is not None],
+        }
+        with self.lock:
+            self.load()
+            self.files[plan.file_id] = entry
+            os.makedirs(Config.target_dir, exist_ok=True)
+            tmp = self.path() + f'.{threading.get_ident()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.files, f, indent=1)
+            os.replace(tmp, self.path())
+
+
+# The items of a file, and the stored entries of those that did not change
+class Plan:
+
+    def __init__(self, file_id: str, items, entry):
+        self.file_id = file_id
+        self.items = items
+        self.entry = entry
+        stored = {}
+        for x in (entry['items'] if entry is not None else []):
+            stored.setdefault((x['key'], x['hash']), []).append(x)
+        self.stored = []
+        for it in items:
+            candidates = stored.get((it.key, it.hash), [])
+            self.stored.append(candidates.pop(0) if candidates != [] else None)
+        # the entries to record, set by `resolve`
+        self.resolved = []
+
+    def incremental(self):
+        return self.entry is not None
+
+    def changed(self):
+        return [it for (it, st) in zip(self.items, self.stored) if st is None]
+
+    # Source code with only the new or changed items
+    def excerpt(self):
+        return excerpt(self.changed())
+
+    # Returns the indices of the (unclaimed) items of `code`, an excerpt of the file
+    def items_in(self, code: str, claimed):
+        res = []
+        for it in index_items(code):
+            for i, x in enumerate(self.items):
+                if i not in claimed and x.key == it.key and x.hash == it.hash:
+                    claimed.add(i)
+                    res.append(i)
+                    break
+        return res
+
+    # Matches the worker's outputs to the items. `results` is a list of
+    # (code sent to the worker, contracts, harnesses, accepted) tuples.
+    def resolve(self, results, harnesses_header: str):
+        resolved = [None] * len(self.items)
+        rejected = set()
+        claimed = set()
+        for (code, contracts, harnesses, accepted) in results:
+            indices = self.items_in(code, claimed)
+            if not accepted:
+                rejected.update(indices)
+                continue
+            contracts, invariants = parse_contracts(contracts)
+            harnesses = parse_harnesses(harnesses, harnesses_header)
+            for i in indices:
+                it = self.items[i]
+                if it.kind == 'fn':
+                    groups = contracts.get(it.key, [])
+                    resolved[i] = self.entry_of(it, groups.pop(0) if groups != [] else '',
+                                                harnesses.pop(it.key.split('::')[-1], []))
+                else:
+                    resolved[i] = self.entry_of(it, '\n\n'.join(invariants.pop(it.key, [])), [])
+
+        # the items that were not sent keep their stored contracts, if any
+        for i, it in enumerate(self.items):
+            if resolved[i] is None and i not in rejected:
+                resolved[i] = self.stored[i] or self.entry_of(it, '', [])
+        self.resolved = resolved
+        return resolved
+
+    # Rejects the resolved items of `source` (the annotated file) at the given lines, and
+    # removes the harnesses at those lines, so that the next run annotates them again.
+    # Returns the keys of the rejected items and the names of the removed harnesses, or
+    # None if a line is not within the contracts of an item or a harness.
+    def reject_items_at(self, source: str, lines):
+        located = []
+        claimed = set()
+        for it in index_items(source):
+            i = next((j for j, x in enumerate(self.items)
+                      if j not in claimed and x.key == it.key and x.hash == it.hash), None)
+            if i is not None:
+                claimed.add(i)
+            # type invariants are appended to the file, as `impl Invariant for T`
+            invariant = re.match(r'(\w+)::is_safe$', it.key)
+            if i is None and invariant is not None:
+                i = next((j for j, x in enumerate(self.items) if x.kind == 'type' and x.key == invariant.group(1)), None)
+            located.append((it, i))
+
+        rejected, harnesses = set(), set()
+        source_lines = source.splitlines()
+        for l in lines:
+            hits = [(it, i) for (it, i) in located if it.start <= l < it.end]
+            if hits == []:
+                return None
+            it, i = hits[0]
+            if 'proof_for_contract' in it.text:
+                harnesses.add(harness_at(source_lines, it.start, it.end, l))
+            elif i is not None and self.resolved[i] is not None and self.resolved[i]['contracts'] != '':
+                rejected.add(i)
+            else:
+                return None
+
+        for i in rejected:
+            self.resolved[i] = None
+        self.resolved = [r if r is None else dict(r, harnesses=[h for h in r['harnesses']
+                                                                 if harness_name(h) not in harnesses])
+                         for r in self.resolved]
+        return [self.items[i].key for i in sorted(rejected)] + sorted(harnesses)
+
+    # Removes the harnesses of the resolved items that are not in `names`
+    def keep_harnesses(self, names):
+        self.resolved = [r if r is None else dict(r, harnesses=[h for h in r['harnesses'] if harness_name(h) in names])
+                         for r in self.resolved]
+
+    def entry_of(self, it, contracts: str, harnesses):
+        return {'key': it.key, 'kind': it.kind, 'hash': it.hash, 'contracts': contracts, 'harnesses': harnesses}
+
+    # The contracts file of the resolved items, in the order of the file
+    def contracts(self):
+        resolved = [r for r in self.resolved if r is not None and r['contracts'] != '']
+        res = '\n\n'.join(r['contracts'] for r in resolved if r['kind'] == 'fn')
+        invariants = [r['contracts'] for r in resolved if r['kind'] == 'type']
+        if invariants != []:
+            res += '\n\nTYPE INVARIANTS\n\n' + '\n\n'.join(invariants)
+        return res
+
+    # The `verify` module with the harnesses of the resolved items
+    def harnesses(self, header: str):
+        harnesses = [h for r in self.resolved if r is not None for h in r['harnesses']]
+        if harnesses == []:
+            return ''
+        return header + '\n\n'.join(harnesses) + '\n}'
+
+
+# The name of the harness at line `l` of the `verify` module in lines [start, end): the
+# function that follows an attribute, or else the one that contains the line
+def harness_at(lines, start: int, end: int, l: int):
+    if lines[l].strip().startswith('#'):
+        candidates = range(l, end)
+    else:
+        candidates = range(l, start - 1, -1)
+    for i in candidates:
+        m = re.search(r'\bfn\s+(\w+)', lines[i])
+        if m is not None:
+            return m.group(1)
+    return ''
+
+
+def harness_name(harness: str):
+    m = re.search(r'\bfn\s+(\w+)', harness)
+    return m.group(1) if m is not None else ''
+
+
+manifest = Manifest()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+import add_contracts
+import rust_syntax
+
+from add_contracts import is_annotated_already
+from chunker import index_items
+from rust_syntax import function_name, struct_name, trim_pub
+
+
+# Compares the merge of contracts into source files (add_contracts.insert_requires)
+# with the original algorithm, which rescanned the file from the beginning for
+# every unmatched contract group and inserted the attributes into a list. Every
+# function of each file gets a contract. The original algorithm misses some
+# functions (e.g., an impl right after a one-line impl), so the number of
+# inserted contracts is reported for both.
+
+
+# The original algorithm, kept for comparison
+def legacy_find_next_impl(l2, j):
+    while j < len(l2):
+        if not l2[j].strip():
+            return j + 1
+        j += 1
+    return j
+
+
+def legacy_intersection(l1, l2, j, res):
+    i = 0
+    offset = 0
+    current_impl = "_None"
+    impls = [("_None", "")]
+    expected_impl = ""
+    use = -1
+    inner = -1
+    num_of_attrs = 0
+    last_impl = len(l2)
+
+    # TODO: should check for `unsafe impl` too
+
+    while i < len(l1) and j < len(l2):
+
+        if expected_impl == "":
+            num_of_attrs = 0
+            last_impl = j
+            expected_impl = l2[j].strip()
+
+            if not expected_impl.startswith("impl ") and \
+               not expected_impl.startswith("impl<") and \
+               not expected_impl.startswith("trait ") and \
+               not expected_impl.startswith("unsafe impl"):
+                expected_impl = "impl " + expected_impl
+            expected_impl = struct_name(expected_impl)
+
+            j += 1
+            # Worker shouldn't add comments to its contract file but sometimes it's still doing that...
+            # TODO: just in case, support multiline comments
+            while j < len(l2) and (l2[j].strip().startswith('#') or l2[j].strip().startswith('//')):
+                j += 1
+                num_of_attrs += 1
+
+        # Peek the impl
+        (current_impl, indentation) = impls[-1]
+
+        l = trim_pub(l1[i].strip())
+        if l.startswith('impl ') or l.startswith('impl<') or \
+           l.startswith('unsafe impl ') or l.startswith('trait ') or \
+           l.startswith('unsafe trait ') or l.startswith('unsafe impl<'):
+            try:
+                current_impl = struct_name(l1[i].strip())
+            except IndexError:
+                i += 1
+                if i >= len(l1):
+                    break
+                current_impl = struct_name("impl<> " + l1[i].strip())
+            if l1[i].endswith('}\n'):
+                current_impl = "_None"
+
+            if current_impl != "_None":
+                # Push current_impl into the stack of impls
+                impls.append(
+                    (current_impl, l1[i].removesuffix(l1[i].lstrip())))
+            else:
+                # Peek the impl
+                (current_impl, indentation) = impls[-1]
+
+            i += 1
+        elif l1[i].startswith(indentation + '}'):
+            # Pop the impl
+            if len(impls) > 1:
+                impls.pop()
+            i += 1
+            continue
+        elif l1[i].startswith("use") and use == -1:
+            use = i
+            i += 1
+            continue
+        elif (l1[i].startswith("#![") or l1[i].startswith("#[")) and inner == -1:
+            inner = i
+            i += 1
+            continue
+
+        if i >= len(l1) or j >= len(l2):
+            break
+
+        fname = function_name(l1[i].strip())
+        expected_fname = function_name(l2[j].strip())
+
+        if current_impl == expected_impl and fname == expected_fname:
+            tab = re.match(r"\s*", l1[i]).group()
+            req = ""
+            while num_of_attrs > 0:
+                req += tab + l2[j - num_of_attrs].strip() + '\n'
+                num_of_attrs -= 1
+
+            res.append((i+offset, req))
+            j += 1
+            while j < len(l2) and not l2[j].strip():
+                j += 1
+            i += 1
+            offset += 1
+            expected_impl = ""
+            last_impl = -1
+        else:
+            i += 1
+
+    if use != -1 and inner > use:
+        inner = -1
+    return res, use, inner, last_impl
+
+
+def legacy_insert_requires(original: str, requires: str, updated: str):
+    with open(original, "r") as fo, open(requires, "r") as fr:
+        og = fo.readlines()
+        new = fr.readlines()
+
+    no_attrs = True
+
+    inter, use, inner, restart_from = legacy_intersection(og, new, 0, [])
+    while restart_from != -1:
+        for (i, l) in inter:
+            no_attrs = no_attrs and l == ""
+            og.insert(i, l)
+        inter, _, _, new_restart_from = legacy_intersection(og, new, restart_from, [])
+        if new_restart_from == restart_from:
+            restart_from = legacy_find_next_impl(new, restart_from)
+            if restart_from >= len(new):
+                break
+        else:
+            restart_from = new_restart_from
+
+    for (i, l) in inter:
+        no_attrs = no_attrs and l == ""
+        og.insert(i, l)
+
+    if no_attrs:
+        return False
+    if inner != -1 and not ("library-core-" in original) and not is_annotated_already(original):
+        og.insert(inner, "#![feature(ub_checks)]\n")
+    if use != -1 and not is_annotated_already(original):
+        if "library-core-" in original:
+            og.insert(use, """use safety::{ensures,requires};
+#[cfg(kani)]
+use crate::kani;
+#[allow(unused_imports)]
+use crate::ub_checks::*;\n\n""")
+        else:
+            use_str = """use safety::{ensures,requires};
+#[cfg(kani)]
+#[unstable(feature = "kani", issue = "none")]
+use core::kani;
+#[allow(unused_imports)]
+#[unstable(feature = "ub_checks", issue = "none")]
+use core::ub_checks::*;\n\n"""
+            if inner != -1:
+                use += 1
+            else:
+                use_str = "#![feature(ub_checks)]\n" + use_str
+            og.insert(use, use_str)
+
+    with open(updated, "w") as f:
+        f.writelines(og)
+
+    return True
+
+
+# A contracts file with a contract for every function of `source`, in the order
+# of the file or in the reverse order (the worst case of the original algorithm)
+def all_contracts(source: str, reverse: bool):
+    groups = []
+    for it in index_items(source):
+        if it.kind == 'fn':
+            struct, fname = it.key.split('::')
+            groups.append(f'{struct}\n#[requires(true)]\n{fname}')
+    if reverse:
+        groups.reverse()
+    return '\n\n'.join(groups) + '\n'
+
+
+def inserted(updated: str):
+    with open(updated, 'r') as f:
+        return f.read().count('#[requires(true)]')
+
+
+# The `n` largest Rust files of `directory`
+def largest_files(directory: str, n: int):
+    files = []
+    for root, _, names in os.walk(directory):
+        files += [os.path.join(root, name) for name in names if name.endswith('.rs')]
+    return sorted(files, key=os.path.getsize, reverse=True)[:n]
+
+
+def timed(insert_requires, original: str, requires: str, updated: str, repeat: int):
+    best = float('inf')
+    for _ in range(repeat):
+        # measure the parse too
+        rust_syntax.index_cache.clear()
+        start = time.perf_counter()
+        insert_requires(original, requires, updated)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    arg = argparse.ArgumentParser(description='Benchmark of the merge of contracts into source files')
+    arg.add_argument('paths', nargs='*',
+                     help='Rust files, or directories to take the largest files from '
+                          '(e.g., library/core/src of verify-rust-std)')
+    arg.add_argument('-n', '--largest', type=int, default=10, help='number of files taken from each directory')
+    arg.add_argument('-r', '--repeat', type=int, default=3, help='runs per file (the best one is reported)')
+    arg.add_argument('--reverse', action='store_true', help='list the contracts in the reverse order of the file')
+    args = arg.parse_args()
+    print(f'Parser: {"tree-sitter" if rust_syntax.RUST is not None else "scanner"}')
+
+    files = []
+    for p in args.paths:
+        files += largest_files(p, args.largest) if os.path.isdir(p) else [p]
+    if files == []:
+        arg.print_usage()
+        sys.exit(1)
+
+    work = tempfile.mkdtemp()
+    total_legacy = total_new = 0.0
+    print(f'{"file":<50}{"lines":>8}{"inserted":>14}{"legacy (s)":>12}{"new (s)":>10}{"speedup":>9}')
+    try:
+        for f in files:
+            with open(f, 'r') as fi:
+                source = fi.read()
+            # keep the file name: the headers depend on it
+            original = os.path.join(work, 'library-core-' + os.path.basename(f))
+            shutil.copyfile(f, original)
+            requires = os.path.join(work, 'contracts.rs')
+            contracts = all_contracts(source, args.reverse)
+            with open(requires, 'w') as fr:
+                fr.write(contracts)
+
+            legacy = timed(legacy_insert_requires, original, requires, original + '.legacy', args.repeat)
+            new = timed(add_contracts.insert_requires, original, requires, original + '.new', args.repeat)
+            counts = f'{inserted(original + ".legacy")}/{inserted(original + ".new")}'
+
+            total_legacy += legacy
+            total_new += new
+            name = f if len(f) <= 48 else '...' + f[-45:]
+            print(f'{name:<50}{source.count(chr(10)):>8}{counts:>14}'
+                  f'{legacy:>12.3f}{new:>10.3f}{legacy / max(new, 1e-9):>8.1f}x')
+    finally:
+        shutil.rmtree(work)
+    print(f'{"total":<50}{"":>8}{"":>14}{total_legacy:>12.3f}{total_new:>10.3f}{total_legacy / max(total_new, 1e-9):>8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+import contextvars
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+
+from configuration import Config
+
+# Records where the time and the tokens of a run go: the wall-clock time of each stage
+# (the `Worker` and `Arbiter` methods decorated with `timed`, the compilation checks and
+# the harness runs), and each model request, with its latency, tokens, retries and the
+# time spent waiting for the rate limiter. Everything is labelled by file, stage and
+# model. At the end of a run, `write` exports the totals to `target_dir`/metrics.json
+# and, in the Prometheus text format, to `target_dir`/metrics.prom.
+
+# the stage of the current thread (or asyncio task)
+current_stage_var = contextvars.ContextVar('current_stage', default='')
+
+# token counters of a request
+TOKENS = ['input_tokens', 'output_tokens', 'cache_read_tokens', 'cache_write_tokens']
+
+
+# The label of the current file, relative to the source directory
+def current_file():
+    return Config.current_file().removeprefix(Config.source_dir)
+
+
+def set_stage(stage: str):
+    current_stage_var.set(stage)
+
+
+def current_stage():
+    return current_stage_var.get()
+
+
+class Metrics:
+
+    def __init__(self):
+        # durations of the stages, by (file, stage)
+        self.stages = {}
+        # totals of the requests, by (file, stage, model)
+        self.requests = {}
+        self.start = time.time()
+        self.lock = threading.Lock()
+        # the labels (file, stage) of the running frames of the stages, read by the
+        # profiler (see profiler.py); only kept while profiling
+        self.frames = None
+
+    # Labels the samples of the profiler within `frame`
+    def enter(self, frame, labels):
+        if self.frames is not None:
+            self.frames[frame] = labels
+
+    def leave(self, frame):
+        if self.frames is not None:
+            self.frames.pop(frame, None)
+
+    def record_stage(self, stage: str, seconds: float):
+        with self.lock:
+            self.stages.setdefault((current_file(), stage), []).append(seconds)
+
+    def record_request(self, model: str, cached: bool, seconds: float, usage, retries: int, wait: float):
+        key = (current_file(), current_stage() or 'other', model)
+        with self.lock:
+            r = self.requests.setdefault(key, dict({'requests': 0, 'cached': 0, 'seconds': 0.0, 'retries': 0,
+                                                    'wait_seconds': 0.0}, **{t: 0 for t in TOKENS}))
+            r['requests'] += 1
+            r['cached'] += 1 if cached else 0
+            r['seconds'] += seconds
+            r['retries'] += retries
+            r['wait_seconds'] += wait
+            # cached responses cost no tokens
+            if not cached:
+                for t in TOKENS:
+                    r[t] += usage[t]
+
+    # Totals of the requests by stage (or by any other labels)
+    def requests_by(self, *labels):
+        res = {}
+        with self.lock:
+            for ((f, stage, model), r) in self.requests.items():
+                values = {'file': f, 'stage': stage, 'model': model}
+                key = tuple(values[l] for l in labels)
+                total = res.setdefault(key, {k: 0 for k in r})
+                for k in r:
+                    total[k] += r[k]
+        return res
+
+    def to_json(self):
+        with self.lock:
+            stages = [{'file': f, 'stage': s, 'calls': len(xs), 'seconds': sum(xs),
+                       'p50_seconds': percentile(xs, 0.5), 'p95_seconds': percentile(xs, 0.95)}
+                      for ((f, s), xs) in self.stages.items()]
+            requests = [dict({'file': f, 'stage': s, 'model': m}, **r)
+                        for ((f, s, m), r) in self.requests.items()]
+        return {
+            'start': self.start,
+            'end': time.time(),
+            'worker_model': Config.worker_model,
+            'arbiter_model': Config.arbiter_model,
+            'files': Config.files_to_annotate,
+            'stages': stages,
+            'requests': requests,
+        }
+
+    # The same totals, in the Prometheus text exposition format
+    def to_prometheus(self):
+        res = ''
+        with self.lock:
+            stages = list(self.stages.items())
+            requests = list(self.requests.items())
+
+        res += metric_header('contractgen_stage_seconds_total', 'counter', 'Wall-clock time spent in each stage')
+        for ((f, s), xs) in stages:
+            res += sample('contractgen_stage_seconds_total', {'file': f, 'stage': s}, sum(xs))
+        res += metric_header('contractgen_stage_calls_total', 'counter', 'Number of times each stage ran')
+        for ((f, s), xs) in stages:
+            res += sample('contractgen_stage_calls_total', {'file': f, 'stage': s}, len(xs))
+
+        counters = [
+            ('requests', 'contractgen_requests_total', 'Model requests, including the cached responses'),
+            ('cached', 'contractgen_cached_responses_total', 'Requests answered by the response cache'),
+            ('seconds', 'contractgen_request_seconds_total', 'Wall-clock time spent in model requests'),
+            ('retries', 'contractgen_request_retries_total', 'Retries after throttling or timeouts'),
+            ('wait_seconds', 'contractgen_rate_limit_wait_seconds_total', 'Time spent in backoff and pacing'),
+        ]
+        for (k, name, help) in counters:
+            res += metric_header(name, 'counter', help)
+            for ((f, s, m), r) in requests:
+                res += sample(name, {'file': f, 'stage': s, 'model': m}, r[k])
+        res += metric_header('contractgen_tokens_total', 'counter', 'Tokens of the model requests, by type')
+        for ((f, s, m), r) in requests:
+            for t in TOKENS:
+                res += sample('contractgen_tokens_total',
+                              {'file': f, 'stage': s, 'model': m, 'type': t.removesuffix('_tokens')}, r[t])
+        return res
+
+    # Time, requests and tokens by stage, in the order in which the stages first ran
+    def summary(self):
+        with self.lock:
+            stages = {}
+            for ((_, s), xs) in self.stages.items():
+                stages.setdefault(s, []).extend(xs)
+        requests = self.requests_by('stage')
+        for (s,) in requests:
+            stages.setdefault(s, [])
+
+        res = f'{"stage":<20}{"calls":>7}{"p50 (s)":>9}{"p95 (s)":>9}{"total (s)":>11}' + \
+              f'{"requests":>10}{"retries":>9}{"in tokens":>11}{"out tokens":>11}{"cache read":>12}{"wait (s)":>10}\n'
+        for (s, xs) in stages.items():
+            r = requests.get((s,), {'requests': 0, 'retries': 0, 'input_tokens': 0, 'output_tokens': 0,
+                                    'cache_read_tokens': 0, 'wait_seconds': 0.0})
+            res += f'{s:<20}{len(xs):>7}{percentile(xs, 0.5):>9.2f}{percentile(xs, 0.95):>9.2f}{sum(xs):>11.1f}' + \
+                   f'{r["requests"]:>10}{r["retries"]:>9}{r["input_tokens"]:>11}{r["output_tokens"]:>11}' + \
+                   f'{r["cache_read_tokens"]:>12}{r["wait_seconds"]:>10.1f}\n'
+        return res
+
+    # Writes metrics.json and metrics.prom into the target directory
+    def write(self):
+        os.makedirs(Config.target_dir, exist_ok=True)
+        path = Config.target_dir + "metrics"
+        with open(path + ".json", 'w') as f:
+            json.dump(self.to_json(), f, indent=1)
+        with open(path + ".prom", 'w') as f:
+            f.write(self.to_prometheus())
+        return path
+
+
+def percentile(xs, q: float):
+    if xs == []:
+        return 0.0
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(q * len(xs)))]
+
+
+def metric_header(name: str, kind: str, help: str):
+    return f'# HELP {name} {help}\n# TYPE {name} {kind}\n'
+
+
+def sample(name: str, labels, value):
+    escaped = ','.join(f'{k}="{escape(v)}"' for (k, v) in labels.items())
+    return f'{name}{{{escaped}}} {value}\n'
+
+
+def escape(v: str):
+    return v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+metrics = Metrics()
+
+
+# Decorates a method (or function) of a stage: its duration is recorded, and the model
+# requests it makes are labelled with the stage
+def timed(stage: str):
+    def decorate(method):
+        if inspect.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def async_wrapper(*args, **kwargs):
+                token = current_stage_var.set(stage)
+                frame = sys._getframe()
+                metrics.enter(frame, (current_file(), stage))
+                start = time.monotonic()
+                try:
+                    return await method(*args, **kwargs)
+                finally:
+                    metrics.record_stage(stage, time.monotonic() - start)
+                    metrics.leave(frame)
+                    current_stage_var.reset(token)
+            return async_wrapper
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            token = current_stage_var.set(stage)
+            frame = sys._getframe()
+            metrics.enter(frame, (current_file(), stage))
+            start = time.monotonic()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                metrics.record_stage(stage, time.monotonic() - start)
+                metrics.leave(frame)
+                current_stage_var.reset(token)
+        return wrapper
+    return decorate
+
+
+# Labels the samples of the profiler in the calls of `func` with the current file and
+# stage, e.g., in the threads that do not inherit them
+def labelled(func):
+    labels = (current_file(), current_stage() or 'other')
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            frame = sys._getframe()
+            metrics.enter(frame, labels)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                metrics.leave(frame)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        frame = sys._getframe()
+        metrics.enter(frame, labels)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics.leave(frame)
+    return wrapper
@@ -0,0 +1,191 @@
+import asyncio
+import json
+import linecache
+import os
+import sys
+import threading
+import time
+
+from configuration import Config
+from metrics import metrics
+
+# Samples the stacks of all threads every `profile_interval` seconds while the files are
+# annotated (`--profile`). Each sample is labelled with the file and the stage of the
+# innermost labelled frame of its stack (see `metrics.timed` and `metrics.labelled`), and
+# classified by what the thread is doing: waiting for a model response (network), for a
+# subprocess (the compiler, Kani, rustfmt, grep, git), for the rate limiter (throttle),
+# or for another thread or task (idle), or running Python code (cpu). The stacks are
+# written to `target_dir`/profiles/<file>.folded, in the collapsed format of flamegraph.pl
+# (also read by speedscope and inferno), and the time of each kind to breakdown.json.
+# The tasks that wait do not occupy a thread, so the suspended tasks of the event loop
+# are sampled too, with the stack of their coroutines.
+
+CPU = 'cpu'
+NETWORK = 'network'
+SUBPROCESS = 'subprocess'
+THROTTLE = 'throttle'
+IDLE = 'idle'
+KINDS = [CPU, NETWORK, SUBPROCESS, THROTTLE, IDLE]
+
+# the innermost frame of a thread blocked on a socket
+NETWORK_FILES = ['/socket.py', '/ssl.py', '/http/client.py', '/urllib3/util/connection.py', '/urllib3/util/wait.py']
+# the innermost frame of a thread waiting for another thread or task, or for work
+IDLE_FILES = ['/threading.py', '/queue.py', '/selectors.py', '/asyncio/base_events.py',
+              '/concurrent/futures/_base.py', '/concurrent/futures/thread.py']
+# the innermost coroutine of a task waiting for a model response
+NETWORK_TASK_DIRS = ['/aiobotocore/', '/aiohttp/']
+
+
+class Profiler:
+
+    def __init__(self):
+        # samples by (file, stage, kind), then by stack
+        self.samples = {}
+        # seconds by (file, stage, kind)
+        self.seconds = {}
+        self.thread = None
+        self.stopped = threading.Event()
+        # the event loop whose tasks are sampled
+        self.loop = None
+
+    def start(self):
+        metrics.frames = {}
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+
+    def watch(self, loop):
+        self.loop = loop
+
+    def run(self):
+        last = time.monotonic()
+        while not self.stopped.wait(Config.profile_interval):
+            now = time.monotonic()
+            # a late sample stands for the whole time since the previous one
+            self.sample(now - last)
+            last = now
+
+    def sample(self, seconds: float):
+        me = threading.get_ident()
+        for (ident, frame) in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame)
+                frame = frame.f_back
+            self.add(stack, classify(stack), seconds)
+
+        loop = self.loop
+        if loop is not None:
+            # the running task is in the stack of the event loop's thread
+            running = asyncio.current_task(loop)
+            for task in asyncio.all_tasks(loop):
+                if task is not running:
+                    stack = suspended(task)
+                    if stack != []:
+                        self.add(stack, classify_task(stack), seconds)
+
+    # Records a sample of `stack`, innermost frame first
+    def add(self, stack, kind: str, seconds: float):
+        labels = None
+        for frame in stack:
+            labels = metrics.frames.get(frame)
+            if labels is not None:
+                break
+        # threads outside of the annotation of a file (e.g., idle threads of a pool) are ignored
+        if labels is None and kind == IDLE:
+            return
+        (file, stage) = labels if labels is not None else ('', 'other')
+        key = (file, stage, kind)
+        folded = ';'.join([stage, kind] + [frame_name(f) for f in reversed(stack)])
+        stacks = self.samples.setdefault(key, {})
+        stacks[folded] = stacks.get(folded, 0) + 1
+        self.seconds[key] = self.seconds.get(key, 0.0) + seconds
+
+    # Seconds of each kind, by stage (or by any other labels)
+    def breakdown(self, *labels):
+        res = {}
+        for ((f, stage, kind), seconds) in self.seconds.items():
+            values = {'file': f, 'stage': stage}
+            total = res.setdefault(tuple(values[l] for l in labels), {k: 0.0 for k in KINDS})
+            total[kind] += seconds
+        return res
+
+    # Seconds of each kind by stage, in the order in which the stages were first sampled
+    def summary(self):
+        res = f'{"stage":<20}' + ''.join(f'{k + " (s)":>16}' for k in KINDS) + f'{"total (s)":>12}\n'
+        for ((stage,), b) in self.breakdown('stage').items():
+            res += f'{stage:<20}' + ''.join(f'{b[k]:>16.1f}' for k in KINDS) + f'{sum(b.values()):>12.1f}\n'
+        return res
+
+    # Writes the stacks of each file, and the breakdown of each file and stage, into
+    # `target_dir`/profiles; returns the directory
+    def write(self):
+        path = Config.target_dir + "profiles/"
+        os.makedirs(path, exist_ok=True)
+        files = {}
+        for ((f, _, _), stacks) in self.samples.items():
+            files.setdefault(f, {}).update(stacks)
+        for (f, stacks) in files.items():
+            name = f.split('.')[0].replace('/', '-') if f != '' else 'other'
+            with open(path + name + ".folded", 'w') as file:
+                for (stack, n) in sorted(stacks.items()):
+                    file.write(f'{stack} {n}\n')
+        breakdown = [dict({'file': f, 'stage': stage}, **b) for ((f, stage), b) in self.breakdown('file', 'stage').items()]
+        with open(path + "breakdown.json", 'w') as file:
+            json.dump({'interval': Config.profile_interval, 'breakdown': breakdown}, file, indent=1)
+        return path
+
+
+def classify(stack):
+    if any(f.f_code.co_filename.endswith('/subprocess.py') for f in stack):
+        return SUBPROCESS
+    filename = stack[0].f_code.co_filename
+    # the pacing of the rate limiter and the backoff after throttling
+    if 'time.sleep(' in linecache.getline(filename, stack[0].f_lineno or 0):
+        return THROTTLE
+    if any(filename.endswith(n) for n in NETWORK_FILES):
+        return NETWORK
+    if any(filename.endswith(n) for n in IDLE_FILES):
+        return IDLE
+    return CPU
+
+
+# The frames of the coroutines of a suspended task, innermost first
+def suspended(task):
+    stack = []
+    awaited = task.get_coro()
+    while True:
+        frame = getattr(awaited, 'cr_frame', None) or getattr(awaited, 'gi_frame', None)
+        if frame is None:
+            break
+        stack.append(frame)
+        awaited = getattr(awaited, 'cr_await', None) or getattr(awaited, 'gi_yieldfrom', None)
+    return list(reversed(stack))
+
+
+# A suspended task waits for a model response (of aiobotocore), for `asyncio.sleep`, or
+# else for a thread (sampled on its own), another task or a lock
+def classify_task(stack):
+    code = stack[0].f_code
+    if any(n in code.co_filename for n in NETWORK_TASK_DIRS):
+        return NETWORK
+    if code.co_filename.endswith('/asyncio/tasks.py') and code.co_name == 'sleep':
+        return THROTTLE
+    return IDLE
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+profiler = Profiler()
@@ -0,0 +1,104 @@
+import random
+import threading
+import time
+
+from configuration import Config
+
+
+# Token bucket shared by all conversations with the same model and region.
+# Requests are not paced until the model throttles us (unless `request_rate` is
+# set); the rate is then halved at every throttle, and slowly increases again
+# with every successful request (AIMD). The rate is halved at most once per
+# round trip: the throttles of the requests sent before the last decrease are
+# part of the same overload.
+class RateLimiter:
+
+    def __init__(self, model: str, region: str):
+        self.model = model
+        self.region = region
+        # allowed requests per second, None until the first throttle
+        self.rate = Config.request_rate if Config.request_rate > 0 else None
+        # available tokens, negative if some requests are already waiting
+        self.tokens = 1.0
+        self.last_refill = time.monotonic()
+        # wall-clock time spent waiting because of throttling (seconds)
+        self.backoff_time = 0.0
+        # wall-clock time spent waiting for a token (seconds)
+        self.pacing_time = 0.0
+        self.throttles = 0
+        # time of the last decrease of the rate
+        self.decreased = 0.0
+        self.lock = threading.Lock()
+
+    # Reserves a token, returns how long the caller should wait before sending its request
+    def reserve(self):
+        with self.lock:
+            if self.rate is None:
+                return 0.0
+            now = time.monotonic()
+            self.tokens = min(1.0, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            self.tokens -= 1.0
+            if self.tokens >= 0:
+                return 0.0
+            delay = -self.tokens / self.rate
+            self.pacing_time += delay
+            return delay
+
+    # Waits for a token; returns the time waited
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def on_success(self):
+        with self.lock:
+            if self.rate is not None:
+                self.rate = min(Config.max_request_rate, self.rate + Config.request_rate_step)
+
+    # `sent` is the time at which the throttled request was sent
+    def on_throttle(self, sent: float):
+        with self.lock:
+            self.throttles += 1
+            if sent < self.decreased:
+                return
+            if self.rate is None:
+                # the pacing starts from the maximum rate
+                self.rate = Config.max_request_rate
+                self.tokens = 0.0
+                self.last_refill = time.monotonic()
+            self.rate = max(Config.min_request_rate, self.rate / 2)
+            self.decreased = time.monotonic()
+
+    # Exponential backoff with full jitter, capped by `Config.max_backoff`
+    def backoff_delay(self, attempt: int):
+        delay = random.uniform(0, min(Config.max_backoff, Config.backoff_base * 2 ** attempt))
+        with self.lock:
+            self.backoff_time += delay
+        return delay
+
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model: str, region: str):
+    with limiters_lock:
+        if (model, region) not in limiters:
+            limiters[(model, region)] = RateLimiter(model, region)
+        return limiters[(model, region)]
+
+
+def throttling_report():
+    res = ''
+    with limiters_lock:
+        for limiter in limiters.values():
+            if limiter.throttles == 0 and limiter.backoff_time == 0 and limiter.pacing_time == 0:
+                continue
+            res += f'  {limiter.model} ({limiter.region}): ' + \
+                   f'{limiter.throttles} throttled requests, ' + \
+                   f'{limiter.backoff_time:.1f}s of backoff, ' + \
+                   f'{limiter.pacing_time:.1f}s of pacing, ' + \
+                   (f'final rate {limiter.rate:.2f} requests/s\n' if limiter.rate is not None else 'not paced\n')
+    return res
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from configuration import Config
+
+
+# Persistent cache of the model's responses. Requests are sent with temperature 0,
+# so an identical request (model, system prompts, messages including the attached
+# documents) can be answered from the disk instead of the network.
+class ResponseCache:
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def enabled(self):
+        return Config.use_cache
+
+    def directory(self):
+        return Config.target_dir + "cache/"
+
+    # The cache points are left out: their placement depends on the estimated size of
+    # the conversation, and does not change the response
+    def key(request):
+        return hashlib.sha256(json.dumps(ResponseCache.without_cache_points(request),
+                                         sort_keys=True).encode('utf-8')).hexdigest()
+
+    def without_cache_points(value):
+        if isinstance(value, list):
+            return [ResponseCache.without_cache_points(v) for v in value
+                    if not (isinstance(v, dict) and 'cachePoint' in v)]
+        if isinstance(value, dict):
+            return {k: ResponseCache.without_cache_points(v) for (k, v) in value.items()}
+        return value
+
+    def path(self, key: str):
+        return self.directory() + key[:2] + '/' + key + ".json"
+
+    # Returns the cached response to `request`, or None
+    def get(self, request):
+        if not self.enabled() or Config.refresh_cache:
+            return None
+        path = self.path(ResponseCache.key(request))
+        try:
+            with open(path, 'r') as f:
+                response = json.load(f)
+            # keep recently used entries during eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return response
+
+    def put(self, request, response):
+        if not self.enabled():
+            return
+        entry = {k: response[k] for k in ['output', 'usage', 'metrics', 'stopReason'] if k in response}
+        path = self.path(ResponseCache.key(request))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write atomically, parallel jobs may send identical requests
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(entry, f, default=str)
+        os.replace(tmp, path)
+
+    # Removes entries older than `Config.cache_max_age` days, then the least
+    # recently used ones until the cache fits into `Config.cache_max_size` MB
+    def evict(self):
+        if not os.path.isdir(self.directory()):
+            return
+        entries = []
+        for root, _, files in os.walk(self.directory()):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+
+        now = time.time()
+        max_age = Config.cache_max_age * 24 * 3600
+        max_size = Config.cache_max_size * 1024 * 1024
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in sorted(entries):
+            if now - mtime <= max_age and total <= max_size:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def report(self):
+        if not self.enabled() or self.hits + self.misses == 0:
+            return ''
+        return f'Response cache: {self.hits} hits, {self.misses} misses'
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,327 @@
+import collections
+import hashlib
+import itertools
+import re
+import threading
+
+try:
+    import tree_sitter
+    import tree_sitter_rust
+    RUST = tree_sitter.Language(tree_sitter_rust.language())
+except ImportError:
+    RUST = None
+
+
+# Item index of Rust source files: impls, traits, modules, functions and types, with
+# their line and byte ranges and the line where attributes (contracts) are inserted.
+# Files are parsed with tree-sitter-rust if it is installed, or else with a scanner
+# that tracks braces outside of comments, strings and chars. Indexes are cached by
+# file content, so the worker and add_contracts.py parse each file once.
+
+
+def trim_pub(l: str):
+    if l.strip().startswith("pub(crate) "):
+        l = l.split("pub(crate) ")[1].strip()
+    elif l.strip().startswith("pub(super) "):
+        l = l.split("pub(super) ")[1].strip()
+    elif l.strip().startswith("pub "):
+        l = l.split("pub ")[1].strip()
+    return l
+
+
+def trim_unsafe(l: str):
+    if l.strip().startswith("unsafe "):
+        l = l.split("unsafe ")[1].strip()
+    return l
+
+
+def struct_name(l: str):
+    l = trim_pub(l)
+    l = trim_unsafe(l)
+
+    if l.startswith("trait "):
+        n = l.split("trait ")[1].split(" ")[0]
+    elif " for " in l:
+        n = without_reference(l.split(" for ")[1]).split(" ")[0]
+    elif "impl<" in l:
+        n = without_reference(l.split("> ")[1]).split(" ")[0]
+    elif "impl " in l:
+        n = without_reference(l.split("impl ")[1]).split(" ")[0]
+    else:
+        return l
+
+    # `super::S<T>` is `S`, `Trait<T>: Bound` is `Trait`
+    return n.split("<")[0].split("::")[-1].split(":")[0]
+
+
+# `&'a mut S` and `dyn S` implement `S`
+def without_reference(t: str):
+    return re.sub(r"^(&\s*('\w+\s+)?(mut\s+)?|dyn\s+)+", '', t.strip())
+
+
+def function_name(l: str):
+    # ignore functions without bodies:
+    # https://github.com/model-checking/kani/issues/3325
+    if l.endswith(";\n") or l.endswith(";"):
+        return l
+
+    l = trim_pub(l)
+
+    if l.strip().startswith("const "):
+        l = l.split("const ")[1].strip()
+
+    if l.strip().startswith("unsafe "):
+        l = l.split("unsafe ")[1].strip()
+
+    if l.startswith('fn ') or (l.startswith('extern "') and '" fn ' in l):
+        return l.split("(")[0].split("<")[0].split(" ")[-1]
+    else:
+        return l
+
+
+# comments, strings and chars, which `scan` blanks out before counting braces
+# (the lookahead skips quickly the other characters)
+MASKED = re.compile(r"""(?=[/"'br])(?://[^\n]*|/\*|(?<!\w)b?r(#*)"[\s\S]*?(?:"\1|\Z)"""
+                    r"""|"(?:\\[\s\S]|[^"\\])*(?:"|\Z)|'(?:\\.[^'\n]*|[^\\\n])')""")
+COMMENT_TOKEN = re.compile(r'/\*|\*/')
+
+
+# Returns, for each line, the brace depth at its beginning and its last code
+# character (outside comments, strings and chars; '' if there is none). The
+# comments, strings and chars of the whole text are first replaced by spaces
+# (but for the closing quote), so that each line is then scanned with `count`.
+def scan(lines):
+    text = ''.join(lines)
+    pieces = []
+    pos = 0
+    m = MASKED.search(text)
+    while m is not None:
+        pieces.append(text[pos:m.start()])
+        end = m.end()
+        if m.group() == '/*':
+            # block comments nest
+            nested = 1
+            while nested > 0:
+                c = COMMENT_TOKEN.search(text, end)
+                if c is None:
+                    end = len(text)
+                    break
+                nested += 1 if c.group() == '/*' else -1
+                end = c.end()
+            pieces.append(' ' * (end - m.start()))
+        elif text[end - 1] in '"\'' and not m.group().startswith('/'):
+            pieces.append(' ' * (end - m.start() - 1) + text[end - 1])
+        else:
+            # line comment, or unterminated string
+            pieces.append(' ' * (end - m.start()))
+        pos = end
+        m = MASKED.search(text, pos)
+    pieces.append(text[pos:])
+    code = ''.join(pieces)
+
+    ends = list(itertools.accumulate(map(len, lines)))
+    code_lines = [code[s:e] for (s, e) in zip([0] + ends, ends)]
+    depths = list(itertools.accumulate((l.count('{') - l.count('}') for l in code_lines), initial=0))
+    last_chars = [l.rstrip()[-1:] for l in code_lines]
+    return depths, last_chars
+
+
+# Returns the (start, end) line ranges of the items at brace depth `level` in [start, end).
+# Attributes and comments belong to the item that follows them.
+def items(lines, depths, last_chars, start: int, end: int, level: int):
+    res = []
+    item_start = -1
+    for i in range(start, end):
+        if item_start == -1:
+            if lines[i].strip() == '':
+                continue
+            item_start = i
+        if depths[i + 1] == level and last_chars[i] in [';', '}']:
+            res.append((item_start, i + 1))
+            item_start = -1
+    if item_start != -1:
+        res.append((item_start, end))
+    return res
+
+
+# Returns the index of the first line of an item that is not an attribute or a comment
+def signature(lines, start: int, end: int):
+    i = start
+    while i < end:
+        l = lines[i].strip()
+        if l.startswith('#'):
+            # possibly multiline attribute
+            balance = l.count('[') - l.count(']')
+            while balance > 0 and i + 1 < end:
+                i += 1
+                balance += lines[i].count('[') - lines[i].count(']')
+        elif not (l == '' or l.startswith('//') or l.startswith('/*') or l.startswith('*')):
+            return i
+        i += 1
+    return start
+
+
+class RustItem:
+
+    def __init__(self, kind: str, name: str, parent: str, line: int, end_line: int,
+                 start_byte: int, end_byte: int, indent: str, has_body: bool):
+        # 'impl', 'trait', 'mod', 'fn' or 'type'
+        self.kind = kind
+        # the implemented structure for impls (see `struct_name`), or else the item name
+        self.name = name
+        # the enclosing impl or trait (`_None` outside of them)
+        self.parent = parent
+        # lines [line, end_line) from the signature, after the attributes and comments;
+        # new attributes are inserted before `line`, with the same indentation
+        self.line = line
+        self.end_line = end_line
+        self.start_byte = start_byte
+        self.end_byte = end_byte
+        self.indent = indent
+        # functions without bodies (in traits and extern blocks) cannot have contracts
+        self.has_body = has_body
+
+
+class ItemIndex:
+
+    def __init__(self, source: str):
+        if RUST is not None:
+            self.items = tree_sitter_items(source)
+        else:
+            self.items = scanned_items(source)
+        # functions by (parent, name)
+        self.functions = {}
+        for it in self.items:
+            if it.kind == 'fn':
+                self.functions.setdefault((it.parent, it.name), []).append(it)
+
+    def lookup(self, parent: str, name: str):
+        return self.functions.get((parent, name), [])
+
+    # Functions named `name` in any impl or trait
+    def lookup_name(self, name: str):
+        return [it for it in self.items if it.kind == 'fn' and it.name == name]
+
+
+index_cache = collections.OrderedDict()
+index_lock = threading.Lock()
+# number of cached indexes
+INDEX_CACHE_SIZE = 64
+
+
+def index_of(source: str):
+    key = hashlib.sha256(source.encode('utf-8')).hexdigest()
+    with index_lock:
+        if key in index_cache:
+            index_cache.move_to_end(key)
+            return index_cache[key]
+    index = ItemIndex(source)
+    with index_lock:
+        index_cache[key] = index
+        if len(index_cache) > INDEX_CACHE_SIZE:
+            index_cache.popitem(last=False)
+    return index
+
+
+def index_file(path: str):
+    with open(path, 'r') as f:
+        return index_of(f.read())
+
+
+# The structure named by a type, e.g., `S` for `&'a mut super::S<T>`
+def type_name(t: str):
+    return without_reference(t).split("+")[0].split("<")[0].split("::")[-1].strip()
+
+
+def tree_sitter_items(source: str):
+    data = source.encode('utf-8')
+    tree = tree_sitter.Parser(RUST).parse(data)
+    res = []
+
+    def add(kind: str, name: str, parent: str, node, has_body: bool):
+        line_start = data.rfind(b'\n', 0, node.start_byte) + 1
+        indent = data[line_start:node.start_byte].decode('utf-8')
+        if indent.strip() != '':
+            indent = re.match(r'\s*', indent).group()
+        res.append(RustItem(kind, name, parent, node.start_point[0], node.end_point[0] + 1,
+                            node.start_byte, node.end_byte, indent, has_body))
+
+    def text(node):
+        return node.text.decode('utf-8') if node is not None else ''
+
+    def visit(node, parent: str):
+        for child in node.named_children:
+            body = child.child_by_field_name('body')
+            if child.type == 'impl_item':
+                name = type_name(text(child.child_by_field_name('type')))
+                add('impl', name, parent, child, body is not None)
+                if body is not None:
+                    visit(body, name)
+            elif child.type == 'trait_item':
+                name = text(child.child_by_field_name('name'))
+                add('trait', name, parent, child, body is not None)
+                if body is not None:
+                    visit(body, name)
+            elif child.type == 'mod_item':
+                add('mod', text(child.child_by_field_name('name')), parent, child, body is not None)
+                if body is not None:
+                    visit(body, parent)
+            elif child.type in ['function_item', 'function_signature_item']:
+                add('fn', text(child.child_by_field_name('name')), parent, child, child.type == 'function_item')
+            elif child.type in ['struct_item', 'enum_item', 'union_item']:
+                add('type', text(child.child_by_field_name('name')), parent, child, True)
+            elif child.type == 'foreign_mod_item' and body is not None:
+                visit(body, parent)
+
+    visit(tree.root_node, '_None')
+    return res
+
+
+BLOCK_ITEM = re.compile(r'(impl\b|trait |auto trait |mod |extern "[^"]*"\s*\{)')
+FN_ITEM = re.compile(r'((const|async|unsafe|safe|extern\s+"[^"]*")\s+)*fn\s+(\w+)')
+TYPE_ITEM = re.compile(r'(struct|enum|union)\s+(\w+)')
+
+
+def scanned_items(source: str):
+    lines = source.splitlines(keepends=True)
+    # byte offsets of the lines
+    offsets = list(itertools.accumulate((len(l.encode('utf-8')) for l in lines), initial=0))
+    depths, last_chars = scan(lines)
+    res = []
+
+    def add(kind: str, name: str, parent: str, sig: int, end: int, has_body: bool):
+        indent = lines[sig][:len(lines[sig]) - len(lines[sig].lstrip())]
+        res.append(RustItem(kind, name, parent, sig, end, offsets[sig] + len(indent.encode('utf-8')),
+                            offsets[end], indent, has_body))
+
+    def visit(start: int, end: int, level: int, parent: str):
+        for (s, e) in items(lines, depths, last_chars, start, end, level):
+            sig = signature(lines, s, e)
+            l = trim_unsafe(trim_pub(lines[sig].strip()))
+            # the line that opens the block, if any
+            h = sig
+            while h < e and depths[h + 1] <= level:
+                h += 1
+            block = h < e - 1 and depths[e - 1] > level
+            m = BLOCK_ITEM.match(l)
+            if m is not None and block:
+                if l.startswith('mod '):
+                    add('mod', l.split()[1].strip('{;'), parent, sig, e, True)
+                    visit(h + 1, e - 1, level + 1, parent)
+                elif l.startswith('extern'):
+                    visit(h + 1, e - 1, level + 1, parent)
+                else:
+                    name = struct_name(' '.join(x.strip() for x in lines[sig:h + 1]))
+                    add('trait' if 'trait ' in m.group(1) else 'impl', name, parent, sig, e, True)
+                    visit(h + 1, e - 1, level + 1, name)
+                continue
+            m = FN_ITEM.match(l)
+            if m is not None:
+                add('fn', m.group(3), parent, sig, e, last_chars[e - 1] == '}')
+                continue
+            m = TYPE_ITEM.match(l)
+            if m is not None:
+                add('type', m.group(2), parent, sig, e, True)
+
+    visit(0, len(lines), 0, '_None')
+    return res
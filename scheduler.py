@@ -0,0 +1,234 @@
+import math
+import threading
+
+import style
+
+from chunker import RELEVANT, estimate_tokens
+from configuration import Config
+from manifest import manifest
+from metrics import TOKENS, current_file, metrics
+from sources import sources
+from worker import Worker
+
+# Spends the tokens of a run where they annotate the most functions. The cost of each
+# file is estimated from its size and its number of relevant functions (unsafe, or with
+# safety comments). With a budget (`token_budget`, `cost_budget`), the files are
+# annotated in the order of their relevant functions per estimated token, and a file
+# only starts if its estimate fits in what remains of the budget. The refinement rounds
+# of a file (and its harnesses) stop once the file has spent `file_token_cap` tokens,
+# once the budget is spent, or once the previous round improved the grade by less than
+# `min_gain_per_ktokens` per thousand tokens. The estimates are calibrated with the
+# tokens actually spent by the completed files.
+
+# requests of the contracts of a file, each with the attached file (or chunk)
+CONTRACT_REQUESTS = 8
+# requests of its harnesses
+HARNESS_REQUESTS = 4
+# tokens of the prompts and instructions of each request, besides the attached code
+PROMPT_TOKENS = 4000
+# output tokens of the contracts (or harnesses) of each relevant function
+FUNCTION_TOKENS = 500
+
+
+class Scheduler:
+
+    def __init__(self):
+        # estimated tokens and relevant functions of each file
+        self.estimates = {}
+        self.functions = {}
+        # estimates of the files being annotated
+        self.running = {}
+        # estimated and spent tokens of the completed files, to calibrate the estimates
+        self.estimated = 0
+        self.spent = 0
+        # files that were skipped, or whose refinement was stopped
+        self.skipped = []
+        self.stopped = []
+        self.lock = threading.Lock()
+
+    def active(self):
+        return Config.token_budget > 0 or Config.cost_budget > 0 or Config.file_token_cap > 0 or \
+            Config.min_gain_per_ktokens > 0
+
+    def budgeted(self):
+        return Config.token_budget > 0 or Config.cost_budget > 0
+
+    # Returns `files` in the order in which they should be annotated
+    def order(self, files):
+        if not self.budgeted():
+            return files
+        for f in files:
+            self.estimate(f)
+        res = sorted(files, key=lambda f: self.functions[f] / max(1, self.estimates[f]), reverse=True)
+        Config.verboseprint('Estimated tokens of the files:')
+        for f in res:
+            Config.verboseprint(f'  {f.removeprefix(Config.source_dir)}: {self.estimates[f]} tokens, '
+                                f'{self.functions[f]} relevant functions')
+        return res
+
+    # Estimates the tokens of the annotation of `f`, or of its new and changed items
+    def estimate(self, f: str, source: str = None):
+        if f in self.estimates:
+            return self.estimates[f]
+        if source is None:
+            source = read_source(f)
+        plan = manifest.plan(Worker.file_id_of(f), source or '')
+        items = plan.changed() if plan.incremental() else plan.items
+        code = plan.excerpt() if plan.incremental() else source or ''
+        functions = sum(1 for it in items if it.kind == 'fn' and RELEVANT.search(it.text))
+
+        tokens = estimate_tokens(code)
+        chunks = math.ceil(tokens / Config.chunk_tokens) if Config.chunk_tokens > 0 else 1
+        requests = CONTRACT_REQUESTS + (HARNESS_REQUESTS if Config.gen_harnesses else 0)
+        estimate = requests * (tokens + max(1, chunks) * PROMPT_TOKENS) + \
+            functions * FUNCTION_TOKENS * (2 if Config.gen_harnesses else 1)
+        if code.strip() == '':
+            estimate = 0
+        self.estimates[f], self.functions[f] = estimate, functions
+        return estimate
+
+    # The estimate of `f`, calibrated with the completed files, and within the file cap
+    def expected(self, f: str):
+        res = self.estimates[f]
+        if self.estimated > 0 and self.spent > 0:
+            res = int(res * self.spent / self.estimated)
+        if Config.file_token_cap > 0:
+            res = min(res, Config.file_token_cap)
+        return res
+
+    # Returns whether `f` (with `source`) fits in what remains of the budget; the files that
+    # are being annotated keep what their estimate did not spend yet
+    def admit(self, f: str, source: str):
+        if not self.budgeted():
+            return True
+        with self.lock:
+            self.estimate(f, source)
+            totals = spent_by_file()
+            reserved = sum(max(0, e - tokens(totals.get(g, {}))) for (g, e) in self.running.items())
+            expected = self.expected(f)
+            if not within_budget(totals_of(totals), reserved + expected):
+                self.skipped.append(f)
+                Config.log(f'{f}: skipped, {expected} estimated tokens over the budget')
+                return False
+            self.running[label(f)] = expected
+        return True
+
+    # Calibrates the estimates with the tokens spent by `f`
+    def finish(self, f: str):
+        if not self.budgeted():
+            return
+        with self.lock:
+            self.running.pop(label(f), None)
+            spent = tokens(spent_by_file().get(label(f), {}))
+            # the files answered from the response cache tell nothing about the cost
+            if spent > 0 and self.estimates.get(f, 0) > 0:
+                self.estimated += self.estimates[f]
+                self.spent += spent
+        Config.log(f'{f}: {spent} tokens spent, {self.estimates.get(f, 0)} estimated')
+
+    # Whether the current file may not spend more tokens, logged as `name`
+    def exhausted(self, name: str):
+        totals = spent_by_file()
+        if Config.file_token_cap > 0 and tokens(totals.get(current_file(), {})) >= Config.file_token_cap:
+            reason = f'the cap of {Config.file_token_cap} tokens per file is reached'
+        elif not within_budget(totals_of(totals), 1):
+            reason = 'the budget is spent'
+        else:
+            return False
+        self.stop(name, reason)
+        return True
+
+    def stop(self, name: str, reason: str):
+        Config.verboseprint(style.yellow(f'\t{reason.capitalize()}. Stopping the annotation of {name}'))
+        Config.log(f'{name}: stopped early, {reason}')
+        with self.lock:
+            self.stopped.append(name)
+
+    # Spent tokens and cost, and the files that were skipped or stopped
+    def report(self):
+        if not self.active():
+            return ''
+        total = totals_of(spent_by_file())
+        res = f'Spent {tokens(total)} tokens'
+        if Config.token_budget > 0:
+            res += f' of {Config.token_budget}'
+        res += f' (${cost(total):.2f}'
+        if Config.cost_budget > 0:
+            res += f' of ${Config.cost_budget:.2f}'
+        res += ')\n'
+        if self.skipped != []:
+            res += f'Skipped over the budget: {", ".join(label(f) for f in self.skipped)}\n'
+        if self.stopped != []:
+            res += f'Stopped early: {", ".join(dict.fromkeys(label(f) for f in self.stopped))}\n'
+        return res
+
+
+# The refinement rounds of a worker and an arbiter, stopped once they are not worth their tokens
+class Rounds:
+
+    def __init__(self, name: str, grade: int, *conversations):
+        self.name = name
+        self.grade = grade
+        self.conversations = conversations
+        self.checkpoints = [len(c.calls) for c in conversations]
+
+    # Whether to start another round, now that the previous one ended with `grade`
+    def worth_another(self, grade: int):
+        spent = sum(tokens(c) for (conv, i) in zip(self.conversations, self.checkpoints)
+                    for c in conv.calls[i:] if not c['cached'])
+        gain = grade - self.grade
+        self.grade = grade
+        self.checkpoints = [len(c.calls) for c in self.conversations]
+        if scheduler.exhausted(self.name):
+            return False
+        if Config.min_gain_per_ktokens > 0 and spent > 0 and gain * 1000 / spent < Config.min_gain_per_ktokens:
+            scheduler.stop(self.name, f'the last round improved the grade by {gain} for {spent} tokens')
+            return False
+        return True
+
+
+def read_source(f: str):
+    if f.startswith('https://') or f.startswith('http://'):
+        return sources.fetch(f)
+    try:
+        with open(f, 'r') as file:
+            return file.read()
+    except OSError:
+        return None
+
+
+# The label of `f` in the metrics
+def label(f: str):
+    return f.removeprefix(Config.source_dir)
+
+
+def spent_by_file():
+    return {f: totals for ((f,), totals) in metrics.requests_by('file').items()}
+
+
+def totals_of(by_file):
+    return {t: sum(totals[t] for totals in by_file.values()) for t in TOKENS}
+
+
+def tokens(totals):
+    return sum(totals.get(t, 0) for t in TOKENS)
+
+
+# USD of the tokens, at `token_prices` per million tokens
+def cost(totals):
+    return sum(totals.get(t, 0) * p for (t, p) in zip(TOKENS, Config.token_prices)) / 1e6
+
+
+# Whether `more` tokens (estimated) can be spent on top of the `total` ones
+def within_budget(total, more: int):
+    if Config.token_budget > 0 and tokens(total) + more > Config.token_budget:
+        return False
+    if Config.cost_budget > 0:
+        # the estimates are priced at the average price of the tokens spent so far
+        price = cost(total) / tokens(total) if tokens(total) > 0 else Config.token_prices[0] / 1e6
+        if cost(total) + more * price > Config.cost_budget:
+            return False
+    return True
+
+
+scheduler = Scheduler()
@@ -0,0 +1,94 @@
+import json
+import os
+import re
+import urllib.parse
+
+import style
+
+from concurrent.futures import ThreadPoolExecutor
+
+from configuration import Config
+from sources import sources
+
+
+# Snapshots of a remote `source_dir` on raw.githubusercontent.com: the branch or tag
+# is resolved once to a commit, and the files to annotate are downloaded (in parallel)
+# at that commit into `target_dir`/snapshots/. The rest of the pipeline then uses the
+# snapshot as a local source directory, so all files come from the same revision.
+
+RAW_GITHUB = "https://raw.githubusercontent.com/"
+
+
+# Splits a raw.githubusercontent.com URL into (owner, repository, ref)
+def parse_raw_url(url: str):
+    if not url.startswith(RAW_GITHUB):
+        return None
+    parts = url.removeprefix(RAW_GITHUB).strip('/').split('/')
+    if len(parts) >= 5 and parts[2] == 'refs' and parts[3] in ['heads', 'tags']:
+        return parts[0], parts[1], '/'.join(parts[2:5])
+    if len(parts) >= 3:
+        return parts[0], parts[1], parts[2]
+    return None
+
+
+# Returns the commit of `ref`, or None if it cannot be resolved
+def resolve(owner: str, repo: str, ref: str):
+    if re.fullmatch(r'[0-9a-f]{40}', ref):
+        return ref
+    if ref.startswith('refs/'):
+        candidates = [ref.removeprefix('refs/')]
+    else:
+        candidates = ['heads/' + ref, 'tags/' + ref]
+    for candidate in candidates:
+        content = sources.fetch(f'https://api.github.com/repos/{owner}/{repo}/git/ref/{urllib.parse.quote(candidate)}')
+        if content is None:
+            continue
+        obj = json.loads(content)['object']
+        if obj['type'] == 'tag':
+            # annotated tag, get the commit it points to
+            tag = sources.fetch(obj['url'])
+            if tag is None:
+                continue
+            obj = json.loads(tag)['object']
+        return obj['sha']
+    return None
+
+
+# Replaces the remote `Config.source_dir` by a local snapshot
+def take_snapshot():
+    parsed = parse_raw_url(Config.source_dir)
+    if parsed is None:
+        print(style.yellow(f'Snapshots are only supported for {RAW_GITHUB}, using {Config.source_dir} directly'))
+        return
+    owner, repo, ref = parsed
+    commit = resolve(owner, repo, ref)
+    if commit is None:
+        print(style.yellow(f'Cannot resolve {ref} of {owner}/{repo}, using {Config.source_dir} directly'))
+        return
+
+    remote_dir = f'{RAW_GITHUB}{owner}/{repo}/{commit}/'
+    snapshot_dir = f'{Config.target_dir}snapshots/{owner}-{repo}-{commit}/'
+    relative_files = [f.removeprefix(Config.source_dir) for f in Config.files_to_annotate]
+    Config.verboseprint(f'Taking a snapshot of {owner}/{repo} at {commit} ({len(relative_files)} files)')
+
+    def download(relative: str):
+        path = snapshot_dir + relative
+        # a commit never changes, the files already in the snapshot are up to date
+        if os.path.isfile(path):
+            return
+        content = sources.fetch(remote_dir + relative)
+        if content is None:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+
+    with ThreadPoolExecutor(max_workers=Config.snapshot_jobs) as executor:
+        list(executor.map(download, relative_files))
+
+    Config.log(f'snapshot of {Config.source_dir} at {commit}: {snapshot_dir}')
+    Config.source_dir = snapshot_dir
+    Config.files_to_annotate = Config.normalize_files(relative_files)
+    if Config.update_source:
+        Config.verboseprint(style.yellow('The sources of a snapshot cannot be updated, skipping the updates'))
+        Config.update_source = False
@@ -0,0 +1,113 @@
+import hashlib
+import http.client
+import json
+import os
+import threading
+import urllib.parse
+
+from configuration import Config
+
+
+# Fetches remote source files with one request per file, over keep-alive
+# connections reused by the requests of each thread. The bodies are stored
+# under `target_dir`/sources/ and revalidated with ETag/Last-Modified, so
+# unchanged files are not downloaded again by the following runs.
+class SourceFetcher:
+
+    def __init__(self):
+        # content of the files fetched during this run (None if not found), by URL
+        self.fetched = {}
+        self.lock = threading.Lock()
+        # connections of the current thread, by (scheme, host)
+        self.local = threading.local()
+
+    def directory(self):
+        return Config.target_dir + "sources/"
+
+    def path(self, url: str):
+        return self.directory() + hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def exists(self, url: str):
+        return self.fetch(url) is not None
+
+    # Returns the content of `url`, or None if it cannot be found
+    def fetch(self, url: str):
+        with self.lock:
+            if url in self.fetched:
+                return self.fetched[url]
+        content = self.download(url)
+        with self.lock:
+            self.fetched[url] = content
+        return content
+
+    def download(self, url: str):
+        cached, meta = self.read_cached(url)
+        headers = {}
+        if cached is not None and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if cached is not None and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        status, response_headers, body = self.request(url, headers)
+        if status == 304 and cached is not None:
+            return cached
+        if status != 200:
+            return None
+        content = body.decode('utf-8')
+        self.write_cached(url, content, {
+            'url': url,
+            'etag': response_headers.get('ETag', ''),
+            'last_modified': response_headers.get('Last-Modified', ''),
+        })
+        return content
+
+    def connection(self, scheme: str, host: str):
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = {}
+        if (scheme, host) not in self.local.connections:
+            if scheme == 'https':
+                self.local.connections[(scheme, host)] = http.client.HTTPSConnection(host, timeout=60)
+            else:
+                self.local.connections[(scheme, host)] = http.client.HTTPConnection(host, timeout=60)
+        return self.local.connections[(scheme, host)]
+
+    def request(self, url: str, headers):
+        u = urllib.parse.urlsplit(url)
+        path = u.path + ('?' + u.query if u.query else '')
+        # required by the GitHub API
+        headers = dict(headers, **{'User-Agent': 'contractgen'})
+        # a kept-alive connection may have been closed by the server, or timed out;
+        # it is dropped, and the request retried over a new one
+        for attempt in range(SourceFetcher.ATTEMPTS):
+            conn = self.connection(u.scheme, u.netloc)
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                return response.status, response.headers, response.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                del self.local.connections[(u.scheme, u.netloc)]
+                if attempt == SourceFetcher.ATTEMPTS - 1:
+                    raise
+
+    # attempts of each request
+    ATTEMPTS = 3
+
+    def read_cached(self, url: str):
+        try:
+            with open(self.path(url) + ".json", 'r') as f:
+                meta = json.load(f)
+            with open(self.path(url) + ".rs", 'r') as f:
+                return f.read(), meta
+        except (OSError, ValueError):
+            return None, {}
+
+    def write_cached(self, url: str, content: str, meta):
+        os.makedirs(self.directory(), exist_ok=True)
+        with open(self.path(url) + ".rs", 'w') as f:
+            f.write(content)
+        with open(self.path(url) + ".json", 'w') as f:
+            json.dump(meta, f)
+
+
+sources = SourceFetcher()
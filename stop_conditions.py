@@ -0,0 +1,22 @@
+# Stop conditions for streamed responses. Each condition receives the text
+# received so far and returns the length of its useful prefix, or None if
+# the stream should go on.
+
+
+# The first ```rust block is closed
+def first_rust_fence(text: str):
+    start = text.find("```rust\n")
+    if start == -1:
+        return None
+    end = text.find("```", start + len("```rust\n"))
+    if end == -1:
+        return None
+    return end + len("```")
+
+
+# The batch of harnesses is complete (see `Worker.harness_batch_request`)
+def end_of_harnesses(text: str):
+    end = text.find("END OF HARNESSES")
+    if end == -1:
+        return None
+    return end + len("END OF HARNESSES")
@@ -1,27 +1,47 @@
+import asyncio
 import os
+import re
 from subprocess import run
-from urllib.request import urlopen
 
-from add_contracts import annotate_file
+from add_contracts import annotate_file, parse_contracts
+from chunker import strip_fences
 from configuration import Config
-from conversation import Conversation
+from metrics import labelled, timed
+from conversation import new_conversation
+from rust_syntax import index_of, scan
+from sources import sources
+from stop_conditions import end_of_harnesses, first_rust_fence
 
 
+# The steps of the worker are coroutines, whatever the transport of its conversation
+# (see `new_conversation`)
 class Worker:
 
     def __init__(self):
         self.file_to_annotate = ''
-        self.conversation = Conversation(Config.worker_model, Config.worker_region, Config.prompt_dir)
+        self.conversation = new_conversation(Config.worker_model, Config.worker_region, Config.prompt_dir)
 
-    def hi(self):
+    async def hi(self):
         self.conversation.add_system_prompt(prompt_str='Hi!')
-        return self.conversation.hi()
+        return await self.conversation.hi()
 
-    def generate_contracts(self):
+    @timed('generate')
+    async def generate_contracts(self):
+        if not self.start_contracts():
+            return ''
+        await self.conversation.converse_async()
+        self.conversation.send_message_from_file('worker_closing_refine.txt')
+        self.generated_contracts = await self.conversation.converse_async()
+        if Config.gen_type_invariants:
+            self.generated_contracts = await self.generate_type_invariants()
+        return self.generated_contracts
+
+    # Sends the initial instructions and the source file; returns False if there is nothing to do
+    def start_contracts(self):
         if self.file_to_annotate == '':
             self.generated_contracts = ''
             Config.verboseprint('No file to annotate')
-            return ''
+            return False
 
         Config.verboseprint(f'\nGenerating contracts for {self.file_to_annotate}')
 
@@ -33,35 +53,104 @@ class Worker:
             prompt_filename='worker_system_prompt.txt')
         self.conversation.send_message_from_file('output_format.txt')
         self.attach_file()
-        self.conversation.converse()
-        self.conversation.send_message_from_file('worker_closing_refine.txt')
-        self.generated_contracts = self.conversation.converse()
-        if Config.gen_type_invariants:
-            self.generated_contracts = self.generate_type_invariants()
+        return True
+
+    # Restores the contracts of the previous run (see journal.py), with the context needed
+    # to generate their harnesses
+    def resume_contracts(self, contracts: str):
+        Config.verboseprint(f'\nResuming {self.file_to_annotate} with the contracts of the previous run')
+
+        self.copy_source_file()
+        self.conversation.add_system_prompt(
+            prompt_filename='worker_system_prompt.txt')
+        self.conversation.send_message_from_file('output_format.txt')
+        self.conversation.send_file_with_message(
+            """
+            You already performed the translation of safety comments as described above on the
+            attached source code. Here is your solution:
+            """ + "\n" + contracts,
+            Config.target_dir + self.file_id + ".rs")
+        self.conversation.set_checkpoint()
+        self.generated_contracts = contracts
+
+    async def generate_type_invariants(self):
+        if not self.start_type_invariants():
+            return ''
+        await self.conversation.converse_async()
+        self.conversation.send_message_str(Worker.TYPE_INVARIANTS_OUTPUT)
+        self.generated_contracts = await self.conversation.converse_async()
         return self.generated_contracts
 
-    def generate_type_invariants(self):
+    TYPE_INVARIANTS_OUTPUT = '''
+            Please print your solution without any explanations.
+            First, print the valid contracts in the original format you used.
+            Then, print the type invariants in the format I described above.
+        '''
+
+    def start_type_invariants(self):
         if self.file_to_annotate == '' or self.generated_contracts == '':
             Config.verboseprint('No type invarinats to generate')
-            return ''
+            return False
 
         Config.verboseprint(f'\tGenerating type invariants')
 
         self.conversation.send_message_from_file('worker_type_invariant.txt')
-        self.conversation.converse()
-        self.conversation.send_message_str(f'''
-            Please print your solution without any explanations.
-            First, print the valid contracts in the original format you used.
-            Then, print the type invariants in the format I described above.
-        ''')
-        self.generated_contracts = self.conversation.converse()
-        return self.generated_contracts
+        return True
+
+    @timed('harnesses')
+    async def generate_harnesses(self):
+        if not self.start_harnesses():
+            return ''
+        await self.conversation.converse_async()
+
+        funcs = self.list_of_updated_functions()
+        if Config.harness_batch_size <= 1:
+            res = Worker.HARNESSES_HEADER
+            for i, func in enumerate(funcs):
+                self.conversation.send_message_str(Worker.harness_request(func))
+                out = await self.conversation.converse_async(stop=first_rust_fence)
+                res += Worker.rust_block(out, "\n")
+            self.generated_harnesses = Worker.close_harnesses(res)
+            return self.generated_harnesses
+
+        harnesses = {}
+        batches = Worker.harness_batches(funcs)
+        if Config.harness_jobs <= 1 or len(batches) <= 1:
+            for batch in batches:
+                await Worker.request_harness_batch(self.conversation, batch, harnesses)
+        else:
+            # the batches are requested concurrently, each in its own branch of the conversation
+            branches = [self.conversation.fork() for _ in batches]
+            harness_jobs = asyncio.Semaphore(Config.harness_jobs)
+
+            async def request(i: int):
+                async with harness_jobs:
+                    await Worker.request_harness_batch(branches[i], batches[i], harnesses)
+
+            await asyncio.gather(*[labelled(request)(i) for i in range(len(batches))])
+            for branch in branches:
+                self.conversation.merge(branch)
+
+        self.generated_harnesses = Worker.join_harnesses(funcs, harnesses)
+        return self.generated_harnesses
 
-    def generate_harnesses(self):
+    # Requests the harnesses of the functions of `batch`, and then those that are missing
+    async def request_harness_batch(conversation, batch, harnesses):
+        missing = batch
+        for attempt in range(Worker.HARNESS_ATTEMPTS):
+            conversation.send_message_str(Worker.harness_batch_request(missing, attempt > 0))
+            out = await conversation.converse_async(stop=end_of_harnesses)
+            missing = Worker.read_harness_batch(out, missing, harnesses)
+            if missing == []:
+                break
+
+    HARNESSES_HEADER = "#[cfg(kani)] mod verify {use super::*;\n"
+
+    def start_harnesses(self):
         if self.file_to_annotate == '' or self.generated_contracts == '':
             self.generated_harnesses = ''
             Config.verboseprint('No harnesses to generate')
-            return ''
+            return False
 
         Config.verboseprint(
             f'Generating harnesses for {self.file_to_annotate}')
@@ -69,11 +158,10 @@ class Worker:
         self.generated_harnesses = ''
 
         self.conversation.send_message_from_file('harnesses.txt')
-        self.conversation.converse()
+        return True
 
-        res = "#[cfg(kani)] mod verify {use super::*;\n"
-        for i, func in enumerate(self.list_of_updated_functions()):
-            self.conversation.send_message_str(f'''
+    def harness_request(func: str):
+        return f'''
                 Using the knowledge gained from steps 1-3, please write a `kani::proof_for_contract`
                 for the function {func} that you annotated. Do not wrap it into `verify` module,
                 just print the Rust code of the proof:
@@ -87,44 +175,124 @@ class Worker:
                 - `kani::any()` can be used only with primitive types.
                 - In the proof you cannot use types that are not defined in the scope, e.g., `Vec` is not
                   allowed.
-            ''')
-            out = self.conversation.converse()
-            out = out.split("```rust\n")
-            if len(out) > 1:
-                res += "\n" + out[1].split("```")[0]
-
-        if res == "#[cfg(kani)] mod verify {use super::*;\n":
-            res = ''
-        else:
-            res += "}"
-        self.generated_harnesses = res
-        return self.generated_harnesses
+            '''
 
-    def autorefine_contracts(self):
+    # number of requests for the harnesses of a batch, including those for the missing ones
+    HARNESS_ATTEMPTS = 2
+
+    # Splits the (distinct) names of the functions into batches of `harness_batch_size`
+    def harness_batches(funcs):
+        names = list(dict.fromkeys(funcs))
+        k = Config.harness_batch_size
+        return [names[i:i + k] for i in range(0, len(names), k)]
+
+    def harness_batch_request(funcs, again: bool = False):
+        names = '\n'.join(f'- {func}' for func in funcs)
+        intro = 'Some of your harnesses were missing or incomplete. Please write them again' if again \
+            else 'Using the knowledge gained from steps 1-3, please write'
+        return f'''
+                {intro}: a `kani::proof_for_contract` for each of the following functions that
+                you annotated:
+
+                {names}
+
+                Do not wrap them into `verify` module. Print each proof in its own block,
+                preceded by the name of the function exactly as listed above, and finish with
+                `END OF HARNESSES`:
+
+                HARNESS: <function name>
+                ```rust
+                <your code>
+                ```
+
+                END OF HARNESSES
+
+                Notes:
+                - If several annotated functions have the same name, print all their proofs
+                  in the same block.
+                - In your harnesses, for the bound for verification use small values: typically 10 is enough.
+                - `kani::any()` can be used only with primitive types.
+                - In the proof you cannot use types that are not defined in the scope, e.g., `Vec` is not
+                  allowed.
+            '''
+
+    # Adds the well-formed harnesses of `out` for `funcs` to `harnesses` (by function name);
+    # returns the functions whose harnesses are missing or malformed
+    def read_harness_batch(out: str, funcs, harnesses):
+        for m in Worker.HARNESS_BLOCK.finditer(out):
+            name = m.group(1).strip('`')
+            if name in funcs and name not in harnesses and Worker.well_formed_harness(m.group(2)):
+                harnesses[name] = m.group(2)
+        return [func for func in funcs if func not in harnesses]
+
+    HARNESS_BLOCK = re.compile(r'^\s*HARNESS:\s*(\S+)\s*\n\s*```rust\n(.*?)```', re.MULTILINE | re.DOTALL)
+
+    # The code declares a contract harness, and its braces are balanced
+    def well_formed_harness(code: str):
+        if 'proof_for_contract' not in code:
+            return False
+        depths, _ = scan(code.splitlines(keepends=True))
+        return depths[-1] == 0
+
+    # The `verify` module with the harnesses, in the order of `funcs`
+    def join_harnesses(funcs, harnesses):
+        res = Worker.HARNESSES_HEADER
+        for func in dict.fromkeys(funcs):
+            if func in harnesses:
+                res += "\n" + harnesses[func]
+        return Worker.close_harnesses(res)
+
+    # Returns the code of the first rust block of the model's output (prefixed with `prefix`)
+    def rust_block(out: str, prefix: str = ""):
+        out = out.split("```rust\n")
+        if len(out) > 1:
+            return prefix + out[1].split("```")[0]
+        return ''
+
+    def close_harnesses(res: str):
+        if res == Worker.HARNESSES_HEADER:
+            return ''
+        return res + "}"
+
+    @timed('autorefine')
+    async def autorefine_contracts(self):
+        if not self.start_autorefine():
+            return ''
+        await self.conversation.converse_async()
+        self.conversation.send_message_from_file('worker_closing_refine.txt')
+        self.generated_contracts = await self.conversation.converse_async()
+        return self.generated_contracts
+
+    def start_autorefine(self):
         if self.file_to_annotate == '':
             self.generated_contracts = ''
-            return ''
+            return False
 
         Config.verboseprint(f'\tAutorefine contracts')
 
         self.generated_contracts = ''
 
         self.conversation.send_message_from_file('worker_autorefine.txt')
-        self.conversation.converse()
-        self.conversation.send_message_from_file('worker_closing_refine.txt')
-        self.generated_contracts = self.conversation.converse()
-        return self.generated_contracts
+        return True
 
-    def refine_contracts(self, instructions: str):
+    @timed('refine')
+    async def refine_contracts(self, instructions: str):
         Config.verboseprint(f'\t{Config.worker_model} refines its solution')
 
         self.conversation.send_message_str(instructions)
-        self.conversation.converse()
+        await self.conversation.converse_async()
         self.conversation.send_message_from_file('worker_closing_refine.txt')
-        self.generated_contracts = self.conversation.converse()
+        self.generated_contracts = await self.conversation.converse_async()
         return self.generated_contracts
 
-    def refine_harnesses(self, instructions: str):
+    @timed('refine harnesses')
+    async def refine_harnesses(self, instructions: str):
+        self.start_refine_harnesses(instructions)
+        out = await self.conversation.converse_async(stop=first_rust_fence)
+        self.generated_harnesses = Worker.close_harnesses(Worker.HARNESSES_HEADER + Worker.rust_block(out))
+        return self.generated_harnesses
+
+    def start_refine_harnesses(self, instructions: str):
         Config.verboseprint(f'\t{Config.worker_model} refines its solution')
 
         instructions += """
@@ -137,16 +305,8 @@ class Worker:
         self.generated_harnesses = ''
 
         self.conversation.send_message_str(instructions)
-        out = self.conversation.converse()
-        out = out.split("```rust\n")
-        res = "#[cfg(kani)] mod verify {use super::*;\n"
-        if len(out) > 1:
-            res += out[1].split("```")[0]
-        if res != "#[cfg(kani)] mod verify {use super::*;\n":
-            self.generated_harnesses = res + "}"
-
-        return self.generated_harnesses
 
+    @timed('save')
     def save_generated_contracts(self):
         if self.generated_contracts == '':
             return
@@ -166,6 +326,7 @@ class Worker:
                       Config.target_dir + self.file_id + "_contracts.rs",
                       Config.target_dir + self.file_id + "_annotated.rs")
 
+    @timed('save')
     def save_generated_harnesses(self):
         if self.generated_harnesses == '':
             return
@@ -209,32 +370,40 @@ class Worker:
         self.generated_contracts = ''
         self.generated_harnesses = ''
         self.file_to_annotate = file_to_annotate
-        relative_filename = file_to_annotate.removeprefix(Config.source_dir)
-        self.file_id = relative_filename.split('.')[0].replace('/', '-')
+        self.file_id = Worker.file_id_of(file_to_annotate)
         self.source_code = self.read_source_file()
 
+    # Annotates only `code`, the chunk number `index` of `file_to_annotate` (see chunker.py)
+    def set_chunk_to_annotate(self, file_to_annotate: str, index: int, code: str):
+        self.generated_contracts = ''
+        self.generated_harnesses = ''
+        self.file_to_annotate = file_to_annotate
+        self.file_id = Worker.file_id_of(file_to_annotate) + f'_chunk{index}'
+        self.source_code = code
+
+    def file_id_of(file_to_annotate: str):
+        relative_filename = file_to_annotate.removeprefix(Config.source_dir)
+        return relative_filename.split('.')[0].replace('/', '-')
+
     def read_source_file(self):
-        if self.file_to_annotate.startswith('https://'):
-            return urlopen(self.file_to_annotate).read().decode('utf-8')
+        if self.file_to_annotate.startswith('https://') or self.file_to_annotate.startswith('http://'):
+            return sources.fetch(self.file_to_annotate)
         else:
             with open(self.file_to_annotate, 'r') as file:
                 return file.read()
 
+    # Returns the functions of the contracts that exist in the source file (with a body)
     def list_of_updated_functions(self):
         res = []
         if self.generated_contracts == '':
             return res
 
-        ls = self.generated_contracts.split('\n')
-        for (i, l) in enumerate(ls):
-            if "type invariant" in l.lower(): # missing 's' in 'invariants' on purpose
-                if i-1 >= 0 and ls[i-1].strip() != '':
-                    res.append(ls[i-1])
-                return res
-            if l.strip() == '':
-                res.append(ls[i-1])
-        if ls[-1].strip() != '':
-            res.append(ls[-1])
+        index = index_of(self.source_code)
+        for (impl, _, fname, _) in parse_contracts(strip_fences(self.generated_contracts).split('\n')):
+            # the worker may get the name of the structure wrong
+            fns = index.lookup(impl, fname) or index.lookup_name(fname)
+            if any(f.has_body for f in fns):
+                res.append(fname)
         return res
 
     def log_summary(self):
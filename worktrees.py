@@ -0,0 +1,118 @@
+import contextlib
+import os
+import queue
+import shutil
+import subprocess
+import threading
+
+import style
+
+import compile_check
+from configuration import Config
+
+# A pool of git worktrees of the source directory, in `target_dir`/worktrees, where the
+# updated files are compiled without touching the checkout of the user. The worktrees
+# are checked out at the HEAD of the source directory, and each one has its own build
+# directories, so that up to `compile_jobs` checks can run at the same time. They are
+# kept between runs, so that the builds stay incremental. The files that replaced their
+# original during the run (see `promote`) are copied into each worktree before its next
+# use, so that each check builds them together with the earlier annotated files.
+
+
+def git(*args, cwd: str):
+    return subprocess.run(["git", "-C", cwd, *args], capture_output=True, text=True, check=False)
+
+
+class WorktreePool:
+
+    def __init__(self):
+        # directories of the free worktrees (within the worktree, the source directory)
+        self.free = None
+        # whether the worktrees could be created, set on first use
+        self.usable = None
+        # number of times each promoted file (relative to the source directory) was promoted
+        self.promoted = {}
+        # versions of the promoted files copied into each worktree, by index
+        self.synced = {}
+        self.lock = threading.Lock()
+
+    def directory(self):
+        return os.path.abspath(Config.target_dir + "worktrees") + '/'
+
+    # Returns whether the updated files can be compiled in worktrees
+    def available(self):
+        with self.lock:
+            if self.usable is None:
+                self.usable = self.create()
+            return self.usable
+
+    def create(self):
+        if shutil.which("git") is None:
+            return False
+        head = git("rev-parse", "HEAD", cwd=Config.source_dir)
+        prefix = git("rev-parse", "--show-prefix", cwd=Config.source_dir)
+        if head.returncode != 0 or prefix.returncode != 0:
+            Config.verboseprint(style.yellow(f'{Config.source_dir} is not a git checkout, compiling in place'))
+            return False
+
+        self.free = queue.Queue()
+        for i in range(Config.compile_jobs):
+            path = self.directory() + str(i)
+            if os.path.isdir(path):
+                r = git("checkout", "--force", "--detach", head.stdout.strip(), cwd=path)
+            else:
+                git("worktree", "prune", cwd=Config.source_dir)
+                r = git("worktree", "add", "--force", "--detach", path, head.stdout.strip(), cwd=Config.source_dir)
+            if r.returncode != 0:
+                Config.verboseprint(style.yellow(f'Cannot create a worktree in {path}: {r.stderr.strip()}'))
+                return False
+            self.free.put((i, path + '/' + prefix.stdout.strip()))
+            self.synced[i] = {}
+        return True
+
+    # Records that `f` replaced its original in the source directory
+    def promote(self, f: str):
+        relative = f.removeprefix(Config.source_dir)
+        with self.lock:
+            self.promoted[relative] = self.promoted.get(relative, 0) + 1
+
+    # Copies the files promoted since the last use of worktree `i` into it
+    def sync(self, i: int, root: str):
+        with self.lock:
+            todo = [(r, v) for (r, v) in self.promoted.items() if self.synced[i].get(r) != v]
+        for (relative, version) in todo:
+            shutil.copyfile(Config.source_dir + relative, root + relative)
+            self.synced[i][relative] = version
+
+    # Restores the file `relative` of a worktree, as checked out or as promoted
+    def restore(self, i: int, root: str, relative: str):
+        with self.lock:
+            promoted = relative in self.synced[i]
+        if promoted:
+            shutil.copyfile(Config.source_dir + relative, root + relative)
+        else:
+            git("checkout", "--", relative, cwd=root)
+
+    # Acquires a free worktree, with the promoted files; yields its index and its source directory
+    @contextlib.contextmanager
+    def acquire(self):
+        i, root = self.free.get()
+        try:
+            self.sync(i, root)
+            yield i, root
+        finally:
+            self.free.put((i, root))
+
+    # Compiles the crate of `f` with `generated_file` in place of `f`, in a free worktree
+    def check(self, f: str, generated_file: str):
+        relative = f.removeprefix(Config.source_dir)
+        with self.acquire() as (i, root):
+            Config.verboseprint(f'\tChecking {relative} in worktree {i}')
+            shutil.copyfile(generated_file, root + relative)
+            try:
+                return compile_check.check(f, root, compile_check.build_dir() + f'{i}/')
+            finally:
+                self.restore(i, root, relative)
+
+
+worktrees = WorktreePool()